@@ -0,0 +1,204 @@
+"""Admission control for the expensive stages: LLM calls and speech synthesis.
+
+Two checks run before a request is allowed to start work:
+
+* a token bucket per user, so one person (or one link shared in a WhatsApp
+  group and opened from the same account) can't take over the worker;
+* a gate per stage that lets a fixed number of calls run at once. Calls
+  beyond that wait in a bounded queue for up to a few seconds; once the
+  queue is full, or the wait runs out, they are shed straight away.
+
+A rejected request raises Busy with the number of seconds after which a
+retry is likely to succeed; the routes turn it into a localized "busy"
+reply with a Retry-After header (429 for the rate limit, 503 for a full
+stage). Limits are per process, like the rest of the in-memory state.
+
+    ADMISSION_ENABLED       "0" turns every check off (default "1")
+    USER_RATE_PER_MINUTE    sustained chat/upload requests per user (default 20)
+    USER_BURST              requests a user may send back to back (default 10)
+    LLM_CONCURRENCY         LLM calls in flight (default 32)
+    LLM_MAX_WAITING         requests waiting for an LLM slot (default 64)
+    LLM_MAX_WAIT_SECONDS    longest wait for an LLM slot (default 10)
+    TTS_CONCURRENCY         gTTS calls in flight (default 4)
+    TTS_MAX_WAITING         syntheses waiting for a TTS slot (default 32)
+    TTS_MAX_WAIT_SECONDS    longest wait for a TTS slot (default 30)
+"""
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+ENABLED = os.getenv("ADMISSION_ENABLED", "1") == "1"
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "20"))
+USER_BURST = int(os.getenv("USER_BURST", "10"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "32"))
+LLM_MAX_WAITING = int(os.getenv("LLM_MAX_WAITING", "64"))
+LLM_MAX_WAIT_SECONDS = float(os.getenv("LLM_MAX_WAIT_SECONDS", "10"))
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", "4"))
+TTS_MAX_WAITING = int(os.getenv("TTS_MAX_WAITING", "32"))
+TTS_MAX_WAIT_SECONDS = float(os.getenv("TTS_MAX_WAIT_SECONDS", "30"))
+
+# Buckets kept for the most recently seen users; older ones start full again
+MAX_TRACKED_USERS = 10000
+
+# How often an async caller re-checks a gate it is queued on
+POLL_SECONDS = 0.05
+
+
+class Busy(Exception):
+    """Admission refused; retry after ``retry_after`` seconds."""
+
+    def __init__(self, reason, retry_after, status=503):
+        super().__init__(f"{reason}, retry in {retry_after}s")
+        self.reason = reason
+        self.retry_after = retry_after
+        self.status = status
+
+
+class UserRateLimiter:
+    """Token bucket per user: ``burst`` requests at once, ``per_minute`` sustained."""
+
+    def __init__(self, per_minute=USER_RATE_PER_MINUTE, burst=USER_BURST, enabled=ENABLED, clock=time.monotonic):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.enabled = enabled and per_minute > 0
+        self.clock = clock
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"allowed": 0, "limited": 0}
+
+    def check(self, user):
+        """Take a token for ``user`` or raise Busy (429)."""
+        if not self.enabled:
+            return
+        now = self.clock()
+        with self.lock:
+            tokens, updated = self.buckets.pop(user, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                self.counters["allowed"] += 1
+                retry_after = None
+            else:
+                self.counters["limited"] += 1
+                retry_after = math.ceil((1 - tokens) / self.rate)
+            self.buckets[user] = (tokens, now)
+            while len(self.buckets) > MAX_TRACKED_USERS:
+                self.buckets.popitem(last=False)
+        if retry_after is not None:
+            raise Busy("rate limited", retry_after, status=429)
+
+    def stats(self):
+        with self.lock:
+            return {**self.counters, "enabled": self.enabled, "per_minute": round(self.rate * 60, 2),
+                    "burst": self.burst, "tracked_users": len(self.buckets)}
+
+
+class Ticket:
+    """A slot held in a StageGate; release() (or leaving the ``with``) gives it back once."""
+
+    def __init__(self, gate, admitted_at):
+        self.gate = gate
+        self.admitted_at = admitted_at
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.gate._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class StageGate:
+    """At most ``limit`` holders at once, ``queue_size`` waiting, the rest shed."""
+
+    def __init__(self, name, limit, queue_size, wait_seconds, enabled=ENABLED):
+        self.name = name
+        self.limit = limit
+        self.queue_size = queue_size
+        self.wait_seconds = wait_seconds
+        self.enabled = enabled and limit > 0
+        self.in_flight = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+        self.counters = {"admitted": 0, "queued": 0, "shed": 0, "timed_out": 0}
+        self.wait_total = 0.0
+        # Moving average of how long a slot is held, for Retry-After
+        self.hold_average = 1.0
+
+    def retry_after(self):
+        """Seconds until the queue ahead of a new caller has likely drained."""
+        rounds = (self.waiting + 1) / max(1, self.limit)
+        return max(1, math.ceil(self.hold_average * rounds))
+
+    def _admit_now(self, started):
+        self.in_flight += 1
+        self.counters["admitted"] += 1
+        self.wait_total += time.monotonic() - started
+        return Ticket(self, time.monotonic())
+
+    def _shed(self, counter):
+        self.counters[counter] += 1
+        return Busy(f"{self.name} busy", self.retry_after())
+
+    def admit(self):
+        """Wait for a slot and return its Ticket, or raise Busy (503)."""
+        started = time.monotonic()
+        with self.cond:
+            if not self.enabled or self.in_flight < self.limit:
+                return self._admit_now(started)
+            if self.waiting >= self.queue_size:
+                raise self._shed("shed")
+            self.waiting += 1
+            self.counters["queued"] += 1
+            try:
+                if not self.cond.wait_for(lambda: self.in_flight < self.limit, self.wait_seconds):
+                    raise self._shed("timed_out")
+                return self._admit_now(started)
+            finally:
+                self.waiting -= 1
+
+    async def aadmit(self):
+        """admit() for coroutines: polls instead of blocking the event loop."""
+        started = time.monotonic()
+        with self.cond:
+            if not self.enabled or self.in_flight < self.limit:
+                return self._admit_now(started)
+            if self.waiting >= self.queue_size:
+                raise self._shed("shed")
+            self.waiting += 1
+            self.counters["queued"] += 1
+        try:
+            deadline = started + self.wait_seconds
+            while True:
+                await asyncio.sleep(POLL_SECONDS)
+                with self.cond:
+                    if self.in_flight < self.limit:
+                        return self._admit_now(started)
+                    if time.monotonic() >= deadline:
+                        raise self._shed("timed_out")
+        finally:
+            with self.cond:
+                self.waiting -= 1
+
+    def _release(self, ticket):
+        held = time.monotonic() - ticket.admitted_at
+        with self.cond:
+            self.in_flight -= 1
+            self.hold_average += (held - self.hold_average) * 0.1
+            self.cond.notify()
+
+    def stats(self):
+        with self.cond:
+            admitted = self.counters["admitted"]
+            return {**self.counters, "enabled": self.enabled, "limit": self.limit, "queue_size": self.queue_size,
+                    "in_flight": self.in_flight, "waiting": self.waiting,
+                    "avg_wait_seconds": round(self.wait_total / admitted, 3) if admitted else 0.0,
+                    "avg_hold_seconds": round(self.hold_average, 3)}
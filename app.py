@@ -1,16 +1,37 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
-import sqlite3, os, uuid, re, requests, datetime, smtplib, random, string
-from gtts import gTTS
+from flask import Flask, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context
+import click
+from markupsafe import escape
+import os, io, re, datetime, random, string, json, time, base64
 import logging
-import threading
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
 
 from dotenv import load_dotenv
 load_dotenv()
 
+import admission
+import chat_archive
+import chat_batch
+import db
+import llm_client
+import llm_router
+import metrics
+from db import get_or_create_session, save_chat_message, delete_chat_session
+from reply_cache import ReplyCache, ENABLED as REPLY_CACHE_ENABLED
+from voice_cache import VoiceCache
+from tts_jobs import VoiceJobQueue
+from mailer import Outbox
+from conversation import ConversationContext
+from local_answers import LocalAnswers, ENABLED as LOCAL_ANSWERS_ENABLED
+from retention import StorageCollector
+from uploads import ImageStore, StageTimer, UploadRejected, MAX_BYTES as UPLOAD_MAX_BYTES
+from media import MediaDirectory
+from werkzeug.exceptions import RequestEntityTooLarge
+
 app = Flask(__name__)
 app.secret_key = os.getenv("FLASK_SECRET_KEY", "krishi_secret_key")
+metrics.init_app(app)
+render_template = metrics.timed("render_template")(render_template)
+# Refuse oversized bodies before they are parsed; the slack covers the multipart framing
+app.config["MAX_CONTENT_LENGTH"] = UPLOAD_MAX_BYTES + 64 * 1024
 
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
@@ -18,15 +39,16 @@ logging.basicConfig(level=logging.DEBUG)
 # Email Configuration
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS", "")
 EMAIL_PASSWORD = os.getenv("EMAIL_PASSWORD", "")
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
+SMTP_SERVER = os.getenv("SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1") == "1"
 
 # Handle storage for Serverless environments (like Vercel)
 IS_VERCEL = os.getenv("VERCEL") == "1"
 
 if IS_VERCEL:
     # Use /tmp for writable files in serverless
-    BASE_DIR = "/tmp"
+    BASE_DIR = os.getenv("SERVERLESS_TMP_DIR", "/tmp")
     DB_PATH = os.path.join(BASE_DIR, "krishi.db")
     UPLOADS_DIR = os.path.join(BASE_DIR, "uploads")
     VOICES_DIR = os.path.join(BASE_DIR, "voices")
@@ -40,41 +62,31 @@ else:
 # Ensure folders exist
 os.makedirs(UPLOADS_DIR, exist_ok=True)
 os.makedirs(VOICES_DIR, exist_ok=True)
+image_store = ImageStore(UPLOADS_DIR)
+upload_media = MediaDirectory(UPLOADS_DIR, "uploads")
+voice_media = MediaDirectory(VOICES_DIR, "voices")
+storage_gc = StorageCollector(db.get_connection, UPLOADS_DIR, VOICES_DIR)
+
+# Prebuilt empty database (``flask --app app db-snapshot``) copied into a fresh
+# /tmp on a serverless cold start instead of replaying every migration; on
+# Vercel one deployed next to app.py is picked up by default
+BUNDLED_SNAPSHOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "krishi.snapshot.db")
+DB_SNAPSHOT = os.getenv("DB_SNAPSHOT", BUNDLED_SNAPSHOT if IS_VERCEL and os.path.exists(BUNDLED_SNAPSHOT) else "")
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    conn.execute('''CREATE TABLE IF NOT EXISTS users
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     email TEXT UNIQUE,
-                     username TEXT,
-                     password TEXT,
-                     is_verified INTEGER DEFAULT 0,
-                     verification_code TEXT)''')
-    
-    conn.execute('''CREATE TABLE IF NOT EXISTS chat_sessions
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     username TEXT,
-                     session_name TEXT DEFAULT 'Chat Session',
-                     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                     FOREIGN KEY (username) REFERENCES users (username))''')
-    
-    conn.execute('''CREATE TABLE IF NOT EXISTS chat_messages
-                    (id INTEGER PRIMARY KEY AUTOINCREMENT,
-                     session_id INTEGER,
-                     message_type TEXT,
-                     message_text TEXT,
-                     response_text TEXT,
-                     image_filename TEXT,
-                     voice_filename TEXT,
-                     language TEXT,
-                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                     FOREIGN KEY (session_id) REFERENCES chat_sessions (id))''')
-    conn.close()
+    """Bring the database schema up to date (see db.MIGRATIONS)."""
+    db.configure(DB_PATH)
+    if db.seed_from_snapshot(DB_PATH, DB_SNAPSHOT):
+        logging.info(f"Seeded {DB_PATH} from {DB_SNAPSHOT}")
+    db.migrate()
 init_db()
 
 # LLM configuration (OpenRouter)
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY", "")
 OPENROUTER_URL = os.getenv("OPENROUTER_URL", "https://openrouter.ai/api/v1/chat/completions")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-001")
+# Picks the model for each call from LLM_MODELS (default OPENROUTER_MODEL)
+model_router = llm_router.ModelRouter()
 
 SYSTEM_PROMPT = (
     "You are Krishi Mitra — an AI assistant for Indian farmers. "
@@ -89,18 +101,16 @@ def generate_verification_code():
     """Generate a 6-digit verification code"""
     return ''.join(random.choices(string.digits, k=6))
 
+outbox = Outbox(db.get_connection, EMAIL_ADDRESS, EMAIL_PASSWORD, SMTP_SERVER, SMTP_PORT, starttls=SMTP_STARTTLS)
+
+@metrics.timed("send_verification_email")
 def send_verification_email(email, username, verification_code):
-    """Send verification email to user"""
+    """Queue the verification email; the outbox sender delivers it."""
     try:
-        if not EMAIL_ADDRESS or not EMAIL_PASSWORD:
+        if not outbox.configured:
             logging.error("EMAIL_ADDRESS/EMAIL_PASSWORD are not configured.")
             return False
 
-        msg = MIMEMultipart()
-        msg['From'] = EMAIL_ADDRESS
-        msg['To'] = email
-        msg['Subject'] = "Verify Your Email - Krishi Mitra"
-        
         body = f"""
         <html>
         <body>
@@ -112,189 +122,416 @@ def send_verification_email(email, username, verification_code):
         </html>
         """
         
-        msg.attach(MIMEText(body, 'html'))
-        
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(EMAIL_ADDRESS, EMAIL_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        
-        logging.info(f"Verification email sent to {email}")
+        outbox.enqueue(email, "Verify Your Email - Krishi Mitra", body)
+        logging.info(f"Verification email queued for {email}")
         return True
     except Exception as e:
-        logging.error(f"Failed to send verification email: {e}")
+        logging.error(f"Failed to queue verification email: {e}")
         return False
 
 def clean_text(text):
     return text.strip()
 
-def text_to_speech_simple(text, lang="en"):
-    """Simple Google TTS without pydub dependencies"""
-    try:
-        language_map = {
-            "kn": "kn", "hi": "hi", "en": "en", "te": "te", "ml": "ml", "ta": "ta"
-        }
-        
-        lang_code = language_map.get(lang, "en")
-        filename = f"{uuid.uuid4().hex}.mp3"
-        filepath = os.path.join(VOICES_DIR, filename)
-        
-        text = text.strip()
-        if not text:
-            text = "ಸಂದೇಶ ಲಭ್ಯವಿಲ್ಲ"
-        
-        slow_speed = lang != "en"
-        
+TTS_LANGUAGES = {
+    "kn": "kn", "hi": "hi", "en": "en", "te": "te", "ml": "ml", "ta": "ta"
+}
+
+# Admission control: per-user request rate and how many LLM and gTTS calls run at once
+user_limiter = admission.UserRateLimiter()
+llm_gate = admission.StageGate("llm", admission.LLM_CONCURRENCY, admission.LLM_MAX_WAITING,
+                               admission.LLM_MAX_WAIT_SECONDS)
+tts_gate = admission.StageGate("tts", admission.TTS_CONCURRENCY, admission.TTS_MAX_WAITING,
+                               admission.TTS_MAX_WAIT_SECONDS)
+
+@metrics.timed("gtts")
+def synthesize_speech(text, lang_code, slow, filepath):
+    """Run gTTS for one text and write the mp3 to filepath.
+
+    Raises admission.Busy when too many syntheses are already running.
+    """
+    # gTTS (and requests under it) is imported on the first synthesis, not at startup
+    from gtts import gTTS
+
+    with tts_gate.admit():
         try:
-            tts = gTTS(text=text, lang=lang_code, slow=slow_speed, lang_check=False)
+            tts = gTTS(text=text, lang=lang_code, slow=slow, lang_check=False)
             tts.save(filepath)
-            
-            if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-                return filename
-            else:
-                return None
-                
+            return os.path.exists(filepath) and os.path.getsize(filepath) > 0
         except Exception as gtts_error:
             logging.error(f"gTTS error: {gtts_error}")
+            metrics.count_error(type(gtts_error).__name__, "gtts")
             try:
                 tts = gTTS(text=text, lang=lang_code, slow=False)
                 tts.save(filepath)
-                if os.path.exists(filepath) and os.path.getsize(filepath) > 0:
-                    return filename
-            except Exception:
-                return None
-            
+                return os.path.exists(filepath) and os.path.getsize(filepath) > 0
+            except Exception as e:
+                metrics.count_error(type(e).__name__, "gtts")
+                return False
+
+tts_cache = VoiceCache(VOICES_DIR, synthesize_speech)
+
+# Synthesize long replies sentence by sentence so playback can start early
+TTS_CHUNKED = os.getenv("TTS_CHUNKED", "1") == "1"
+
+# How long a request waits for a voice (or the next voice chunk) to appear
+VOICE_WAIT_SECONDS = 10
+
+def tts_params(text, lang="en"):
+    """Text, gTTS language code and slow flag used to synthesize a reply."""
+    text = text.strip()
+    if not text:
+        text = "ಸಂದೇಶ ಲಭ್ಯವಿಲ್ಲ"
+    return text, TTS_LANGUAGES.get(lang, "en"), lang != "en"
+
+@metrics.timed("text_to_speech")
+def text_to_speech_simple(text, lang="en"):
+    """Simple Google TTS without pydub dependencies.
+
+    Files are content-addressed, so identical texts reuse one mp3.
+    """
+    try:
+        text, lang_code, slow_speed = tts_params(text, lang)
+        if TTS_CHUNKED:
+            return tts_cache.get_or_create_chunked(text, lang_code, slow_speed)
+        return tts_cache.get_or_create(text, lang_code, slow_speed)
+    except admission.Busy:
+        raise
     except Exception as e:
         logging.error(f"Google TTS Error: {str(e)}")
         return None
 
 def text_to_speech(text, lang="en"):
-    return text_to_speech_simple(text, lang)
+    """Voice job entry point: a job the TTS gate sheds just fails."""
+    try:
+        return text_to_speech_simple(text, lang)
+    except admission.Busy as e:
+        logging.warning(f"Voice synthesis shed: {e}")
+        return None
 
-def generate_reply(prompt, lang="en"):
-    """Get AI-generated response from OpenRouter model."""
-    if not OPENROUTER_API_KEY:
-        if lang == "kn":
-            return "AI ಸೇವೆಯನ್ನು ಈಗ ಬಳಸಲು ಆಗುತ್ತಿಲ್ಲ. ದಯವಿಟ್ಟು ನಿರ್ವಾಹಕರನ್ನು ಸಂಪರ್ಕಿಸಿ."
-        elif lang == "hi":
-            return "AI सेवा अभी उपलब्ध नहीं है। कृपया व्यवस्थापक से संपर्क करें।"
-        return "AI service is not configured. Please contact the administrator."
+voice_jobs = VoiceJobQueue(db.get_connection, text_to_speech)
+
+def voice_url(voice_filename):
+    return f"/voices/{voice_filename}" if voice_filename else None
+
+def queue_voice(reply, lang, username, message_id):
+    """Start the voice job for a reply and describe it for the client.
+
+    ``voice`` is set if the file is already there (cache hit or inline job),
+    otherwise ``voice_stream`` can be played right away when chunked TTS is
+    on, and ``voice_job`` can always be followed for the final file.
+    """
+    job_id = voice_jobs.submit(reply, lang, username, message_id)
+    job = voice_jobs.get(job_id)
+    voice = voice_url(job["voice_filename"])
+    playable = TTS_CHUNKED and not voice and job["status"] not in ("failed", "dropped")
+    return {
+        "voice": voice,
+        "voice_job": job_id,
+        "voice_stream": f"/voices/stream/{job_id}" if playable else None
+    }
+
+ERROR_MESSAGES = {
+    "not_configured": {
+        "kn": "AI ಸೇವೆಯನ್ನು ಈಗ ಬಳಸಲು ಆಗುತ್ತಿಲ್ಲ. ದಯವಿಟ್ಟು ನಿರ್ವಾಹಕರನ್ನು ಸಂಪರ್ಕಿಸಿ.",
+        "hi": "AI सेवा अभी उपलब्ध नहीं है। कृपया व्यवस्थापक से संपर्क करें।",
+        "en": "AI service is not configured. Please contact the administrator.",
+    },
+    "service": {
+        "kn": "ಕ್ಷಮಿಸಿ, ಸೇವೆಯೊಂದಿಗೆ ಸಂಪರ್ಕ ಸಾಧಿಸಲು ಸಾಧ್ಯವಾಗುತ್ತಿಲ್ಲ. ದಯವಿಟ್ಟು ಕೆಲವು ನಿಮಿಷಗಳ ನಂತರ ಮತ್ತೆ ಪ್ರಯತ್ನಿಸಿ.",
+        "hi": "क्षमा करें, सेवा से कनेक्ट नहीं हो पा रहा है। कृपया कुछ मिनटों बाद पुनः प्रयास करें।",
+        "en": "Sorry, unable to connect to the service. Please try again after some time.",
+    },
+    "network": {
+        "kn": "ನೆಟ್ವರ್ಕ್ ದೋಷ ಸಂಭವಿಸಿದೆ. ದಯವಿಟ್ಟು ಮತ್ತೆ ಪ್ರಯತ್ನಿಸಿ.",
+        "hi": "नेटवर्क त्रुटि हुई। कृपया पुनः प्रयास करें।",
+        "en": "Network error occurred. Please try again.",
+    },
+    "image_too_large": {
+        "kn": "ಚಿತ್ರ ತುಂಬಾ ದೊಡ್ಡದಾಗಿದೆ. ದಯವಿಟ್ಟು ಚಿಕ್ಕ ಚಿತ್ರವನ್ನು ಅಪ್‌ಲೋಡ್ ಮಾಡಿ.",
+        "hi": "चित्र बहुत बड़ा है। कृपया छोटा चित्र अपलोड करें।",
+        "en": "The image is too large. Please upload a smaller photo.",
+    },
+    "busy": {
+        "kn": "ಈಗ ತುಂಬಾ ಜನ ಕೇಳುತ್ತಿದ್ದಾರೆ. ದಯವಿಟ್ಟು {seconds} ಸೆಕೆಂಡುಗಳ ನಂತರ ಮತ್ತೆ ಪ್ರಯತ್ನಿಸಿ.",
+        "hi": "अभी बहुत सारे अनुरोध आ रहे हैं। कृपया {seconds} सेकंड बाद पुनः प्रयास करें।",
+        "en": "Too many requests right now. Please try again in {seconds} seconds.",
+    },
+    "image_invalid": {
+        "kn": "ಈ ಫೈಲ್ ಅನ್ನು ಚಿತ್ರವಾಗಿ ಓದಲು ಆಗಲಿಲ್ಲ. ದಯವಿಟ್ಟು JPEG ಅಥವಾ PNG ಫೋಟೋ ಅಪ್‌ಲೋಡ್ ಮಾಡಿ.",
+        "hi": "यह फ़ाइल चित्र के रूप में नहीं पढ़ी जा सकी। कृपया JPEG या PNG फ़ोटो अपलोड करें।",
+        "en": "This file could not be read as an image. Please upload a JPEG or PNG photo.",
+    },
+}
+
+EMPTY_REPLY = "ಕ್ಷಮಿಸಿ, ಉತ್ತರ ಸಿಗಲಿಲ್ಲ."
+
+# Replies that stand in for a real answer; these must never be cached
+FALLBACK_REPLIES = {EMPTY_REPLY} | {text for messages in ERROR_MESSAGES.values() for text in messages.values()}
 
+response_cache = ReplyCache(db.get_connection) if REPLY_CACHE_ENABLED else None
+
+def error_message(kind, lang="en"):
+    """Localized error string shown to the user instead of a model reply."""
+    metrics.count_error(kind, "reply")
+    messages = ERROR_MESSAGES[kind]
+    return messages.get(lang, messages["en"])
+
+def busy_reply(e, lang="en"):
+    """JSON body and headers for a request refused by admission control."""
+    reply = error_message("busy", lang).format(seconds=e.retry_after)
+    return {"reply": reply, "voice": None, "retry_after": e.retry_after}, {"Retry-After": str(e.retry_after)}
+
+def busy_response(e, lang="en"):
+    payload, headers = busy_reply(e, lang)
+    return jsonify(payload), e.status, headers
+
+def batch_busy(e, lang="en"):
+    """Result of a batch question shed by admission control."""
+    return {"reply": error_message("busy", lang).format(seconds=e.retry_after), "error": "busy",
+            "retry_after": e.retry_after}
+
+def openrouter_request(prompt, stream=False, image_url=None, context=None):
+    """Build headers and JSON body for an OpenRouter chat completion.
+
+    ``image_url`` (usually a base64 data URL) is sent as an image part
+    alongside the prompt. ``context`` is the list of earlier messages from
+    ConversationContext.build().
+    """
     headers = {
         "Authorization": f"Bearer {OPENROUTER_API_KEY}",
         "Content-Type": "application/json"
     }
+    content = prompt
+    if image_url:
+        content = [
+            {"type": "text", "text": prompt},
+            {"type": "image_url", "image_url": {"url": image_url}}
+        ]
     data = {
-        "model": "google/gemini-2.0-flash-001",
+        "model": OPENROUTER_MODEL,
         "messages": [
             {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": prompt}
+            *(context or []),
+            {"role": "user", "content": content}
         ]
     }
-    try:
-        r = requests.post(OPENROUTER_URL, headers=headers, json=data, timeout=30)
-        if r.status_code == 200:
-            reply = r.json().get("choices", [{}])[0].get("message", {}).get("content", "")
-            return clean_text(reply if reply else "ಕ್ಷಮಿಸಿ, ಉತ್ತರ ಸಿಗಲಿಲ್ಲ.")
-        else:
-            logging.error(f"OpenRouter API Error: {r.status_code} - {r.text}")
-            if lang == "kn":
-                return "ಕ್ಷಮಿಸಿ, ಸೇವೆಯೊಂದಿಗೆ ಸಂಪರ್ಕ ಸಾಧಿಸಲು ಸಾಧ್ಯವಾಗುತ್ತಿಲ್ಲ. ದಯವಿಟ್ಟು ಕೆಲವು ನಿಮಿಷಗಳ ನಂತರ ಮತ್ತೆ ಪ್ರಯತ್ನಿಸಿ."
-            elif lang == "hi":
-                return "क्षमा करें, सेवा से कनेक्ट नहीं हो पा रहा है। कृपया कुछ मिनटों बाद पुनः प्रयास करें।"
-            else:
-                return "Sorry, unable to connect to the service. Please try again after some time."
-    except Exception as e:
-        logging.error(f"Request Error: {e}")
-        if lang == "kn":
-            return "ನೆಟ್ವರ್ಕ್ ದೋಷ ಸಂಭವಿಸಿದೆ. ದಯವಿಟ್ಟು ಮತ್ತೆ ಪ್ರಯತ್ನಿಸಿ."
-        elif lang == "hi":
-            return "नेटवर्क त्रुटि हुई। कृपया पुनः प्रयास करें।"
-        else:
-            return "Network error occurred. Please try again."
+    if stream:
+        data["stream"] = True
+    return headers, data
 
-def get_or_create_session(username, session_id=None):
-    """Get existing session or create new one."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    if session_id:
-        cursor.execute("SELECT id, session_name FROM chat_sessions WHERE id = ? AND username = ?", 
-                      (session_id, username))
-        session = cursor.fetchone()
-        if session:
-            conn.close()
-            return session[0], session[1]
-    
-    session_name = f"Chat {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
-    cursor.execute("INSERT INTO chat_sessions (username, session_name) VALUES (?, ?)", 
-                  (username, session_name))
-    session_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return session_id, session_name
-
-def save_chat_message(session_id, message_type, message_text, response_text, image_filename=None, voice_filename=None, language="en"):
-    """Save chat message to database."""
+def reply_text(payload):
+    """The cleaned reply out of a (non-streamed) chat completion response."""
+    reply = payload.get("choices", [{}])[0].get("message", {}).get("content", "")
+    return clean_text(reply if reply else EMPTY_REPLY)
+
+def stream_piece(line):
+    """Parse one line of a streamed completion: (finished, text piece or None)."""
+    # Blank lines separate events, ":" lines are keep-alive comments
+    if not line or not line.startswith("data:"):
+        return False, None
+    payload = line[len("data:"):].strip()
+    if payload == "[DONE]":
+        return True, None
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute('''INSERT INTO chat_messages 
-                        (session_id, message_type, message_text, response_text, image_filename, voice_filename, language)
-                        VALUES (?, ?, ?, ?, ?, ?, ?)''',
-                    (session_id, message_type, message_text, response_text, image_filename, voice_filename, language))
-        conn.execute("UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (session_id,))
-        conn.commit()
-        conn.close()
-        return True
-    except Exception as e:
-        print("Error saving chat message:", e)
-        return False
+        chunk = json.loads(payload)
+    except ValueError:
+        return False, None
+    return False, chunk.get("choices", [{}])[0].get("delta", {}).get("content")
+
+def cache_prompt_for(prompt, image=None):
+    """Reply cache key text: the prompt plus the content hash of an image."""
+    return prompt if image is None else f"{prompt}\n[image {image['digest']}]"
 
-def get_chat_sessions(username):
-    """Get all chat sessions for a user."""
+def image_prompt(lang):
+    return f"A farmer uploaded a photo of a crop. Analyze this image and describe what crop it may be, identify any visible diseases or pests, and suggest remedies in {lang} language."
+
+def is_fallback_reply(reply):
+    return reply in FALLBACK_REPLIES
+
+SUMMARY_PROMPT = (
+    "You keep a running summary of a conversation between a farmer and an agricultural assistant. "
+    "Update the summary with the new exchanges. Keep the crops, location, field size, symptoms, "
+    "quantities and advice already given; drop greetings and repetition. "
+    "Reply with the summary only, at most 120 words, in the language the farmer uses."
+)
+
+@metrics.timed("summarize")
+def summarize_turns(summary, turns):
+    """Extend a session summary with (question, answer) turns; None on failure."""
+    if not OPENROUTER_API_KEY:
+        return None
+
+    exchanges = "\n".join(f"Farmer: {question}\nAssistant: {answer}" for question, answer in turns)
+    headers = {
+        "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+        "Content-Type": "application/json"
+    }
+    data = {
+        "model": OPENROUTER_MODEL,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": f"Current summary:\n{summary or '(none)'}\n\nNew exchanges:\n{exchanges}"}
+        ],
+        "max_tokens": 300
+    }
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT id, session_name, created_at, updated_at 
-                         FROM chat_sessions 
-                         WHERE username = ? 
-                         ORDER BY updated_at DESC''', (username,))
-        sessions = cursor.fetchall()
-        conn.close()
-        return sessions
+        r = model_router.post(OPENROUTER_URL, headers=headers, json=data, hedge=False)
+        if r.status_code != 200:
+            logging.error(f"OpenRouter summary error: {r.status_code} - {r.text}")
+            return None
+        text = r.json().get("choices", [{}])[0].get("message", {}).get("content", "")
+        return clean_text(text) or None
     except Exception as e:
-        print("Error retrieving chat sessions:", e)
+        logging.error(f"Summary request error: {e}")
+        return None
+
+conversation = ConversationContext(db.get_connection, summarize_turns, SYSTEM_PROMPT, skip_reply=is_fallback_reply)
+
+# Known questions answered from the knowledge base and chat history
+local_index = LocalAnswers(db.get_connection, skip_reply=is_fallback_reply) if LOCAL_ANSWERS_ENABLED else None
+
+def local_reply(prompt, lang, context=None):
+    """A confident local answer to a fresh question, or None to ask the model.
+
+    A follow-up (non-empty ``context``) depends on the conversation, so it
+    always goes to the model.
+    """
+    if local_index is None or context:
+        return None
+    return local_index.answer(prompt, lang)
+
+def offline_reply(prompt, lang, reply):
+    """The closest local answer in place of a stand-in ``reply`` (an error message)."""
+    if local_index is None:
+        return reply
+    return local_index.fallback(prompt, lang) or reply
+
+def reply_context(session_id, prompt):
+    """Earlier turns of the session to send with ``prompt`` (empty without a session)."""
+    if session_id is None:
         return []
+    return conversation.build(session_id, prompt)
+
+@metrics.timed("generate_reply")
+def generate_reply(prompt, lang="en", use_cache=True, image=None, session_id=None):
+    """Get AI-generated response, served from the reply cache when possible.
+
+    ``image`` is an upload from ImageStore.ingest() with its "data_url" set;
+    its content hash is part of the cache key, so the same photo asked about
+    again is answered from the cache. With ``session_id`` the earlier turns
+    of that session are sent along, and the cache is only consulted for the
+    first message of a session since a follow-up means something different
+    in every conversation. A text question the local index knows is
+    answered from it without calling the model, and so is one the model
+    fails on if the index has something close (see local_answers.py).
+    """
+    context = reply_context(session_id, prompt)
+    if image is None:
+        local = local_reply(prompt, lang, context)
+        if local is not None:
+            return local
+    use_cache = use_cache and response_cache is not None and not context
+    cache_prompt = cache_prompt_for(prompt, image)
+    if use_cache:
+        cached = response_cache.get(cache_prompt, lang)
+        if cached is not None:
+            return cached
 
-def get_chat_messages(session_id):
-    """Get all messages for a chat session."""
+    reply = request_reply(prompt, lang, image_url=image["data_url"] if image else None, context=context)
+    if is_fallback_reply(reply):
+        return reply if image is not None else offline_reply(prompt, lang, reply)
+    if use_cache:
+        response_cache.put(cache_prompt, lang, reply)
+    return reply
+
+@metrics.timed("openrouter")
+def request_reply(prompt, lang="en", image_url=None, context=None):
+    """Get AI-generated response from OpenRouter model."""
+    if not OPENROUTER_API_KEY:
+        return error_message("not_configured", lang)
+
+    headers, data = openrouter_request(prompt, image_url=image_url, context=context)
     try:
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute('''SELECT message_type, message_text, response_text, image_filename, voice_filename, language, timestamp
-                         FROM chat_messages 
-                         WHERE session_id = ? 
-                         ORDER BY timestamp ASC''', (session_id,))
-        messages = cursor.fetchall()
-        conn.close()
-        return messages
+        r = model_router.post(OPENROUTER_URL, headers=headers, json=data)
+        if r.status_code == 200:
+            return reply_text(r.json())
+        else:
+            logging.error(f"OpenRouter API Error: {r.status_code} - {r.text}")
+            return error_message("service", lang)
+    except llm_client.CircuitOpenError:
+        return error_message("service", lang)
     except Exception as e:
-        print("Error retrieving chat messages:", e)
-        return []
+        logging.error(f"Request Error: {e}")
+        return error_message("network", lang)
+
+def generate_reply_stream(prompt, lang="en", use_cache=True, session_id=None):
+    """Yield the OpenRouter reply piece by piece as tokens arrive.
 
-def delete_chat_session(session_id, username):
-    """Delete a chat session and all its messages."""
+    On failure a single localized error string is yielded instead, so callers
+    can treat the output exactly like the text of generate_reply(). A cached
+    or local answer is yielded whole, and a local answer stands in for the
+    error string when there is a close one.
+    """
+    context = reply_context(session_id, prompt)
+    local = local_reply(prompt, lang, context)
+    if local is not None:
+        yield local
+        return
+    use_cache = use_cache and response_cache is not None and not context
+    if use_cache:
+        cached = response_cache.get(prompt, lang)
+        if cached is not None:
+            yield cached
+            return
+
+    if not OPENROUTER_API_KEY:
+        yield offline_reply(prompt, lang, error_message("not_configured", lang))
+        return
+
+    headers, data = openrouter_request(prompt, stream=True, context=context)
+    produced = False
+    parts = []
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
-        conn.execute("DELETE FROM chat_sessions WHERE id = ? AND username = ?", (session_id, username))
-        conn.commit()
-        conn.close()
-        return True
+        with model_router.post(OPENROUTER_URL, headers=headers, json=data, stream=True) as r:
+            if r.status_code != 200:
+                logging.error(f"OpenRouter API Error: {r.status_code} - {r.text}")
+                yield offline_reply(prompt, lang, error_message("service", lang))
+                return
+            for line in r.iter_lines(decode_unicode=True):
+                finished, piece = stream_piece(line)
+                if finished:
+                    break
+                if piece:
+                    produced = True
+                    parts.append(piece)
+                    yield piece
+    except llm_client.CircuitOpenError:
+        yield offline_reply(prompt, lang, error_message("service", lang))
+        return
     except Exception as e:
-        print("Error deleting chat session:", e)
-        return False
+        logging.error(f"Stream Request Error: {e}")
+        if not produced:
+            yield offline_reply(prompt, lang, error_message("network", lang))
+        return
+
+    if not produced:
+        yield offline_reply(prompt, lang, EMPTY_REPLY)
+    elif use_cache:
+        response_cache.put(prompt, lang, clean_text("".join(parts)))
+
+def sse_event(event, data):
+    """Format one Server-Sent Event frame with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.template_filter("thumbnail")
+def thumbnail_filter(filename):
+    return image_store.thumbnail_for(filename)
+
+@app.before_request
+def start_background_work():
+    storage_gc.start()
+    if local_index is not None:
+        local_index.start()
 
 # ---------------- ROUTES ----------------
 
@@ -316,20 +553,11 @@ def register():
             return render_template("register.html", error="Enter valid email.")
         
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT * FROM users WHERE email = ? OR username = ?", (email, username))
-            if cursor.fetchone():
-                conn.close()
+            if db.user_exists(email, username):
                 return render_template("register.html", error="Email/Username exists.")
             
             verification_code = generate_verification_code()
-            
-            cursor.execute("INSERT INTO users (email, username, password, verification_code) VALUES (?, ?, ?, ?)", 
-                          (email, username, password, verification_code))
-            conn.commit()
-            conn.close()
+            db.create_user(email, username, password, verification_code)
             
             if send_verification_email(email, username, verification_code):
                 session['pending_email'] = email
@@ -355,21 +583,10 @@ def verify_email():
             return render_template("verify_email.html", error="Enter code", email=email)
         
         try:
-            conn = sqlite3.connect(DB_PATH)
-            cursor = conn.cursor()
-            
-            cursor.execute("SELECT * FROM users WHERE email = ? AND verification_code = ?", 
-                          (email, verification_code))
-            user = cursor.fetchone()
-            
-            if user:
-                cursor.execute("UPDATE users SET is_verified = 1, verification_code = NULL WHERE email = ?", (email,))
-                conn.commit()
-                conn.close()
+            if db.verify_user(email, verification_code):
                 session.pop('pending_email', None)
                 return redirect(url_for('login'))
             else:
-                conn.close()
                 return render_template("verify_email.html", error="Invalid code", email=email)
                 
         except Exception as e:
@@ -383,11 +600,7 @@ def login():
         email = request.form['email'].strip().lower()
         password = request.form['password'].strip()
         
-        conn = sqlite3.connect(DB_PATH)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users WHERE email = ? AND password = ?", (email, password))
-        user = cursor.fetchone()
-        conn.close()
+        user = db.find_user(email, password)
         
         if user:
             if user[4] == 1:  # is_verified
@@ -419,15 +632,161 @@ def index():
         session['current_session_id'] = session_id
         session['current_session_name'] = session_name
     
-    current_messages = get_chat_messages(session['current_session_id'])
-    chat_sessions = get_chat_sessions(session['user'])
+    # Only the newest page of each is rendered; the rest loads on scroll
+    current_messages, more_messages = db.get_chat_messages_page(session['current_session_id'], MESSAGES_PAGE_SIZE)
+    chat_sessions, more_sessions = db.get_chat_sessions_page(session['user'], SESSIONS_PAGE_SIZE)
     
     return render_template('index.html', 
                          user=session['user'],
                          current_messages=current_messages,
                          chat_sessions=chat_sessions,
                          current_session_id=session['current_session_id'],
-                         current_session_name=session['current_session_name'])
+                         current_session_name=session['current_session_name'],
+                         messages_cursor=message_cursor(current_messages) if more_messages else None,
+                         sessions_cursor=session_cursor(chat_sessions) if more_sessions else None)
+
+# ---------------- HISTORY API ----------------
+
+MESSAGES_PAGE_SIZE = int(os.getenv("MESSAGES_PAGE_SIZE", "30"))
+SESSIONS_PAGE_SIZE = int(os.getenv("SESSIONS_PAGE_SIZE", "50"))
+MAX_PAGE_SIZE = 200
+
+def encode_cursor(values):
+    """Opaque, URL-safe cursor for a keyset position."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    """Keyset position from a cursor, None for no cursor. Raises ValueError."""
+    if not cursor:
+        return None
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        timestamp, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(timestamp), int(row_id)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+def message_cursor(rows):
+    oldest = rows[0]
+    return encode_cursor([oldest[6], oldest[7]])
+
+def session_cursor(rows):
+    last = rows[-1]
+    return encode_cursor([last[3], last[0]])
+
+def page_limit(default):
+    limit = request.args.get("limit", default, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+def conditional_json(payload):
+    """JSON response with an ETag, answered with 304 if the client's copy matches."""
+    response = jsonify(payload)
+    response.headers["Cache-Control"] = "private, no-cache"
+    response.add_etag()
+    return response.make_conditional(request)
+
+@app.route("/api/sessions")
+def api_sessions():
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    try:
+        before = decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    rows, has_more = db.get_chat_sessions_page(session['user'], page_limit(SESSIONS_PAGE_SIZE), before)
+    return conditional_json({
+        "success": True,
+        "sessions": [
+            {"id": row[0], "name": row[1], "created_at": row[2], "updated_at": row[3]}
+            for row in rows
+        ],
+        "next_cursor": session_cursor(rows) if has_more else None
+    })
+
+@app.route("/api/sessions/<int:session_id>/messages")
+def api_session_messages(session_id):
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    if not db.session_belongs_to(session_id, session['user']):
+        return jsonify({"success": False, "error": "Unknown session"}), 404
+    try:
+        before = decode_cursor(request.args.get("cursor"))
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+
+    rows, has_more = db.get_chat_messages_page(session_id, page_limit(MESSAGES_PAGE_SIZE), before)
+    return conditional_json({
+        "success": True,
+        "messages": [
+            {
+                "id": row[7],
+                "type": row[0],
+                "text": row[1],
+                "response": row[2],
+                "image": row[3],
+                "thumbnail": image_store.thumbnail_for(row[3]) if row[3] else None,
+                "voice": voice_url(row[4]),
+                "language": row[5],
+                "timestamp": row[6]
+            }
+            for row in rows
+        ],
+        "next_cursor": message_cursor(rows) if has_more else None
+    })
+
+SEARCH_PAGE_SIZE = 20
+
+def highlight(snippet):
+    """HTML-escape a search snippet and mark the matched terms."""
+    escaped = str(escape(snippet or ""))
+    return escaped.replace(db.SNIPPET_START, "<mark>").replace(db.SNIPPET_END, "</mark>")
+
+@app.route("/search")
+def search():
+    """Full-text search over the logged-in user's questions and answers.
+
+    Query parameters: ``q`` (required), ``from``/``to`` (YYYY-MM-DD,
+    inclusive), ``page`` (1-based) and ``limit``.
+    """
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+
+    terms = db.search_terms(request.args.get("q", ""))
+    if not terms:
+        return jsonify({"success": False, "error": "Enter a search term"}), 400
+
+    dates = {}
+    for name in ("from", "to"):
+        value = request.args.get(name)
+        if value:
+            try:
+                dates[name] = datetime.date.fromisoformat(value).isoformat()
+            except ValueError:
+                return jsonify({"success": False, "error": f"Invalid {name} date"}), 400
+
+    page = max(1, request.args.get("page", 1, type=int))
+    limit = page_limit(SEARCH_PAGE_SIZE)
+    rows, has_more = db.search_messages(session['user'], terms, limit, offset=(page - 1) * limit,
+                                        since=dates.get("from"), until=dates.get("to"))
+    return jsonify({
+        "success": True,
+        "results": [
+            {
+                "message_id": row[0],
+                "session_id": row[1],
+                "session_name": row[2],
+                "type": row[3],
+                "language": row[4],
+                "timestamp": row[5],
+                "question": highlight(row[6]),
+                "answer": highlight(row[7])
+            }
+            for row in rows
+        ],
+        "page": page,
+        "next_page": page + 1 if has_more else None
+    })
 
 @app.route("/new_chat", methods=["POST"])
 def new_chat():
@@ -467,33 +826,178 @@ def chat():
     if not user_message:
         return jsonify({"reply": "ದಯವಿಟ್ಟು ಸಂದೇಶವನ್ನು ನಮೂದಿಸಿ.", "voice": None})
 
-    reply = generate_reply(user_message, lang)
-    
-    voice_filename = None
-    def generate_voice():
-        nonlocal voice_filename
-        voice_filename = text_to_speech(reply, lang)
-    
-    voice_thread = threading.Thread(target=generate_voice)
-    voice_thread.start()
-    voice_thread.join(timeout=10)
-    
-    voice_url = f"/voices/{voice_filename}" if voice_filename else None
+    try:
+        user_limiter.check(session['user'])
+        with llm_gate.admit():
+            reply = generate_reply(user_message, lang, session_id=session['current_session_id'])
+    except admission.Busy as e:
+        return busy_response(e, lang)
 
-    save_chat_message(
+    message_id = save_chat_message(
         session_id=session['current_session_id'],
         message_type="text",
         message_text=user_message,
         response_text=reply,
-        voice_filename=voice_filename,
         language=lang
     )
+    conversation.update(session['current_session_id'])
 
     return jsonify({
         "reply": reply,
-        "voice": voice_url
+        **queue_voice(reply, lang, session['user'], message_id)
     })
 
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Streaming variant of /chat that forwards tokens as Server-Sent Events.
+
+    Events: ``token`` ({"text"}) for each piece of the reply, ``reply`` with
+    the full cleaned text once the model is done, ``voice`` with the fields
+    of queue_voice(), and a final ``done``.
+    """
+    if 'user' not in session or 'current_session_id' not in session:
+        return jsonify({"reply": "Please login first.", "voice": None}), 401
+
+    user_message = request.form.get("message", "").strip()
+    lang = request.form.get("lang", "en")
+
+    if not user_message:
+        return jsonify({"reply": "ದಯವಿಟ್ಟು ಸಂದೇಶವನ್ನು ನಮೂದಿಸಿ.", "voice": None}), 400
+
+    session_id = session['current_session_id']
+    username = session['user']
+    try:
+        user_limiter.check(username)
+        ticket = llm_gate.admit()
+    except admission.Busy as e:
+        return busy_response(e, lang)
+
+    def save(parts):
+        reply = clean_text("".join(parts)) or EMPTY_REPLY
+        message_id = save_chat_message(
+            session_id=session_id,
+            message_type="text",
+            message_text=user_message,
+            response_text=reply,
+            language=lang
+        )
+        conversation.update(session_id)
+        return reply, message_id
+
+    def events():
+        parts = []
+        pieces = generate_reply_stream(user_message, lang, session_id=session_id)
+        with ticket, metrics.stage("generate_reply_stream"):
+            try:
+                for piece in pieces:
+                    parts.append(piece)
+                    yield sse_event("token", {"text": piece})
+            except GeneratorExit:
+                # The client went away mid-reply. The model is answering (and
+                # being paid for) anyway, so finish the reply for the history
+                parts.extend(pieces)
+                save(parts)
+                raise
+
+        reply, message_id = save(parts)
+        yield sse_event("reply", {"reply": reply})
+
+        voice = queue_voice(reply, lang, username, message_id)
+        if not voice["voice"] and not voice["voice_stream"]:
+            # The stream is already open, so wait here for the voice instead
+            # of making the client poll; on timeout it can follow the job id.
+            job = voice_jobs.wait(voice["voice_job"], VOICE_WAIT_SECONDS)
+            voice["voice"] = voice_url(job and job["voice_filename"])
+        yield sse_event("voice", voice)
+        yield sse_event("done", {})
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+    # The generator's own cleanup never runs if the client leaves before it starts
+    response.call_on_close(ticket.release)
+    return response
+
+def batch_session(username, payload):
+    """The session a batch asked to be saved into (None for a new one).
+
+    Raises BatchRejected for a session the user doesn't own.
+    """
+    session_id = payload.get("session_id")
+    if session_id is None:
+        return None
+    if not isinstance(session_id, int) or not db.session_belongs_to(session_id, username):
+        raise chat_batch.BatchRejected("Unknown session_id.")
+    return session_id
+
+def save_batch(username, session_id, answered):
+    """Save answered (question, reply) pairs in one transaction, one message per item.
+
+    Returns (session_id, messages saved, id of each question's first message).
+    """
+    rows = [(message, reply, question.lang) for question, reply in answered for _, message in question.items]
+    if not rows:
+        return session_id, 0, {}
+    session_id, ids = db.save_chat_batch(username, session_id, rows)
+    conversation.update(session_id)
+    first_ids = {}
+    position = 0
+    for question, _ in answered:
+        first_ids[question] = ids[position]
+        position += len(question.items)
+    return session_id, len(ids), first_ids
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch_route():
+    """Answer many questions in one request, streamed as NDJSON (see chat_batch.py)."""
+    if 'user' not in session:
+        return jsonify({"error": "Please login first."}), 401
+
+    username = session['user']
+    payload = request.get_json(silent=True)
+    try:
+        questions = chat_batch.parse(payload)
+        session_id = batch_session(username, payload)
+        user_limiter.check(username)
+    except chat_batch.BatchRejected as e:
+        return jsonify({"error": str(e)}), 400
+    except admission.Busy as e:
+        return busy_response(e, payload.get("lang") or "en")
+
+    def answer(question):
+        try:
+            with llm_gate.admit():
+                return {"reply": generate_reply(question.message, question.lang)}
+        except admission.Busy as e:
+            return batch_busy(e, question.lang)
+
+    def lines():
+        answered = []
+        results = chat_batch.answer_all(questions, answer)
+        try:
+            for question, result in results:
+                if "error" not in result:
+                    answered.append((question, result["reply"]))
+                yield chat_batch.ndjson({"event": "reply", "items": question.indexes, "lang": question.lang, **result})
+        except GeneratorExit:
+            # The client went away: save the questions answered so far
+            results.close()
+            save_batch(username, session_id, answered)
+            raise
+
+        saved_session, saved, first_ids = save_batch(username, session_id, answered)
+        for question, reply in answered:
+            if question.voice:
+                voice = queue_voice(reply, question.lang, username, first_ids[question])
+                yield chat_batch.ndjson({"event": "voice", "items": question.indexes, **voice})
+        yield chat_batch.ndjson({"event": "done", "session_id": saved_session, "saved": saved,
+                                 "questions": len(questions), "items": len(payload["items"])})
+
+    return Response(lines(), mimetype="application/x-ndjson",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
 @app.route("/upload", methods=["POST"])
 def upload_image():
     if 'user' not in session or 'current_session_id' not in session:
@@ -505,39 +1009,58 @@ def upload_image():
     if not image:
         return jsonify({"reply": "ದಯವಿಟ್ಟು ಚಿತ್ರವನ್ನು ಅಪ್‌ಲೋಡ್ ಮಾಡಿ.", "voice": None})
 
-    filename = f"{uuid.uuid4().hex}_{image.filename}"
-    filepath = os.path.join(UPLOADS_DIR, filename)
-    image.save(filepath)
+    try:
+        user_limiter.check(session['user'])
+    except admission.Busy as e:
+        return busy_response(e, lang)
 
-    prompt = f"A farmer uploaded a crop image named {image.filename}. Analyze this image and describe what crop it may be, identify any visible diseases or pests, and suggest remedies in {lang} language."
+    timer = StageTimer()
+    try:
+        stored = image_store.ingest(image.stream, timer)
+    except UploadRejected as e:
+        logging.warning(f"Upload {image.filename!r} rejected: {e}")
+        kind = "image_too_large" if e.reason == "too_large" else "image_invalid"
+        return jsonify({"reply": error_message(kind, lang), "voice": None}), 413 if e.reason == "too_large" else 400
 
-    reply = generate_reply(prompt, lang)
-    
-    voice_filename = None
-    def generate_voice():
-        nonlocal voice_filename
-        voice_filename = text_to_speech(reply, lang)
-    
-    voice_thread = threading.Thread(target=generate_voice)
-    voice_thread.start()
-    voice_thread.join(timeout=10)
-    
-    voice_url = f"/voices/{voice_filename}" if voice_filename else None
+    with timer.stage("encode"):
+        stored["data_url"] = image_store.data_url(stored)
 
-    save_chat_message(
-        session_id=session['current_session_id'],
-        message_type="image",
-        message_text=f"Image: {image.filename}",
-        response_text=reply,
-        image_filename=filename,
-        voice_filename=voice_filename,
-        language=lang
-    )
+    prompt = image_prompt(lang)
 
-    return jsonify({
+    try:
+        with timer.stage("llm"), llm_gate.admit():
+            reply = generate_reply(prompt, lang, image=stored, session_id=session['current_session_id'])
+    except admission.Busy as e:
+        return busy_response(e, lang)
+
+    with timer.stage("save"):
+        message_id = save_chat_message(
+            session_id=session['current_session_id'],
+            message_type="image",
+            message_text=f"Image: {image.filename}",
+            response_text=reply,
+            image_filename=stored["filename"],
+            language=lang
+        )
+    conversation.update(session['current_session_id'])
+
+    image_store.record(timer)
+    if not storage_gc.run_async:
+        # Without the sweeper thread, reclaim a batch per upload to keep /tmp bounded
+        storage_gc.kick()
+    logging.info(f"Upload {stored['filename']} (duplicate={stored['duplicate']}): {timer}")
+    response = jsonify({
         "reply": reply,
-        "voice": voice_url
+        "image": url_for("serve_upload", filename=stored["filename"]),
+        "thumbnail": url_for("serve_upload", filename=stored["thumbnail"]),
+        **queue_voice(reply, lang, session['user'], message_id)
     })
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(e):
+    return jsonify({"reply": error_message("image_too_large", request.args.get("lang", "en")), "voice": None}), 413
 
 @app.route("/delete_session/<int:session_id>", methods=["DELETE"])
 def delete_session(session_id):
@@ -550,6 +1073,9 @@ def delete_session(session_id):
         new_session_id, new_session_name = get_or_create_session(session['user'])
         session['current_session_id'] = new_session_id
         session['current_session_name'] = new_session_name
+    if success:
+        # The session's images and voices are unreferenced now
+        storage_gc.kick()
     
     return jsonify({"success": success})
 
@@ -563,11 +1089,7 @@ def rename_session(session_id):
         return jsonify({"success": False, "error": "Name cannot be empty"})
     
     try:
-        conn = sqlite3.connect(DB_PATH)
-        conn.execute("UPDATE chat_sessions SET session_name = ? WHERE id = ? AND username = ?", 
-                    (new_name, session_id, session['user']))
-        conn.commit()
-        conn.close()
+        db.rename_chat_session(session_id, session['user'], new_name)
         
         if session.get('current_session_id') == session_id:
             session['current_session_name'] = new_name
@@ -576,15 +1098,296 @@ def rename_session(session_id):
     except Exception as e:
         return jsonify({"success": False, "error": str(e)})
 
+@app.route("/export/history")
+def export_history():
+    """Download the user's chat history as NDJSON or CSV, zipped with its files if ``files=1``."""
+    if 'user' not in session:
+        return redirect(url_for('login'))
+    fmt = request.args.get("format", "ndjson")
+    if fmt not in chat_archive.FORMATS:
+        return jsonify({"success": False, "error": "format must be ndjson or csv"}), 400
+    with_files = request.args.get("files") == "1"
+    username = session['user']
+
+    def chunks():
+        # A connection of its own: the export reads for as long as the
+        # download takes and must not hold this thread's shared one
+        conn = db.connect()
+        try:
+            if with_files:
+                yield from chat_archive.bundle_chunks(conn, username, fmt, UPLOADS_DIR, VOICES_DIR)
+            else:
+                yield from chat_archive.export_chunks(conn, username, fmt)
+        finally:
+            conn.close()
+
+    stamp = datetime.datetime.now().strftime('%Y%m%d')
+    filename = f"krishi-history-{stamp}.{'zip' if with_files else fmt}"
+    return Response(
+        chunks(),
+        mimetype="application/zip" if with_files else chat_archive.FORMATS[fmt][1],
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"}
+    )
+
+@app.route("/import/history", methods=["POST"])
+def import_history():
+    """Add the sessions of an NDJSON or CSV export to the user's history.
+
+    Image and voice names are dropped (see chat_archive.py). Bundles with
+    files and exports larger than the upload limit are imported with
+    ``flask import-history``.
+    """
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    upload = request.files.get("file")
+    if upload is None:
+        return jsonify({"success": False, "error": "No file uploaded"}), 400
+    fmt = chat_archive.format_of(upload.filename)
+    if fmt not in chat_archive.FORMATS:
+        return jsonify({"success": False, "error": "Upload an .ndjson or .csv export"}), 400
+
+    stream = io.TextIOWrapper(upload.stream, encoding="utf-8", newline="")
+    try:
+        counts = chat_archive.import_records(db.get_connection(), chat_archive.read_records(stream, fmt),
+                                             username=session['user'], keep_files=False)
+    except (chat_archive.ArchiveError, UnicodeDecodeError) as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    return jsonify({"success": True, **counts})
+
+@app.route('/cache/stats')
+def cache_stats():
+    if response_cache is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **response_cache.stats()})
+
+@app.route('/voice_jobs/<job_id>')
+def voice_job_status(job_id):
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    job = voice_jobs.get(job_id, session['user'])
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown job"}), 404
+    return jsonify({"success": True, "status": job["status"], "voice": voice_url(job["voice_filename"])})
+
+@app.route('/voice_jobs/<job_id>/events')
+def voice_job_events(job_id):
+    """Server-Sent Events stream that emits one ``voice`` event when the job ends."""
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    username = session['user']
+    if voice_jobs.get(job_id, username) is None:
+        return jsonify({"success": False, "error": "Unknown job"}), 404
+
+    def events():
+        job = voice_jobs.wait(job_id, 60, username)
+        if job is None:
+            # The row went away while we waited (e.g. purged by retention)
+            yield sse_event("voice", {"status": "gone", "voice": None})
+            return
+        yield sse_event("voice", {"status": job["status"], "voice": voice_url(job["voice_filename"])})
+
+    return Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/voice_jobs/stats')
+def voice_job_stats():
+    return jsonify(voice_jobs.stats())
+
+@app.route('/email/stats')
+def email_stats():
+    return jsonify(outbox.stats())
+
+@app.route('/context/stats')
+def context_stats():
+    return jsonify(conversation.stats())
+
+@app.route('/admission/stats')
+def admission_stats():
+    return jsonify({"users": user_limiter.stats(), "llm": llm_gate.stats(), "tts": tts_gate.stats()})
+
+for gate in (llm_gate, tts_gate):
+    metrics.register_gauge(f"krishi_{gate.name}_in_flight", lambda gate=gate: gate.in_flight,
+                           f"{gate.name.upper()} calls holding an admission slot in this process.")
+    metrics.register_gauge(f"krishi_{gate.name}_waiting", lambda gate=gate: gate.waiting,
+                           f"Requests queued for a {gate.name.upper()} admission slot in this process.")
+
+@app.route('/local_answers/stats')
+def local_answers_stats():
+    if local_index is None:
+        return jsonify({"enabled": False})
+    return jsonify({"enabled": True, **local_index.stats()})
+
+@app.route('/llm/stats')
+def llm_stats():
+    return jsonify(model_router.stats())
+
+metrics.register_gauge("krishi_voice_queue_depth", lambda: voice_jobs.queue.qsize(),
+                       "Voice jobs waiting for a TTS worker in this process.")
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/storage/stats')
+def storage_stats():
+    return jsonify(storage_gc.stats())
+
+@app.route('/uploads/stats')
+def upload_stats():
+    return jsonify(image_store.stats())
+
 @app.route('/uploads/<filename>')
 def serve_upload(filename):
-    from flask import send_from_directory
-    return send_from_directory(UPLOADS_DIR, filename)
+    return upload_media.send(filename)
+
+@app.route('/media/stats')
+def media_stats():
+    return jsonify({"uploads": upload_media.stats(), "voices": voice_media.stats()})
+
+def regenerate_voice(filename):
+    """Recreate an evicted voice file from the chat message that references it.
+
+    Returns the filename that now holds the audio: the same one for
+    content-addressed files, a new one for legacy random names.
+    """
+    try:
+        row = db.find_voice_source(filename)
+    except Exception as e:
+        print("Error looking up voice file:", e)
+        return None
+    if not row or not row[0]:
+        return None
+    return text_to_speech_simple(row[0], row[1] or "en")
+
+@app.route('/voices/stream/<job_id>')
+def stream_voice(job_id):
+    """Play a reply's voice while it is still being synthesized.
+
+    Sends each sentence chunk as soon as its file appears, as one continuous
+    audio/mpeg body. Once the job is done the joined file is used instead.
+    """
+    if 'user' not in session:
+        return jsonify({"success": False, "error": "Not logged in"}), 401
+    username = session['user']
+    job = voice_jobs.get(job_id, username)
+    if job is None:
+        return jsonify({"success": False, "error": "Unknown job"}), 404
+    if job["voice_filename"]:
+        return redirect(voice_url(job["voice_filename"]))
+
+    row = db.get_voice_job_text(job_id)
+    if not row:
+        return jsonify({"success": False, "error": "Unknown job"}), 404
+
+    text, lang_code, slow = tts_params(row[0], row[1] or "en")
+    filenames = tts_cache.chunk_filenames(text, lang_code, slow)
+
+    def chunks():
+        for filename in filenames:
+            filepath = os.path.join(VOICES_DIR, filename)
+            deadline = time.monotonic() + VOICE_WAIT_SECONDS
+            while not os.path.exists(filepath):
+                job = voice_jobs.get(job_id)
+                # A job row purged meanwhile will never produce the file either
+                if time.monotonic() > deadline or job is None or job["status"] in ("failed", "dropped"):
+                    return
+                time.sleep(0.1)
+            with open(filepath, "rb") as f:
+                yield f.read()
+
+    return Response(chunks(), mimetype="audio/mpeg", headers={"Cache-Control": "no-cache"})
 
 @app.route('/voices/<filename>')
 def serve_voice(filename):
-    from flask import send_from_directory
-    return send_from_directory(VOICES_DIR, filename)
+    if not voice_media.exists(filename):
+        try:
+            regenerated = regenerate_voice(filename)
+        except admission.Busy as e:
+            return busy_response(e, request.args.get("lang", "en"))
+        if regenerated and regenerated != filename:
+            # Legacy random names come back under a new name; point the
+            # client there rather than caching other bytes under this URL
+            return redirect(voice_url(regenerated))
+    else:
+        tts_cache.touch(filename)
+    return voice_media.send(filename)
+
+# ---------------- CLI ----------------
+
+@app.cli.command("storage-gc")
+@click.option("--dry-run", is_flag=True, help="Only report what would be reclaimed.")
+def storage_gc_command(dry_run):
+    """Sweep unreferenced uploads and voices and apply retention quotas."""
+    report = storage_gc.collect(dry_run=dry_run)
+    verb = "Reclaimable" if dry_run else "Reclaimed"
+    for kind in ("uploads", "voices", "temp"):
+        click.echo(f"{kind:<8} {report[kind]['files']:>6} files  {report[kind]['bytes'] / 1e6:>9.2f} MB")
+    click.echo(f"images expired by quota: {report['images_expired']}")
+    for table, count in report["rows"].items():
+        click.echo(f"{table} rows {'to purge' if dry_run else 'purged'}: {count}")
+    click.echo(f"{verb}: {report['reclaimable_bytes'] / 1e6:.2f} MB")
+
+@app.cli.command("db-snapshot")
+@click.argument("path", default="krishi.snapshot.db")
+def db_snapshot_command(path):
+    """Write an empty database with the current schema for DB_SNAPSHOT."""
+    version = db.build_snapshot(path)
+    if local_index is not None:
+        # The knowledge base goes into the snapshot as well, so a fresh
+        # instance doesn't index it on its first question
+        conn = db.connect(path)
+        try:
+            LocalAnswers(lambda: conn).load_knowledge()
+        finally:
+            conn.close()
+    click.echo(f"Wrote {path} (schema version {version})")
+
+@app.cli.command("local-index")
+@click.option("--force", is_flag=True, help="Reindex the knowledge base even if it looks current.")
+def local_index_command(force):
+    """Index the knowledge base and harvest frequently asked questions."""
+    if local_index is None:
+        raise click.ClickException("LOCAL_ANSWERS_ENABLED is 0")
+    loaded = local_index.load_knowledge(force=force)
+    click.echo(f"knowledge base: {'unchanged' if loaded is None else f'{loaded} entries'}")
+    harvested = local_index.harvest(force=True)
+    click.echo(f"chat history: {'off' if harvested is None else f'{harvested} entries'}")
+
+@app.cli.command("export-history")
+@click.argument("output", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option("--user", help="Only this user's sessions (default: everyone's).")
+@click.option("--format", "fmt", type=click.Choice(sorted(chat_archive.FORMATS)), default="ndjson", show_default=True)
+@click.option("--with-files", is_flag=True, help="Write a zip with the referenced uploads and voices.")
+def export_history_command(output, user, fmt, with_files):
+    """Stream chat history to OUTPUT ("-" for stdout)."""
+    conn = db.connect()
+    try:
+        if with_files:
+            chunks = chat_archive.bundle_chunks(conn, user, fmt, UPLOADS_DIR, VOICES_DIR)
+        else:
+            chunks = chat_archive.export_chunks(conn, user, fmt)
+        with click.open_file(output, "wb") as out:
+            for chunk in chunks:
+                out.write(chunk)
+    finally:
+        conn.close()
+
+@app.cli.command("import-history")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--user", help="Import every session as this user instead of its recorded owner.")
+@click.option("--batch-rows", type=int, default=chat_archive.IMPORT_BATCH_ROWS, show_default=True,
+              help="Messages inserted per transaction.")
+def import_history_command(path, user, batch_rows):
+    """Load an .ndjson, .csv or .zip history export."""
+    try:
+        counts = chat_archive.import_file(db.get_connection(), path, UPLOADS_DIR, VOICES_DIR,
+                                          username=user, batch_rows=batch_rows)
+    except chat_archive.ArchiveError as e:
+        raise click.ClickException(str(e))
+    click.echo(", ".join(f"{count} {kind}" for kind, count in counts.items()))
 
 # ---------------- RUN APP ----------------
 if __name__ == "__main__":
@@ -0,0 +1,524 @@
+"""ASGI entry point: the chat pipeline on asyncio, everything else on Flask.
+
+    uvicorn asgi:app --workers 1
+
+/chat, /chat/stream, /chat/batch and /upload are handled natively. Their OpenRouter
+calls are awaited on a shared httpx connection pool, so one worker can keep
+hundreds of them in flight instead of one per thread. SQLite access, image
+processing and TTS stay synchronous and run on the thread pools below,
+never on the event loop. Every other route, the templates and the session
+cookie are served by the Flask app through a WSGI bridge on its own pool,
+so both modes behave the same and ``gunicorn app:app`` keeps working.
+
+    ASGI_DB_THREADS     threads for database calls (default 8)
+    ASGI_WORK_THREADS   threads for image processing and TTS (default 4)
+    ASGI_FLASK_THREADS  threads serving the remaining Flask routes (default 32)
+"""
+import asyncio
+import contextvars
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+from asgiref.wsgi import WsgiToAsgiInstance
+from werkzeug.wrappers import Request
+
+import admission
+import app as krishi
+import chat_batch
+import llm_client
+import metrics
+from tts_jobs import FINISHED
+from uploads import StageTimer, UploadRejected
+
+DB_THREADS = int(os.getenv("ASGI_DB_THREADS", "8"))
+WORK_THREADS = int(os.getenv("ASGI_WORK_THREADS", "4"))
+FLASK_THREADS = int(os.getenv("ASGI_FLASK_THREADS", "32"))
+
+# Seconds between voice job polls while /chat/stream waits for the mp3
+VOICE_POLL_SECONDS = 0.25
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+db_pool = ThreadPoolExecutor(DB_THREADS, thread_name_prefix="asgi-db")
+work_pool = ThreadPoolExecutor(WORK_THREADS, thread_name_prefix="asgi-work")
+flask_pool = ThreadPoolExecutor(FLASK_THREADS, thread_name_prefix="asgi-flask")
+
+
+async def run_in(pool, func, *args, **kwargs):
+    """Run a blocking call on ``pool``, keeping this request's metrics context."""
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(pool, call)
+
+
+def in_db(func, *args, **kwargs):
+    return run_in(db_pool, func, *args, **kwargs)
+
+
+def in_work(func, *args, **kwargs):
+    return run_in(work_pool, func, *args, **kwargs)
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class ClientGone(Exception):
+    pass
+
+
+async def read_body(receive, limit=None):
+    """Spool the request body to a temporary file, refusing more than ``limit`` bytes."""
+    body = SpooledTemporaryFile(max_size=65536)
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            body.close()
+            raise ClientGone()
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if limit is not None and size > limit:
+            body.close()
+            raise BodyTooLarge()
+        body.write(chunk)
+        if not message.get("more_body"):
+            break
+    body.seek(0)
+    return body
+
+
+class FlaskBridge(WsgiToAsgiInstance):
+    """Serve one request of the Flask app on ``flask_pool``.
+
+    The stock WsgiToAsgi runs the app through a thread-sensitive
+    sync_to_async, which puts every WSGI call of the process on one shared
+    thread. Here requests run in parallel like gunicorn threads, and the
+    response iterable is closed so Flask tears down streamed responses.
+    """
+
+    async def __call__(self, scope, receive, send):
+        self.scope = scope
+        loop = asyncio.get_running_loop()
+        self.sync_send = lambda message: asyncio.run_coroutine_threadsafe(send(message), loop).result()
+        try:
+            body = await read_body(receive)
+        except ClientGone:
+            return
+        with body:
+            await run_in(flask_pool, self.run_wsgi_app, body)
+
+    def run_wsgi_app(self, body):
+        environ = self.build_environ(self.scope, body)
+        output = self.wsgi_application(environ, self.start_response)
+        try:
+            for chunk in output:
+                if not self.response_started:
+                    self.response_started = True
+                    self.sync_send(self.response_start)
+                if chunk:
+                    self.sync_send({"type": "http.response.body", "body": chunk, "more_body": True})
+        finally:
+            if hasattr(output, "close"):
+                output.close()
+        if not self.response_started:
+            self.response_started = True
+            self.sync_send(self.response_start)
+        self.sync_send({"type": "http.response.body"})
+
+
+class Exchange:
+    """One natively handled request: the parsed request, its session and the reply channel."""
+
+    def __init__(self, scope, body, send, record):
+        bridge = WsgiToAsgiInstance(None)
+        bridge.scope = scope
+        self.environ = bridge.build_environ(scope, body)
+        self.request = Request(self.environ)
+        self.session = krishi.app.session_interface.open_session(krishi.app, self.request) or {}
+        self.send = send
+        self.record = record
+
+    @property
+    def lang(self):
+        return self.request.form.get("lang", "en")
+
+    def url_for(self, endpoint, **values):
+        return krishi.app.url_map.bind_to_environ(self.environ).build(endpoint, values)
+
+    async def start(self, status, content_type, headers=None):
+        self.record["status"] = status
+        headers = {"Content-Type": content_type, **(headers or {})}
+        timing = metrics.timing_header(self.record)
+        if timing:
+            existing = headers.get("Server-Timing")
+            headers["Server-Timing"] = f"{existing}, {timing}" if existing else timing
+        await self.send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in headers.items()]
+        })
+
+    async def write(self, data, more=True):
+        await self.send({"type": "http.response.body", "body": data, "more_body": more})
+
+    async def json(self, payload, status=200, headers=None):
+        await self.start(status, "application/json", headers)
+        await self.write(f"{krishi.app.json.dumps(payload)}\n".encode("utf-8"), more=False)
+
+
+# ---------------- REPLIES ----------------
+# Async twins of generate_reply(), request_reply() and generate_reply_stream()
+# in app.py; the prompt building, caching rules and parsing are shared.
+
+async def request_reply(prompt, lang="en", image_url=None, context=None):
+    """Get AI-generated response from OpenRouter model."""
+    if not krishi.OPENROUTER_API_KEY:
+        return krishi.error_message("not_configured", lang)
+
+    headers, data = krishi.openrouter_request(prompt, image_url=image_url, context=context)
+    try:
+        with metrics.stage("openrouter"):
+            r = await krishi.model_router.apost(krishi.OPENROUTER_URL, headers=headers, json=data)
+        if r.status_code == 200:
+            return krishi.reply_text(r.json())
+        logging.error(f"OpenRouter API Error: {r.status_code} - {r.text}")
+        return krishi.error_message("service", lang)
+    except llm_client.CircuitOpenError:
+        return krishi.error_message("service", lang)
+    except Exception as e:
+        logging.error(f"Request Error: {e!r}")
+        return krishi.error_message("network", lang)
+
+
+async def generate_reply(prompt, lang="en", image=None, session_id=None):
+    """Get AI-generated response, served from the reply cache when possible."""
+    with metrics.stage("generate_reply"):
+        context = await in_db(krishi.reply_context, session_id, prompt)
+        if image is None:
+            local = await in_db(krishi.local_reply, prompt, lang, context)
+            if local is not None:
+                return local
+        cache = krishi.response_cache
+        use_cache = cache is not None and not context
+        cache_prompt = krishi.cache_prompt_for(prompt, image)
+        if use_cache:
+            cached = await in_db(cache.get, cache_prompt, lang)
+            if cached is not None:
+                return cached
+
+        reply = await request_reply(prompt, lang, image_url=image["data_url"] if image else None, context=context)
+        if krishi.is_fallback_reply(reply):
+            return reply if image is not None else await in_db(krishi.offline_reply, prompt, lang, reply)
+        if use_cache:
+            await in_db(cache.put, cache_prompt, lang, reply)
+        return reply
+
+
+async def generate_reply_stream(prompt, lang="en", session_id=None):
+    """Yield the OpenRouter reply piece by piece as tokens arrive."""
+    context = await in_db(krishi.reply_context, session_id, prompt)
+    local = await in_db(krishi.local_reply, prompt, lang, context)
+    if local is not None:
+        yield local
+        return
+    cache = krishi.response_cache
+    use_cache = cache is not None and not context
+    if use_cache:
+        cached = await in_db(cache.get, prompt, lang)
+        if cached is not None:
+            yield cached
+            return
+
+    if not krishi.OPENROUTER_API_KEY:
+        yield await in_db(krishi.offline_reply, prompt, lang, krishi.error_message("not_configured", lang))
+        return
+
+    headers, data = krishi.openrouter_request(prompt, stream=True, context=context)
+    produced = False
+    parts = []
+    try:
+        r = await krishi.model_router.apost(krishi.OPENROUTER_URL, headers=headers, json=data, stream=True)
+        try:
+            if r.status_code != 200:
+                await r.aread()
+                logging.error(f"OpenRouter API Error: {r.status_code} - {r.text}")
+                yield await in_db(krishi.offline_reply, prompt, lang, krishi.error_message("service", lang))
+                return
+            async for line in r.aiter_lines():
+                finished, piece = krishi.stream_piece(line)
+                if finished:
+                    break
+                if piece:
+                    produced = True
+                    parts.append(piece)
+                    yield piece
+        finally:
+            await r.aclose()
+    except llm_client.CircuitOpenError:
+        yield await in_db(krishi.offline_reply, prompt, lang, krishi.error_message("service", lang))
+        return
+    except Exception as e:
+        logging.error(f"Stream Request Error: {e!r}")
+        if not produced:
+            yield await in_db(krishi.offline_reply, prompt, lang, krishi.error_message("network", lang))
+        return
+
+    if not produced:
+        yield await in_db(krishi.offline_reply, prompt, lang, krishi.EMPTY_REPLY)
+    elif use_cache:
+        await in_db(cache.put, prompt, lang, krishi.clean_text("".join(parts)))
+
+
+async def wait_for_voice(job_id, timeout):
+    """Poll a voice job without holding a thread; returns the job row."""
+    deadline = time.monotonic() + timeout
+    while True:
+        job = await in_db(krishi.voice_jobs.get, job_id)
+        if job is None or job["status"] in FINISHED or time.monotonic() >= deadline:
+            return job
+        await asyncio.sleep(VOICE_POLL_SECONDS)
+
+
+def save_message(session_id, message_type, message_text, reply, lang, image_filename=None):
+    message_id = krishi.save_chat_message(
+        session_id=session_id,
+        message_type=message_type,
+        message_text=message_text,
+        response_text=reply,
+        image_filename=image_filename,
+        language=lang
+    )
+    krishi.conversation.update(session_id)
+    return message_id
+
+
+# ---------------- ROUTES ----------------
+# Same requests and responses as the Flask views of the same name.
+
+def logged_in(exchange):
+    return 'user' in exchange.session and 'current_session_id' in exchange.session
+
+
+async def busy(exchange, e, lang):
+    payload, headers = krishi.busy_reply(e, lang)
+    await exchange.json(payload, e.status, headers)
+
+
+async def chat(exchange):
+    if not logged_in(exchange):
+        return await exchange.json({"reply": "Please login first.", "voice": None})
+
+    user_message = exchange.request.form.get("message", "").strip()
+    lang = exchange.lang
+    if not user_message:
+        return await exchange.json({"reply": "ದಯವಿಟ್ಟು ಸಂದೇಶವನ್ನು ನಮೂದಿಸಿ.", "voice": None})
+
+    session_id = exchange.session['current_session_id']
+    try:
+        krishi.user_limiter.check(exchange.session['user'])
+        with await krishi.llm_gate.aadmit():
+            reply = await generate_reply(user_message, lang, session_id=session_id)
+    except admission.Busy as e:
+        return await busy(exchange, e, lang)
+    message_id = await in_db(save_message, session_id, "text", user_message, reply, lang)
+    voice = await in_work(krishi.queue_voice, reply, lang, exchange.session['user'], message_id)
+    await exchange.json({"reply": reply, **voice})
+
+
+async def chat_stream(exchange):
+    if not logged_in(exchange):
+        return await exchange.json({"reply": "Please login first.", "voice": None}, 401)
+
+    user_message = exchange.request.form.get("message", "").strip()
+    lang = exchange.lang
+    if not user_message:
+        return await exchange.json({"reply": "ದಯವಿಟ್ಟು ಸಂದೇಶವನ್ನು ನಮೂದಿಸಿ.", "voice": None}, 400)
+
+    session_id = exchange.session['current_session_id']
+    username = exchange.session['user']
+    try:
+        krishi.user_limiter.check(username)
+        ticket = await krishi.llm_gate.aadmit()
+    except admission.Busy as e:
+        return await busy(exchange, e, lang)
+
+    async def event(name, data):
+        await exchange.write(krishi.sse_event(name, data).encode("utf-8"))
+
+    parts = []
+    with ticket:
+        await exchange.start(200, "text/event-stream; charset=utf-8", SSE_HEADERS)
+        with metrics.stage("generate_reply_stream"):
+            async for piece in generate_reply_stream(user_message, lang, session_id=session_id):
+                parts.append(piece)
+                await event("token", {"text": piece})
+
+    reply = krishi.clean_text("".join(parts)) or krishi.EMPTY_REPLY
+    message_id = await in_db(save_message, session_id, "text", user_message, reply, lang)
+    await event("reply", {"reply": reply})
+
+    voice = await in_work(krishi.queue_voice, reply, lang, username, message_id)
+    if not voice["voice"] and not voice["voice_stream"]:
+        job = await wait_for_voice(voice["voice_job"], krishi.VOICE_WAIT_SECONDS)
+        voice["voice"] = krishi.voice_url(job and job["voice_filename"])
+    await event("voice", voice)
+    await event("done", {})
+    await exchange.write(b"", more=False)
+
+
+async def chat_batch_route(exchange):
+    if 'user' not in exchange.session:
+        return await exchange.json({"error": "Please login first."}, 401)
+
+    username = exchange.session['user']
+    payload = exchange.request.get_json(silent=True)
+    try:
+        questions = chat_batch.parse(payload)
+        session_id = await in_db(krishi.batch_session, username, payload)
+        krishi.user_limiter.check(username)
+    except chat_batch.BatchRejected as e:
+        return await exchange.json({"error": str(e)}, 400)
+    except admission.Busy as e:
+        return await busy(exchange, e, payload.get("lang") or "en")
+
+    async def answer(question):
+        try:
+            with await krishi.llm_gate.aadmit():
+                return {"reply": await generate_reply(question.message, question.lang)}
+        except admission.Busy as e:
+            return krishi.batch_busy(e, question.lang)
+
+    await exchange.start(200, "application/x-ndjson", SSE_HEADERS)
+    answered = []
+    async for question, result in chat_batch.aanswer_all(questions, answer):
+        if "error" not in result:
+            answered.append((question, result["reply"]))
+        await exchange.write(chat_batch.ndjson({"event": "reply", "items": question.indexes,
+                                                "lang": question.lang, **result}))
+
+    saved_session, saved, first_ids = await in_db(krishi.save_batch, username, session_id, answered)
+    for question, reply in answered:
+        if question.voice:
+            voice = await in_work(krishi.queue_voice, reply, question.lang, username, first_ids[question])
+            await exchange.write(chat_batch.ndjson({"event": "voice", "items": question.indexes, **voice}))
+    await exchange.write(chat_batch.ndjson({"event": "done", "session_id": saved_session, "saved": saved,
+                                            "questions": len(questions), "items": len(payload["items"])}),
+                         more=False)
+
+
+def parse_upload(request):
+    image = request.files.get("image")
+    return image, request.form.get("lang", "en")
+
+
+async def upload_image(exchange):
+    if not logged_in(exchange):
+        return await exchange.json({"reply": "Please login first.", "voice": None})
+
+    # Multipart parsing spools the file to disk, so keep it off the loop
+    image, lang = await in_work(parse_upload, exchange.request)
+    if not image:
+        return await exchange.json({"reply": "ದಯವಿಟ್ಟು ಚಿತ್ರವನ್ನು ಅಪ್‌ಲೋಡ್ ಮಾಡಿ.", "voice": None})
+
+    try:
+        krishi.user_limiter.check(exchange.session['user'])
+    except admission.Busy as e:
+        return await busy(exchange, e, lang)
+
+    store = krishi.image_store
+    timer = StageTimer()
+    try:
+        stored = await in_work(store.ingest, image.stream, timer)
+    except UploadRejected as e:
+        logging.warning(f"Upload {image.filename!r} rejected: {e}")
+        kind = "image_too_large" if e.reason == "too_large" else "image_invalid"
+        return await exchange.json({"reply": krishi.error_message(kind, lang), "voice": None},
+                                   413 if e.reason == "too_large" else 400)
+
+    with timer.stage("encode"):
+        stored["data_url"] = await in_work(store.data_url, stored)
+
+    session_id = exchange.session['current_session_id']
+    try:
+        with timer.stage("llm"), await krishi.llm_gate.aadmit():
+            reply = await generate_reply(krishi.image_prompt(lang), lang, image=stored, session_id=session_id)
+    except admission.Busy as e:
+        return await busy(exchange, e, lang)
+
+    with timer.stage("save"):
+        message_id = await in_db(save_message, session_id, "image", f"Image: {image.filename}", reply, lang,
+                                 image_filename=stored["filename"])
+
+    store.record(timer)
+    if not krishi.storage_gc.run_async:
+        await in_db(krishi.storage_gc.kick)
+    logging.info(f"Upload {stored['filename']} (duplicate={stored['duplicate']}): {timer}")
+    voice = await in_work(krishi.queue_voice, reply, lang, exchange.session['user'], message_id)
+    await exchange.json({
+        "reply": reply,
+        "image": exchange.url_for("serve_upload", filename=stored["filename"]),
+        "thumbnail": exchange.url_for("serve_upload", filename=stored["thumbnail"]),
+        **voice
+    }, headers={"Server-Timing": timer.server_timing()})
+
+
+class KrishiASGI:
+    """Dispatch the chat routes to the async handlers and the rest to Flask."""
+
+    routes = {
+        ("POST", "/chat"): chat,
+        ("POST", "/chat/stream"): chat_stream,
+        ("POST", "/chat/batch"): chat_batch_route,
+        ("POST", "/upload"): upload_image,
+    }
+
+    def __init__(self, flask_app):
+        self.flask_app = flask_app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return
+
+        path = scope["path"]
+        root = scope.get("root_path", "")
+        if root and path.startswith(root):
+            path = path[len(root):]
+        handler = self.routes.get((scope["method"], path))
+        if handler is None:
+            return await FlaskBridge(self.flask_app)(scope, receive, send)
+
+        krishi.storage_gc.start()
+        limit = self.flask_app.config["MAX_CONTENT_LENGTH"]
+        with metrics.track_request(path, scope["method"]) as record:
+            try:
+                body = await read_body(receive, limit)
+            except ClientGone:
+                return
+            except BodyTooLarge:
+                record["status"] = 413
+                exchange = Exchange(scope, None, send, record)
+                lang = exchange.request.args.get("lang", "en")
+                return await exchange.json({"reply": krishi.error_message("image_too_large", lang), "voice": None}, 413)
+            with body:
+                await handler(Exchange(scope, body, send, record))
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await llm_client.close_async_client()
+                for pool in (db_pool, work_pool, flask_pool):
+                    pool.shutdown(wait=False)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+
+app = KrishiASGI(krishi.app)
@@ -0,0 +1,7 @@
+"""ASGI entry point for benchmarks: asgi.py with gTTS sent to the stub.
+
+    uvicorn --app-dir benchmarks asgi_stubbed:app
+"""
+import wsgi_stubbed  # noqa: F401  (points gTTS at STUB_TTS_URL)
+
+from asgi import app  # noqa: E402
@@ -0,0 +1,141 @@
+"""Compare how many chat requests one worker keeps in flight, sync vs ASGI.
+
+Starts the OpenRouter/TTS/SMTP stubs with a slow model, then serves the app
+twice from throwaway directories: with one gunicorn worker (the sync app,
+``--threads`` threads) and with one uvicorn worker (asgi.py). For each,
+``--concurrency`` logged-in users send /chat messages back to back for
+``--duration`` seconds. With a model that takes L seconds to answer, a
+worker that can hold N calls in flight completes about N / L requests per
+second, so the reported throughput times the latency is its capacity:
+
+    python benchmarks/bench_async.py --concurrency 200 --llm-latency-ms 2000
+    python benchmarks/bench_async.py --mode asgi --stream
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from load_test import BENCH_DIR, REPO_ROOT, Recorder, free_port, start_server
+from stubs import Latency, start_stubs
+
+
+def start_uvicorn(workdir, env):
+    port = free_port()
+    command = [sys.executable, "-m", "uvicorn", "--workers", "1", "--port", str(port),
+               "--host", "127.0.0.1", "--no-access-log", "--log-level", "warning",
+               "--app-dir", BENCH_DIR, "asgi_stubbed:app"]
+    env = dict(env, PYTHONPATH=os.pathsep.join([REPO_ROOT, BENCH_DIR, env.get("PYTHONPATH", "")]))
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen(command, env=env, cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited, see {workdir}/server.log")
+        try:
+            requests.get(base_url + "/", timeout=2)
+            return server, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit(f"Server did not start, see {workdir}/server.log")
+
+
+def log_in(index, base_url, smtp):
+    """Register, verify and log in one user; returns its requests.Session or None."""
+    http = requests.Session()
+    email = f"grower{index}@example.com"
+    http.post(f"{base_url}/register", data={"email": email, "username": f"grower{index}", "password": "bench"},
+              allow_redirects=False, timeout=60)
+    code = smtp.wait_for_code(email, timeout=60)
+    if code is None:
+        return None
+    http.post(f"{base_url}/verify-email", data={"verification_code": code}, allow_redirects=False, timeout=60)
+    http.post(f"{base_url}/login", data={"email": email, "password": "bench"}, allow_redirects=False, timeout=60)
+    # /index picks the current chat session
+    http.get(f"{base_url}/index", timeout=60)
+    return http
+
+
+def run_mode(mode, args, stubs, env):
+    llm, tts, smtp = stubs
+    workdir = tempfile.mkdtemp(prefix=f"krishi-{mode}-")
+    if mode == "sync":
+        server_args = argparse.Namespace(workers=1, threads=args.threads, app="wsgi_stubbed:app")
+        server, base_url = start_server(server_args, workdir, env)
+        label = f"sync  (gunicorn, 1 worker x {args.threads} threads)"
+    else:
+        server, base_url = start_uvicorn(workdir, env)
+        label = "asgi  (uvicorn, 1 worker)"
+
+    route = "/chat/stream" if args.stream else "/chat"
+    recorder = Recorder()
+    try:
+        with ThreadPoolExecutor(min(args.concurrency, 32)) as pool:
+            sessions = [s for s in pool.map(lambda i: log_in(i, base_url, smtp), range(args.concurrency)) if s]
+
+        llm_before = llm.requests
+        deadline = time.monotonic() + args.duration
+
+        def user(http, index):
+            while time.monotonic() < deadline:
+                recorder.call(f"POST {route}", lambda: http.post(
+                    base_url + route, data={"message": f"question {index} {time.monotonic()}", "lang": "en"},
+                    stream=args.stream, timeout=300))
+
+        started = time.monotonic()
+        users = [threading.Thread(target=user, args=(http, i), daemon=True) for i, http in enumerate(sessions)]
+        for thread in users:
+            thread.start()
+        for thread in users:
+            thread.join()
+        elapsed = time.monotonic() - started
+    finally:
+        server.terminate()
+        server.wait()
+
+    stats = recorder.report(elapsed).get(f"POST {route}", {"count": 0, "errors": 0, "p50": 0, "p95": 0, "rps": 0})
+    capacity = stats["rps"] * args.llm_latency_ms / 1000
+    print(f"{label}: {len(sessions)} users, {stats['count']} requests ({stats['errors']} errors), "
+          f"{stats['rps']:.1f} req/s, p50 {stats['p50']:.0f} ms, p95 {stats['p95']:.0f} ms, "
+          f"~{capacity:.0f} LLM calls in flight; {llm.requests - llm_before} stub calls")
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=("both", "sync", "asgi"), default="both")
+    parser.add_argument("--concurrency", type=int, default=200, help="users sending at the same time")
+    parser.add_argument("--duration", type=float, default=20, help="seconds of sending per mode")
+    parser.add_argument("--threads", type=int, default=8, help="gunicorn threads of the sync worker")
+    parser.add_argument("--llm-latency-ms", type=float, default=2000)
+    parser.add_argument("--stream", action="store_true", help="use /chat/stream instead of /chat")
+    args = parser.parse_args()
+
+    stubs = start_stubs(Latency(args.llm_latency_ms, 0.1), Latency(50, 0.1), Latency(0))
+    llm, tts, smtp = stubs
+    env = dict(os.environ,
+               OPENROUTER_API_KEY="stub", OPENROUTER_URL=f"{llm.url}/",
+               STUB_TTS_URL=tts.url, REPLY_CACHE_ENABLED="0", LOCAL_ANSWERS_ENABLED="0",
+               EMAIL_ADDRESS="bench@example.com", EMAIL_PASSWORD="stub", EMAIL_RATE_PER_MINUTE="0",
+               USER_RATE_PER_MINUTE="0", LLM_CONCURRENCY=str(args.concurrency),
+               SMTP_SERVER="127.0.0.1", SMTP_PORT=str(smtp.server_address[1]), SMTP_STARTTLS="0",
+               FLASK_SECRET_KEY="bench-async", NO_PROXY="127.0.0.1,localhost")
+
+    results = {}
+    for mode in (("sync", "asgi") if args.mode == "both" else (args.mode,)):
+        results[mode] = run_mode(mode, args, stubs, env)
+    if len(results) == 2 and results["sync"]["rps"]:
+        print(f"ASGI completes {results['asgi']['rps'] / results['sync']['rps']:.1f}x the requests per worker")
+
+
+if __name__ == "__main__":
+    main()
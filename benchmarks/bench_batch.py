@@ -0,0 +1,83 @@
+"""Compare submitting questions one /chat at a time with one /chat/batch.
+
+Starts the OpenRouter and TTS stubs (see stubs.py), imports the app in a
+throwaway directory and, through Flask's test client, sends the same list
+of questions (with some repeated, the way officers' notebooks have them)
+first as sequential /chat requests and then as a single /chat/batch, at a
+few parallelism limits. Reported are the wall time, the LLM calls the stub
+saw and the time until the first NDJSON line:
+
+    python benchmarks/bench_batch.py --questions 40 --llm-latency-ms 800
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+from bench_index import REPO_ROOT
+from stubs import Latency, start_stubs
+
+
+def questions(count, repeat_every):
+    """``count`` questions, every ``repeat_every``-th one a repeat of an earlier one."""
+    items = []
+    for i in range(count):
+        if repeat_every and i % repeat_every == repeat_every - 1:
+            items.append(items[i // 2])
+        else:
+            items.append({"message": f"question {i} about pests on field {i}", "lang": "en"})
+    return items
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=40)
+    parser.add_argument("--repeat-every", type=int, default=4, help="every n-th question repeats an earlier one")
+    parser.add_argument("--parallelism", type=int, nargs="+", default=[1, 4, 8])
+    parser.add_argument("--llm-latency-ms", type=float, default=800)
+    args = parser.parse_args()
+
+    llm, tts, _ = start_stubs(Latency(args.llm_latency_ms, 0.1), Latency(50, 0.1), Latency(0))
+    os.environ.update(OPENROUTER_API_KEY="stub", OPENROUTER_URL=f"{llm.url}/", STUB_TTS_URL=tts.url,
+                      REPLY_CACHE_ENABLED="0", LOCAL_ANSWERS_ENABLED="0", USER_RATE_PER_MINUTE="0",
+                      FLASK_SECRET_KEY="bench-batch", NO_PROXY="127.0.0.1,localhost", METRICS_ENABLED="0")
+    os.chdir(tempfile.mkdtemp(prefix="krishi-bench-"))
+    sys.path.insert(0, REPO_ROOT)
+    import app as krishi
+    import chat_batch
+    import db
+
+    client = krishi.app.test_client()
+    session_id, _ = db.get_or_create_session("officer1")
+    with client.session_transaction() as s:
+        s["user"] = "officer1"
+        s["current_session_id"] = session_id
+    items = questions(args.questions, args.repeat_every)
+    print(f"{len(items)} questions, stub LLM {args.llm_latency_ms:.0f} ms")
+
+    calls_before = llm.requests
+    started = time.perf_counter()
+    for item in items:
+        assert client.post("/chat", data=item).status_code == 200
+    print(f"  sequential /chat     {time.perf_counter() - started:7.2f} s  LLM calls {llm.requests - calls_before}")
+
+    for parallelism in args.parallelism:
+        chat_batch.PARALLELISM = parallelism
+        calls_before = llm.requests
+        started = time.perf_counter()
+        response = client.post("/chat/batch", json={"items": items}, buffered=False)
+        first = None
+        lines = []
+        for chunk in response.iter_encoded():
+            first = first or time.perf_counter()
+            lines.extend(json.loads(line) for line in chunk.decode("utf-8").splitlines() if line)
+        elapsed = time.perf_counter() - started
+        done = lines[-1]
+        print(f"  /chat/batch x{parallelism:<3}    {elapsed:7.2f} s  LLM calls {llm.requests - calls_before}  "
+              f"first line {(first - started) * 1000:6.0f} ms  saved {done['saved']} in one transaction")
+
+
+if __name__ == "__main__":
+    main()
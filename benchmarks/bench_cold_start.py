@@ -0,0 +1,127 @@
+"""Measure a serverless cold start: import time and first bytes of / and /chat.
+
+Each run is a new Python process with VERCEL=1 and an empty directory
+standing in for /tmp, the way a fresh Vercel instance starts. It times
+``import app``, then the first GET / and the first POST /chat through
+Flask's test client, against the local OpenRouter and TTS stubs (see
+stubs.py). The runs are repeated with the database seeded from a snapshot
+(DB_SNAPSHOT) instead of built by the migrations, and the slowest imports
+of one run are listed so regressions can be traced to a module:
+
+    python benchmarks/bench_cold_start.py --runs 10
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from bench_index import REPO_ROOT
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def cold_start():
+    """Child process: one cold start, printed as JSON on the last line."""
+    started = time.perf_counter()
+    sys.path.insert(0, REPO_ROOT)
+    import app as krishi
+    imported = time.perf_counter()
+
+    client = krishi.app.test_client()
+    landing = client.get("/")
+    first_landing = time.perf_counter()
+    assert landing.status_code == 200, landing.status_code
+
+    # gTTS has no setting for its host; patching it loads it, which the
+    # first /chat would do anyway, so it is timed as part of that request
+    import gtts.tts
+    stub_tts = os.environ["STUB_TTS_URL"].rstrip("/")
+    gtts.tts._translate_url = lambda tld="com", path="": f"{stub_tts}/{path}"
+
+    import db
+    session_id, _ = db.get_or_create_session("farmer1")
+    with client.session_transaction() as s:
+        s["user"] = "farmer1"
+        s["current_session_id"] = session_id
+    chat = client.post("/chat", data={"message": "How much urea per acre for paddy?", "lang": "en"})
+    first_chat = time.perf_counter()
+    assert chat.status_code == 200, chat.status_code
+
+    print(json.dumps({
+        "import": (imported - started) * 1000,
+        "/": (first_landing - imported) * 1000,
+        "/chat": (first_chat - first_landing) * 1000,
+        "total": (first_chat - started) * 1000,
+    }))
+
+
+def run_child(env, importtime=False):
+    with tempfile.TemporaryDirectory() as tmp:
+        command = [sys.executable] + (["-X", "importtime"] if importtime else []) + [__file__, "--child"]
+        result = subprocess.run(command, env=dict(env, SERVERLESS_TMP_DIR=tmp), cwd=tmp,
+                                capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"Cold start failed:\n{result.stderr[-4000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1]), result.stderr
+
+
+def slowest_imports(importtime_log, count):
+    """Top-level packages by cumulative import time from ``-X importtime``."""
+    packages = {}
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        package = name.strip().split(".")[0]
+        # Nested imports are indented; keep the outermost (largest) figure
+        packages[package] = max(packages.get(package, 0), int(cumulative))
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--llm-latency-ms", type=float, default=0)
+    parser.add_argument("--tts-latency-ms", type=float, default=0)
+    parser.add_argument("--top-imports", type=int, default=10)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        cold_start()
+        return
+
+    # Imported here so the child's import log only shows the app's own imports
+    from stubs import Latency, start_stubs
+
+    llm, tts, _ = start_stubs(Latency(args.llm_latency_ms), Latency(args.tts_latency_ms), Latency(0))
+    env = dict(os.environ, VERCEL="1", PYTHONPATH=os.pathsep.join([REPO_ROOT, BENCH_DIR]),
+               OPENROUTER_API_KEY="stub", OPENROUTER_URL=f"{llm.url}/", STUB_TTS_URL=tts.url,
+               FLASK_SECRET_KEY="cold-start", NO_PROXY="127.0.0.1,localhost", DB_SNAPSHOT="")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        sys.path.insert(0, REPO_ROOT)
+        import db
+        snapshot = os.path.join(tmp, "krishi.snapshot.db")
+        db.build_snapshot(snapshot)
+
+        print(f"{args.runs} cold starts each, stub LLM {args.llm_latency_ms:.0f} ms, TTS {args.tts_latency_ms:.0f} ms")
+        for label, extra in (("migrations", {}), ("snapshot", {"DB_SNAPSHOT": snapshot})):
+            runs = [run_child(dict(env, **extra))[0] for _ in range(args.runs)]
+            summary = "  ".join(f"{stage} {statistics.median(run[stage] for run in runs):7.1f} ms"
+                                for stage in ("import", "/", "/chat", "total"))
+            print(f"  {label:<11} median  {summary}")
+
+        _, log = run_child(dict(env, DB_SNAPSHOT=snapshot), importtime=True)
+    print("Slowest imports of one cold start (cumulative):")
+    for package, micros in slowest_imports(log, args.top_imports):
+        print(f"  {package:<24} {micros / 1000:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Measure chat history export and import at growing history sizes.
+
+Builds throwaway databases in a temporary directory with one user owning
+more and more messages, then streams that user's history to a file in each
+format and imports it into an empty database. Reported are the throughput
+and the peak Python memory (tracemalloc) of each step, next to loading the
+same history with get_chat_messages(), which the export replaces:
+
+    python benchmarks/bench_export.py --messages 10000 100000 1000000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from bench_index import REPO_ROOT, populate
+
+
+def measure(step):
+    """(seconds, peak bytes) of ``step()``, from two runs: tracemalloc slows the traced one down."""
+    started = time.perf_counter()
+    step()
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    try:
+        step()
+        return seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--sessions", type=int, default=200, help="sessions of the exported user")
+    parser.add_argument("--batch-rows", type=int, default=1000, help="messages per import transaction")
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    import chat_archive
+    import db
+
+    workdir = tempfile.mkdtemp(prefix="krishi-bench-")
+    print(f"{'messages':>10} {'step':<16} {'seconds':>8} {'msgs/s':>10} {'peak MB':>8}")
+    for messages in args.messages:
+        source_path = os.path.join(workdir, f"history-{messages}.db")
+        conn = db.connect(source_path)
+        db.migrate(conn)
+        populate(conn, 1, args.sessions, messages)
+
+        def load_all():
+            for session_id, *_ in db.get_chat_sessions("farmer0"):
+                db.get_chat_messages(session_id)
+
+        db.configure(source_path)
+        steps = [("get_chat_messages", load_all)]
+        for fmt in chat_archive.FORMATS:
+            path = os.path.join(workdir, f"history-{messages}.{fmt}")
+
+            def export(fmt=fmt, path=path):
+                with open(path, "wb") as out:
+                    for chunk in chat_archive.export_chunks(conn, "farmer0", fmt):
+                        out.write(chunk)
+
+            def load(fmt=fmt, path=path):
+                target_path = os.path.join(workdir, f"import-{messages}-{fmt}.db")
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(target_path + suffix):
+                        os.remove(target_path + suffix)
+                target = db.connect(target_path)
+                db.migrate(target)
+                try:
+                    chat_archive.import_file(target, path, workdir, workdir, batch_rows=args.batch_rows)
+                finally:
+                    target.close()
+
+            steps += [(f"export {fmt}", export), (f"import {fmt}", load)]
+
+        for name, step in steps:
+            seconds, peak = measure(step)
+            print(f"{messages:>10,} {name:<16} {seconds:>8.2f} {messages / seconds:>10,.0f} {peak / 1e6:>8.2f}")
+        db.close_connection()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
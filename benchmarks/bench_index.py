@@ -0,0 +1,109 @@
+"""Benchmark /index latency against a chat history with millions of messages.
+
+Builds a throwaway database in a temporary directory, fills it with
+synthetic sessions and messages, then times GET /index for one user through
+Flask's test client. Run it twice to compare against the unindexed schema:
+
+    python benchmarks/bench_index.py --messages 2000000
+    python benchmarks/bench_index.py --messages 2000000 --drop-indexes
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HISTORY_INDEXES = ("idx_chat_sessions_user_updated", "idx_chat_messages_session_time")
+
+
+def default_text(i, rng):
+    return f"question {i} about paddy and urea", f"answer {i}: apply fertilizer in split doses"
+
+
+def populate(conn, users, sessions_per_user, messages, make_text=default_text):
+    """Insert users, sessions and messages in a few large transactions.
+
+    ``make_text(i, rng)`` returns the (question, answer) of message ``i``.
+    """
+    sessions = users * sessions_per_user
+    with conn:
+        conn.executemany("INSERT INTO users (email, username, password, is_verified) VALUES (?, ?, 'pw', 1)",
+                         ((f"farmer{u}@example.com", f"farmer{u}") for u in range(users)))
+        conn.executemany('''INSERT INTO chat_sessions (username, session_name, created_at, updated_at)
+                            VALUES (?, ?, datetime('now', ?), datetime('now', ?))''',
+                         ((f"farmer{s % users}", f"Chat {s}", f"-{s} minutes", f"-{s} minutes")
+                          for s in range(sessions)))
+
+    rng = random.Random(42)
+    batch = 100000
+    for start in range(0, messages, batch):
+        rows = []
+        for i in range(start, min(start + batch, messages)):
+            question, answer = make_text(i, rng)
+            rows.append((rng.randint(1, sessions), "text", question, answer, None, None, "en",
+                         f"-{messages - i} seconds"))
+        with conn:
+            conn.executemany('''INSERT INTO chat_messages
+                                (session_id, message_type, message_text, response_text,
+                                 image_filename, voice_filename, language, timestamp)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, datetime('now', ?))''', rows)
+        print(f"  {min(start + batch, messages):,} messages", end="\r", flush=True)
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--sessions-per-user", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--drop-indexes", action="store_true",
+                        help="drop the history indexes to measure the old schema")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="krishi-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as krishi
+    import db
+
+    print(f"Populating {workdir}/krishi.db")
+    started = time.perf_counter()
+    conn = db.get_connection()
+    populate(conn, args.users, args.sessions_per_user, args.messages)
+    if args.drop_indexes:
+        for name in HISTORY_INDEXES:
+            conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.execute("ANALYZE")
+    print(f"Populated in {time.perf_counter() - started:.1f}s")
+
+    client = krishi.app.test_client()
+    username = "farmer1"
+    session_id = conn.execute("SELECT id FROM chat_sessions WHERE username = ? ORDER BY updated_at DESC LIMIT 1",
+                              (username,)).fetchone()[0]
+    with client.session_transaction() as s:
+        s["user"] = username
+        s["current_session_id"] = session_id
+        s["current_session_name"] = "bench"
+
+    client.get("/index")
+    timings = []
+    for _ in range(args.requests):
+        t0 = time.perf_counter()
+        response = client.get("/index")
+        timings.append((time.perf_counter() - t0) * 1000)
+        assert response.status_code == 200
+
+    timings.sort()
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    label = "without history indexes" if args.drop_indexes else "with history indexes"
+    print(f"/index {label}: {args.messages:,} messages, {args.requests} requests")
+    print(f"  p50 {statistics.median(timings):.2f} ms  p95 {p95:.2f} ms  max {timings[-1]:.2f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Time local answer lookups against the knowledge base and a large history.
+
+Fills a throwaway database with chat history in which a set of questions
+recurs across many users (plus noise; populate() stores every
+message as English), harvests the frequently asked ones
+into the local index next to the knowledge base, then times
+LocalAnswers.answer() and fallback() for prompts in Kannada, Hindi and
+English that should hit, fall back or miss. Every lookup must stay well
+under the 50 ms budget:
+
+    python benchmarks/bench_local_answers.py --messages 500000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_index import REPO_ROOT, populate
+
+FREQUENT = [
+    "When should I spray fungicide on grapes",
+    "Best time to harvest turmeric",
+    "ಅಡಿಕೆ ಕೊಳೆ ರೋಗಕ್ಕೆ ಔಷಧಿ ಯಾವುದು",
+    "गन्ने में लाल सड़न रोग का इलाज",
+]
+
+PROMPTS = {
+    "kb exact (en)": ("How much urea per acre for paddy?", "en"),
+    "kb reworded (en)": ("urea dose for paddy", "en"),
+    "kb inflected (kn)": ("ಟೊಮೆಟೊ ಎಲೆ ಮುದುಡು", "kn"),
+    "kb reworded (hi)": ("धान में यूरिया कितना डालें", "hi"),
+    "history (en)": ("best time to harvest turmeric?", "en"),
+    "history (Kannada)": ("ಅಡಿಕೆ ಕೊಳೆ ರೋಗಕ್ಕೆ ಔಷಧಿ ಯಾವುದು", "en"),
+    "entities (fallback)": ("paddy urea", "en"),
+    "vague (miss)": ("my tomato plants", "en"),
+    "unrelated (miss)": ("what is the weather today", "en"),
+}
+
+
+def history_text(i, rng):
+    if i % 3 == 0:
+        return rng.choice(FREQUENT), f"answer {i}: see your local Krishi Vigyan Kendra"
+    return f"question {i} about field {rng.randint(1, 10 ** 6)}", f"answer {i}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=500000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--sessions-per-user", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="krishi-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import db
+    import local_answers
+
+    db.configure(os.path.join(workdir, "krishi.db"))
+    db.migrate()
+    print(f"Populating {workdir}/krishi.db")
+    populate(db.get_connection(), args.users, args.sessions_per_user, args.messages, make_text=history_text)
+
+    index = local_answers.LocalAnswers(db.get_connection, run_async=False)
+    started = time.perf_counter()
+    index.load_knowledge(force=True)
+    loaded = time.perf_counter()
+    harvested = index.harvest(force=True)
+    print(f"Knowledge base indexed in {(loaded - started) * 1000:.1f} ms, "
+          f"{harvested} questions harvested in {time.perf_counter() - loaded:.1f}s")
+
+    print(f"{args.requests} lookups each (answer threshold {index.confidence}, "
+          f"fallback {index.fallback_confidence})")
+    for label, (prompt, lang) in PROMPTS.items():
+        for name, lookup in (("answer", index.answer), ("fallback", index.fallback)):
+            lookup(prompt, lang)
+            timings = []
+            for _ in range(args.requests):
+                t0 = time.perf_counter()
+                found = lookup(prompt, lang)
+                timings.append((time.perf_counter() - t0) * 1000)
+            timings.sort()
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            outcome = "-" if found is None else found[:40].replace("\n", " ")
+            print(f"  {label:<19} {name:<8} p50 {statistics.median(timings):6.2f} ms  p99 {p99:6.2f} ms  {outcome}")
+    print(index.stats())
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("METRICS_ENABLED", "0")
+    main()
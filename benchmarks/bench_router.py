@@ -0,0 +1,93 @@
+"""Compare tail latency of LLM calls with and without the model router.
+
+Starts the OpenRouter stub with three models: a primary whose latency has a
+long tail, a backup on another provider that is steady but a bit slower, and
+a flaky one that fails half of its calls. The same requests then go through
+llm_router.ModelRouter in three setups, each on a fresh router:
+
+    single     the primary alone, no hedging (what generate_reply() used to do)
+    hedged     primary, then backup, hedging after the primary's p-percentile
+    fallback   flaky first: its failures move on to the next model and, once
+               its error rate is known, it drops to the back of the order
+
+    python benchmarks/bench_router.py --requests 400 --concurrency 16
+    python benchmarks/bench_router.py --primary-sigma 1.2 --hedge-percentile 90
+"""
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_index import REPO_ROOT
+from load_test import percentile
+from stubs import Latency, OpenRouterHandler, StubServer
+
+PRIMARY = "stub/primary"
+BACKUP = "backup/steady"
+FLAKY = "flaky/model"
+
+
+def run(router, url, requests_total, concurrency):
+    """Send ``requests_total`` chat completions; returns (sorted ms, failures)."""
+    body = {"messages": [{"role": "user", "content": "How much urea per acre for paddy?"}]}
+
+    def one(_):
+        started = time.perf_counter()
+        try:
+            response = router.post(url, headers={"Content-Type": "application/json"}, json=body)
+            ok = response.status_code == 200
+        except Exception:
+            ok = False
+        return (time.perf_counter() - started) * 1000, ok
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(one, range(requests_total)))
+    return sorted(ms for ms, _ in results), sum(1 for _, ok in results if not ok)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--primary-latency-ms", type=float, default=300)
+    parser.add_argument("--primary-sigma", type=float, default=1.0, help="log-normal spread of the primary")
+    parser.add_argument("--backup-latency-ms", type=float, default=450)
+    parser.add_argument("--flaky-error-rate", type=float, default=0.5)
+    parser.add_argument("--hedge-percentile", type=float, default=90)
+    args = parser.parse_args()
+
+    sys.path.insert(0, REPO_ROOT)
+    import llm_router
+
+    primary = Latency(args.primary_latency_ms, args.primary_sigma)
+    stub = StubServer(0, OpenRouterHandler, primary, {
+        BACKUP: Latency(args.backup_latency_ms, 0.1),
+        FLAKY: Latency(args.primary_latency_ms, 0.3, args.flaky_error_rate),
+    }).start()
+    url = f"{stub.url}/"
+
+    setups = {
+        "single": dict(models=[PRIMARY], hedge_percentile=0),
+        "hedged": dict(models=[PRIMARY, BACKUP], hedge_percentile=args.hedge_percentile),
+        "fallback": dict(models=[FLAKY, PRIMARY, BACKUP], hedge_percentile=args.hedge_percentile),
+    }
+    print(f"{args.requests} requests, {args.concurrency} at a time; primary median "
+          f"{args.primary_latency_ms:.0f} ms (sigma {args.primary_sigma}), backup {args.backup_latency_ms:.0f} ms")
+    for label, options in setups.items():
+        router = llm_router.ModelRouter(hedge_min_ms=50, hedge_min_samples=10, **options)
+        calls_before = stub.requests
+        timings, failures = run(router, url, args.requests, args.concurrency)
+        stats = router.stats()
+        outcomes = ", ".join(f"{model} ok {s['ok']} err {s['error']} hedged {s['hedged']} fallback {s['fallback']}"
+                             for model, s in stats["models"].items())
+        print(f"  {label:<9} p50 {percentile(timings, 0.50):7.1f} ms  p95 {percentile(timings, 0.95):7.1f} ms  "
+              f"p99 {percentile(timings, 0.99):7.1f} ms  failed {failures}  "
+              f"stub calls {stub.requests - calls_before}")
+        print(f"            order {stats['order']}; {outcomes}")
+    stub.shutdown()
+
+
+if __name__ == "__main__":
+    os.environ.setdefault("METRICS_ENABLED", "0")
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark /search latency against millions of indexed messages.
+
+Fills a throwaway database with multilingual synthetic questions and
+answers (the FTS triggers index them as they are inserted), then times
+GET /search for one user with common and rare terms, a date range and a
+deep page:
+
+    python benchmarks/bench_search.py --messages 2000000
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from bench_index import REPO_ROOT, populate
+
+VOCABULARY = [
+    "paddy", "tomato", "leaf", "curl", "urea", "potash", "neem", "oil", "spray", "aphids",
+    "irrigation", "drip", "monsoon", "sowing", "harvest", "fungicide", "wilt", "yellow", "acre", "seeds",
+    "ಭತ್ತ", "ಟೊಮೆಟೊ", "ಎಲೆ", "ಗೊಬ್ಬರ", "ಬೇವಿನ", "ಎಣ್ಣೆ", "ನೀರು", "ಕೀಟ", "ಬಿತ್ತನೆ", "ಕೊಯ್ಲು",
+    "धान", "टमाटर", "पत्ते", "खाद", "नीम", "कीट", "सिंचाई", "बुवाई", "फसल", "बीज",
+    "వరి", "టమాటా", "ఆకు", "ఎరువు", "தக்காளி", "இலை", "உரம்", "നെല്ല്", "തക്കാളി", "വളം",
+]
+
+QUERIES = {
+    "common term": {"q": "tomato"},
+    "two terms": {"q": "ಟೊಮೆಟೊ ಎಲೆ"},
+    "prefix (inflected)": {"q": "ಗೊಬ್ಬ"},
+    "rare term": {"q": "fungicide wilt monsoon"},
+    "date range": {"q": "paddy", "from": "2000-01-01", "to": "2100-01-01"},
+    "page 5": {"q": "urea", "page": "5"},
+}
+
+
+def multilingual_text(i, rng):
+    question = " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(4, 10)))
+    answer = " ".join(rng.choice(VOCABULARY) for _ in range(rng.randint(12, 30)))
+    return question, answer
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=2000000)
+    parser.add_argument("--users", type=int, default=5000)
+    parser.add_argument("--sessions-per-user", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=30)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="krishi-bench-")
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_ROOT)
+    import app as krishi
+    import db
+
+    print(f"Populating {workdir}/krishi.db")
+    started = time.perf_counter()
+    conn = db.get_connection()
+    populate(conn, args.users, args.sessions_per_user, args.messages, make_text=multilingual_text)
+    conn.execute("INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('optimize')")
+    conn.execute("ANALYZE")
+    print(f"Populated and indexed in {time.perf_counter() - started:.1f}s")
+
+    client = krishi.app.test_client()
+    with client.session_transaction() as s:
+        s["user"] = "farmer1"
+
+    print(f"/search for one user, {args.messages:,} messages, {args.requests} requests each")
+    for label, params in QUERIES.items():
+        client.get("/search", query_string=params)
+        timings = []
+        for _ in range(args.requests):
+            t0 = time.perf_counter()
+            response = client.get("/search", query_string=params)
+            timings.append((time.perf_counter() - t0) * 1000)
+            assert response.status_code == 200
+        timings.sort()
+        p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+        hits = len(response.get_json()["results"])
+        print(f"  {label:<20} p50 {statistics.median(timings):7.2f} ms  p95 {p95:7.2f} ms  ({hits} results)")
+
+
+if __name__ == "__main__":
+    main()
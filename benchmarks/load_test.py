@@ -0,0 +1,292 @@
+"""Load test the app under gunicorn against local OpenRouter, TTS and SMTP stubs.
+
+Starts the stubs (see stubs.py), gunicorn serving the real app from a
+throwaway directory, and a number of virtual users. Each user registers,
+reads the verification code off the SMTP stub, verifies and logs in, then
+loops through a journey: /index, a few /chat messages, one /chat/stream,
+an /upload, a new session, switching back and deleting the new one.
+Latency is reported per route as p50/p95/p99 together with requests per
+second:
+
+    python benchmarks/load_test.py --users 50 --duration 60
+    python benchmarks/load_test.py --llm-latency-ms 3000 --error-rate 0.05
+
+Save a run and compare later ones against it; the comparison exits with
+status 1 when a route's p50, p95 or p99 grows, or its throughput drops, by
+more than the threshold:
+
+    python benchmarks/load_test.py --save baseline.json
+    python benchmarks/load_test.py --compare baseline.json --threshold 0.15
+"""
+import argparse
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+from PIL import Image
+
+from bench_index import REPO_ROOT
+from stubs import Latency, start_stubs
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+QUESTIONS = [
+    "My tomato leaves are curling, what should I do?",
+    "How much urea per acre for paddy?",
+    "ನನ್ನ ಭತ್ತದ ಎಲೆಗಳು ಹಳದಿ ಆಗುತ್ತಿವೆ",
+    "गेहूं में कौन सा खाद डालें?",
+    "When should I sow groundnut after the monsoon?",
+    "and how often should I spray it?",
+]
+
+TRACKED = ("p50", "p95", "p99")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values, share):
+    """Nearest-rank percentile of a sorted list."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(share * len(values))) - 1))]
+
+
+class Recorder:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def call(self, label, send, ok_status=(200, 302)):
+        started = time.perf_counter()
+        try:
+            response = send()
+            if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                response.content
+            failed = response.status_code not in ok_status
+        except requests.RequestException:
+            response, failed = None, True
+        elapsed = (time.perf_counter() - started) * 1000
+        with self.lock:
+            self.samples[label].append(elapsed)
+            if failed:
+                self.errors[label] += 1
+        return response
+
+    def report(self, duration):
+        routes = {}
+        for label, samples in sorted(self.samples.items()):
+            samples = sorted(samples)
+            routes[label] = {
+                "count": len(samples),
+                "errors": self.errors[label],
+                "p50": round(percentile(samples, 0.50), 1),
+                "p95": round(percentile(samples, 0.95), 1),
+                "p99": round(percentile(samples, 0.99), 1),
+                "rps": round(len(samples) / duration, 2),
+            }
+        return routes
+
+
+def photo(seed):
+    """A JPEG about the size of a phone photo, different for every user."""
+    rng = random.Random(seed)
+    img = Image.linear_gradient("L").resize((1600, 1200)).convert("RGB")
+    img.paste((rng.randrange(256), rng.randrange(256), rng.randrange(256)), (0, 0, 800, 600))
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=85)
+    return buf.getvalue()
+
+
+def virtual_user(index, base_url, smtp, recorder, deadline, args):
+    http = requests.Session()
+    email = f"farmer{index}@example.com"
+    form = {"email": email, "username": f"farmer{index}", "password": "bench"}
+    image = photo(index)
+    rng = random.Random(index)
+
+    def get(path, **kwargs):
+        return lambda: http.get(base_url + path, allow_redirects=False, timeout=120, **kwargs)
+
+    def post(path, **kwargs):
+        return lambda: http.post(base_url + path, allow_redirects=False, timeout=120, **kwargs)
+
+    def pause():
+        if args.think_ms:
+            time.sleep(rng.uniform(0.5, 1.5) * args.think_ms / 1000)
+
+    recorder.call("POST /register", post("/register", data=form))
+    code = smtp.wait_for_code(email)
+    if code is None:
+        recorder.errors["POST /verify-email"] += 1
+        return
+    recorder.call("POST /verify-email", post("/verify-email", data={"verification_code": code}))
+    recorder.call("POST /login", post("/login", data={"email": email, "password": "bench"}))
+
+    while time.monotonic() < deadline:
+        recorder.call("GET /index", get("/index"))
+        for _ in range(args.chats):
+            pause()
+            recorder.call("POST /chat", post("/chat", data={"message": rng.choice(QUESTIONS), "lang": "en"}))
+        pause()
+        recorder.call("POST /chat/stream", post("/chat/stream", data={"message": rng.choice(QUESTIONS), "lang": "en"},
+                                                stream=True))
+        pause()
+        recorder.call("POST /upload", post("/upload", data={"lang": "en"},
+                                           files={"image": ("leaf.jpg", image, "image/jpeg")}))
+
+        created = recorder.call("POST /new_chat", post("/new_chat"))
+        sessions = recorder.call("GET /api/sessions", get("/api/sessions"))
+        try:
+            new_id = created.json()["session_id"]
+            other = [s["id"] for s in sessions.json()["sessions"] if s["id"] != new_id]
+        except (AttributeError, ValueError, KeyError):
+            continue
+        if other:
+            recorder.call("GET /switch_session/<id>", get(f"/switch_session/{other[0]}"))
+            recorder.call("DELETE /delete_session/<id>",
+                          lambda: http.delete(f"{base_url}/delete_session/{new_id}", timeout=120))
+
+
+def start_server(args, workdir, env):
+    port = free_port()
+    command = [sys.executable, "-m", "gunicorn",
+               "--workers", str(args.workers), "--threads", str(args.threads),
+               "--bind", f"127.0.0.1:{port}", "--timeout", "120",
+               "--chdir", workdir, "--pythonpath", f"{REPO_ROOT},{BENCH_DIR}",
+               args.app]
+    log = open(os.path.join(workdir, "server.log"), "wb")
+    server = subprocess.Popen(command, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"Server exited, see {workdir}/server.log")
+        try:
+            requests.get(base_url + "/", timeout=2)
+            return server, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    server.terminate()
+    raise SystemExit(f"Server did not start, see {workdir}/server.log")
+
+
+def compare(routes, baseline, threshold, min_count):
+    """Regressions of this run against a saved one, as printable lines."""
+    regressions = []
+    for label, base in baseline["routes"].items():
+        current = routes.get(label)
+        if current is None or current["count"] < min_count or base["count"] < min_count:
+            continue
+        for metric in TRACKED:
+            if base[metric] > 0 and current[metric] > base[metric] * (1 + threshold):
+                regressions.append(f"{label} {metric} {base[metric]} -> {current[metric]} ms")
+        if current["rps"] < base["rps"] * (1 - threshold):
+            regressions.append(f"{label} rps {base['rps']} -> {current['rps']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--duration", type=float, default=30, help="seconds of journeys after registration")
+    parser.add_argument("--ramp", type=float, default=5, help="seconds over which users start")
+    parser.add_argument("--chats", type=int, default=3, help="/chat messages per journey")
+    parser.add_argument("--think-ms", type=float, default=0, help="pause between steps")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--app", default="wsgi_stubbed:app", help="gunicorn app spec")
+    parser.add_argument("--llm-latency-ms", type=float, default=1500)
+    parser.add_argument("--tts-latency-ms", type=float, default=400)
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal spread of stub latencies")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of failed stub calls")
+    parser.add_argument("--no-reply-cache", action="store_true")
+    parser.add_argument("--no-local-answers", action="store_true")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--compare", metavar="FILE", help="fail on regressions against saved results")
+    parser.add_argument("--threshold", type=float, default=0.15)
+    parser.add_argument("--min-count", type=int, default=20, help="ignore routes with fewer samples")
+    args = parser.parse_args()
+
+    llm, tts, smtp = start_stubs(Latency(args.llm_latency_ms, args.sigma, args.error_rate),
+                                 Latency(args.tts_latency_ms, args.sigma, args.error_rate),
+                                 Latency(5, args.sigma))
+
+    workdir = tempfile.mkdtemp(prefix="krishi-load-")
+    env = dict(os.environ,
+               OPENROUTER_API_KEY="stub", OPENROUTER_URL=f"{llm.url}/",
+               STUB_TTS_URL=tts.url,
+               EMAIL_ADDRESS="bench@example.com", EMAIL_PASSWORD="stub", EMAIL_RATE_PER_MINUTE="0",
+               USER_RATE_PER_MINUTE="0",
+               SMTP_SERVER="127.0.0.1", SMTP_PORT=str(smtp.server_address[1]), SMTP_STARTTLS="0",
+               FLASK_SECRET_KEY="load-test", NO_PROXY="127.0.0.1,localhost")
+    if args.no_reply_cache:
+        env["REPLY_CACHE_ENABLED"] = "0"
+    if args.no_local_answers:
+        env["LOCAL_ANSWERS_ENABLED"] = "0"
+
+    server, base_url = start_server(args, workdir, env)
+    print(f"Serving from {workdir} at {base_url} ({args.workers} workers x {args.threads} threads)")
+
+    recorder = Recorder()
+    started = time.monotonic()
+    deadline = started + args.ramp + args.duration
+    users = []
+    try:
+        for i in range(args.users):
+            user = threading.Thread(target=virtual_user, args=(i, base_url, smtp, recorder, deadline, args),
+                                    daemon=True)
+            user.start()
+            users.append(user)
+            time.sleep(args.ramp / max(1, args.users))
+        for user in users:
+            user.join()
+    finally:
+        server.terminate()
+        server.wait()
+    duration = time.monotonic() - started
+
+    routes = recorder.report(duration)
+    total = sum(route["count"] for route in routes.values())
+    print(f"{args.users} users, {duration:.1f}s, {total} requests, {total / duration:.1f} req/s; "
+          f"stub calls: {llm.requests} LLM, {tts.requests} TTS")
+    print(f"{'route':<30} {'count':>6} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>7}")
+    for label, route in routes.items():
+        print(f"{label:<30} {route['count']:>6} {route['errors']:>6} {route['p50']:>8.1f} "
+              f"{route['p95']:>8.1f} {route['p99']:>8.1f} {route['rps']:>7.2f}")
+
+    results = {"config": {key: value for key, value in vars(args).items() if key not in ("save", "compare")},
+               "routes": routes}
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved to {args.save}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(routes, baseline, args.threshold, args.min_count)
+        if regressions:
+            print(f"Regressions beyond {args.threshold:.0%}:")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.threshold:.0%} against {args.compare}")
+
+
+if __name__ == "__main__":
+    main()
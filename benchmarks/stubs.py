@@ -0,0 +1,248 @@
+"""Local stand-ins for OpenRouter, Google TTS and the SMTP server.
+
+Load tests must not spend OpenRouter credits or hit translate.google.com,
+and their numbers should not depend on how those services feel today. The
+stubs answer in the same wire formats the app parses, after a latency drawn
+from a log-normal distribution (a median and a spread), and fail a
+configurable share of requests; the OpenRouter stub can give individual
+models their own latency and error rate, to stand in for a slow or failing
+model behind the router (see llm_router.py). The SMTP stub keeps the verification codes
+it receives so a scripted journey can complete registration.
+
+Run on their own to point a manually started app at them:
+
+    python benchmarks/stubs.py --llm-port 9001 --tts-port 9002 --smtp-port 9025
+"""
+import argparse
+import base64
+import json
+import math
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+REPLY = ("Tomato leaf curl is usually spread by whiteflies. Remove affected plants, spray neem oil "
+         "every seven days and use yellow sticky traps. Apply balanced NPK fertilizer and water at "
+         "the base of the plant in the morning.")
+
+
+class Latency:
+    """Log-normal latency with the given median (ms) and spread, plus an error rate."""
+
+    def __init__(self, median_ms, sigma=0.5, error_rate=0.0):
+        self.median_ms = median_ms
+        self.sigma = sigma
+        self.error_rate = error_rate
+
+    def sleep(self):
+        if self.median_ms > 0:
+            time.sleep(math.exp(random.gauss(math.log(self.median_ms), self.sigma)) / 1000)
+
+    def fails(self):
+        return random.random() < self.error_rate
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, port, handler, latency, model_latency=None):
+        super().__init__(("127.0.0.1", port), handler)
+        self.latency = latency
+        # Per-model overrides of ``latency``, by the "model" in the request body
+        self.model_latency = model_latency or {}
+        self.requests = 0
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name=type(self).__name__, daemon=True).start()
+        return self
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+
+class QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class OpenRouterHandler(QuietHandler):
+    """POST /: chat completions, streamed as SSE when the body asks for it."""
+
+    def do_POST(self):
+        request = json.loads(self.read_body() or b"{}")
+        self.server.requests += 1
+        latency = self.server.model_latency.get(request.get("model"), self.server.latency)
+        latency.sleep()
+        if latency.fails():
+            self.send_body(500, b'{"error": {"message": "stub failure"}}', "application/json")
+            return
+
+        # Vary every reply so voices aren't all served from the voice cache
+        reply = f"{REPLY} Advice number {self.server.requests}."
+        if not request.get("stream"):
+            body = json.dumps({"choices": [{"message": {"role": "assistant", "content": reply}}]})
+            self.send_body(200, body.encode("utf-8"), "application/json")
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        words = reply.split(" ")
+        for i, word in enumerate(words):
+            piece = word if i == 0 else f" {word}"
+            chunk = json.dumps({"choices": [{"delta": {"content": piece}}]})
+            self.wfile.write(f"data: {chunk}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(0.005)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+class TTSHandler(QuietHandler):
+    """POST /_/TranslateWebserverUi/data/batchexecute, the endpoint gTTS calls."""
+
+    def do_POST(self):
+        body = self.read_body()
+        self.server.requests += 1
+        latency = self.server.latency
+        latency.sleep()
+        if latency.fails():
+            self.send_body(503, b"stub failure", "text/plain")
+            return
+
+        # About as much audio as gTTS returns: ~1 KB per 10 characters
+        audio = b"\xff\xfb\x90\x00" + bytes(max(1024, len(body) * 100))
+        encoded = base64.b64encode(audio).decode("ascii")
+        payload = ')]}\'\n\n[["wrb.fr","jQ1olc","[\\"' + encoded + '\\"]",null,null,null,"generic"]]\n'
+        self.send_body(200, payload.encode("ascii"), "application/json; charset=utf-8")
+
+
+CODE = re.compile(rb"verification code is: <strong>(\d{6})</strong>")
+
+
+class SMTPHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: EHLO, AUTH, MAIL, RCPT, DATA, QUIT."""
+
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 stub ESMTP")
+        recipient = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.strip().split(b" ")[0].upper()
+            if command == b"EHLO":
+                self.reply("250-stub")
+                self.reply("250 AUTH PLAIN LOGIN")
+            elif command == b"HELO":
+                self.reply("250 stub")
+            elif command == b"AUTH":
+                self.reply("235 2.7.0 Authentication successful")
+            elif command == b"RCPT":
+                recipient = line.split(b"<", 1)[1].split(b">", 1)[0].decode("ascii").lower()
+                self.reply("250 OK")
+            elif command == b"DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                message = []
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                    message.append(data_line)
+                self.server.latency.sleep()
+                self.server.deliver(recipient, b"".join(message))
+                self.reply("250 OK queued")
+            elif command == b"QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                # MAIL, RSET, NOOP
+                self.reply("250 OK")
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, port, latency):
+        super().__init__(("127.0.0.1", port), SMTPHandler)
+        self.latency = latency
+        self.codes = {}
+        self.delivered = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name="SMTPStub", daemon=True).start()
+        return self
+
+    def deliver(self, recipient, message):
+        match = CODE.search(message.replace(b"=\r\n", b"").replace(b"=\n", b""))
+        with self.delivered:
+            if match:
+                self.codes[recipient] = match.group(1).decode("ascii")
+            self.delivered.notify_all()
+
+    def wait_for_code(self, recipient, timeout=30):
+        deadline = time.monotonic() + timeout
+        with self.delivered:
+            while recipient not in self.codes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return None
+                self.delivered.wait(remaining)
+            return self.codes.pop(recipient)
+
+
+def start_stubs(llm_latency, tts_latency, smtp_latency, llm_port=0, tts_port=0, smtp_port=0):
+    """Start all three stubs on background threads; returns (llm, tts, smtp)."""
+    llm = StubServer(llm_port, OpenRouterHandler, llm_latency).start()
+    tts = StubServer(tts_port, TTSHandler, tts_latency).start()
+    smtp = SMTPStub(smtp_port, smtp_latency).start()
+    return llm, tts, smtp
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--llm-port", type=int, default=9001)
+    parser.add_argument("--tts-port", type=int, default=9002)
+    parser.add_argument("--smtp-port", type=int, default=9025)
+    parser.add_argument("--llm-latency-ms", type=float, default=1500)
+    parser.add_argument("--tts-latency-ms", type=float, default=400)
+    parser.add_argument("--sigma", type=float, default=0.5, help="log-normal spread of all latencies")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    llm, tts, smtp = start_stubs(Latency(args.llm_latency_ms, args.sigma, args.error_rate),
+                                 Latency(args.tts_latency_ms, args.sigma, args.error_rate),
+                                 Latency(0),
+                                 args.llm_port, args.tts_port, args.smtp_port)
+    print(f"OPENROUTER_URL={llm.url}/")
+    print(f"STUB_TTS_URL={tts.url}")
+    print(f"SMTP_SERVER=127.0.0.1 SMTP_PORT={smtp.server_address[1]} SMTP_STARTTLS=0")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
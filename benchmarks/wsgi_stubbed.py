@@ -0,0 +1,16 @@
+"""WSGI entry point for load tests: the real app with gTTS sent to a stub.
+
+gTTS has no setting for the host it calls, so its URL builder is pointed
+at STUB_TTS_URL before the app is imported. Everything else (OpenRouter,
+SMTP) is configured through the environment that load_test.py sets.
+
+    gunicorn --pythonpath .,benchmarks wsgi_stubbed:app
+"""
+import os
+
+import gtts.tts
+
+STUB_TTS_URL = os.environ["STUB_TTS_URL"].rstrip("/")
+gtts.tts._translate_url = lambda tld="com", path="": f"{STUB_TTS_URL}/{path}"
+
+from app import app  # noqa: E402
@@ -0,0 +1,364 @@
+"""Streaming export and import of chat history.
+
+An export walks sessions (one user's or everyone's) and their messages in
+index order, fetching EXPORT_FETCH_ROWS rows from a cursor at a time and
+handing each record on as soon as it is read, so memory stays flat however
+long the history is. It runs on a connection of its own with temp_store set
+to FILE, so the one sort it needs (the distinct file names of a bundle)
+spills to disk instead of memory.
+
+NDJSON has one record per line, each session followed by its messages:
+
+    {"type": "session", "id": 7, "username": "...", "session_name": "...", "created_at": "...", ...}
+    {"type": "message", "id": 120, "session_id": 7, "message_type": "text", "message_text": "...", ...}
+
+CSV has one row per message with its session's columns repeated; a session
+without messages is a row with empty message columns. A bundle is a zip,
+streamed as it is written, holding history.ndjson or history.csv followed by
+the uploads (with their thumbnails and vision copies) and the voices the
+history references, under uploads/ and voices/.
+
+An import reads any of them back. Sessions get new ids in the target
+database and messages are inserted IMPORT_BATCH_ROWS per transaction.
+Bundled files are copied into place unless a file of that name is already
+there; their names are content hashes, so that one is the same file. Only
+the CLI imports bundles, since the files land in directories every user's
+messages share. For the same reason a user's own import (the web route)
+drops the image and voice names of the messages: kept, they would let
+anyone attach someone else's upload or voice, by its name, to their history
+and have it served to them.
+
+    EXPORT_FETCH_ROWS  rows fetched from a cursor at a time (default 500)
+    IMPORT_BATCH_ROWS  messages inserted per transaction (default 1000)
+"""
+import csv
+import io
+import json
+import os
+import shutil
+import zipfile
+
+from uploads import thumbnail_name, vision_name
+
+FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "500"))
+IMPORT_BATCH_ROWS = int(os.getenv("IMPORT_BATCH_ROWS", "1000"))
+
+# Bytes collected before a chunk is handed to the response, and read at a
+# time from bundled files
+CHUNK_SIZE = 64 * 1024
+
+# Format: (file name inside a bundle, content type)
+FORMATS = {
+    "ndjson": ("history.ndjson", "application/x-ndjson"),
+    "csv": ("history.csv", "text/csv; charset=utf-8"),
+}
+
+SESSION_FIELDS = ("id", "username", "session_name", "created_at", "updated_at")
+MESSAGE_FIELDS = ("id", "session_id", "message_type", "message_text", "response_text",
+                  "image_filename", "voice_filename", "language", "timestamp")
+CSV_FIELDS = ("username", "session_id", "session_name", "session_created_at", "session_updated_at",
+              "message_id", "message_type", "message_text", "response_text",
+              "image_filename", "voice_filename", "language", "timestamp")
+
+
+class ArchiveError(ValueError):
+    """The file being imported isn't a history export; the message says why."""
+
+
+# ---------------- export ----------------
+
+def fetch_rows(cursor, size=FETCH_ROWS):
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield from rows
+
+
+def iter_records(conn, username=None):
+    """Yield ("session", dict) and ("message", dict), each session before its messages.
+
+    Sessions are read in (username, updated_at) index order and messages in
+    (session_id, timestamp) index order, so neither query sorts anything.
+    """
+    conn.execute("PRAGMA temp_store = FILE")
+    if username is None:
+        users = fetch_rows(conn.execute("SELECT DISTINCT username FROM chat_sessions ORDER BY username"))
+    else:
+        users = [(username,)]
+    for (user,) in users:
+        sessions = conn.execute('''SELECT id, username, session_name, created_at, updated_at
+                                   FROM chat_sessions WHERE username = ?
+                                   ORDER BY updated_at, id''', (user,))
+        for session in fetch_rows(sessions):
+            yield "session", dict(zip(SESSION_FIELDS, session))
+            messages = conn.execute('''SELECT id, session_id, message_type, message_text, response_text,
+                                              image_filename, voice_filename, language, timestamp
+                                       FROM chat_messages WHERE session_id = ?
+                                       ORDER BY timestamp, id''', (session[0],))
+            for message in fetch_rows(messages):
+                yield "message", dict(zip(MESSAGE_FIELDS, message))
+
+
+def ndjson_lines(records):
+    for kind, record in records:
+        yield json.dumps({"type": kind, **record}, ensure_ascii=False) + "\n"
+
+
+def csv_lines(records):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(row):
+        writer.writerow(row)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    def session_columns(session):
+        return [session["username"], session["id"], session["session_name"],
+                session["created_at"], session["updated_at"]]
+
+    yield line(CSV_FIELDS)
+    session = None
+    empty = False
+    for kind, record in records:
+        if kind == "session":
+            if empty:
+                yield line(session_columns(session) + [""] * (len(CSV_FIELDS) - 5))
+            session = record
+            empty = True
+        else:
+            empty = False
+            yield line(session_columns(session) + [record[field] for field in MESSAGE_FIELDS if field != "session_id"])
+    if empty:
+        yield line(session_columns(session) + [""] * (len(CSV_FIELDS) - 5))
+
+
+def export_lines(conn, username, fmt):
+    records = iter_records(conn, username)
+    return ndjson_lines(records) if fmt == "ndjson" else csv_lines(records)
+
+
+def export_chunks(conn, username, fmt):
+    """The export as bytes, in chunks of about CHUNK_SIZE."""
+    parts = []
+    size = 0
+    for text in export_lines(conn, username, fmt):
+        data = text.encode("utf-8")
+        parts.append(data)
+        size += len(data)
+        if size >= CHUNK_SIZE:
+            yield b"".join(parts)
+            parts.clear()
+            size = 0
+    if parts:
+        yield b"".join(parts)
+
+
+def referenced_files(conn, username=None):
+    """("uploads" or "voices", file name) for every file the history references, once each."""
+    for column, folder in (("image_filename", "uploads"), ("voice_filename", "voices")):
+        sql = f'''SELECT DISTINCT m.{column} FROM chat_messages m
+                  JOIN chat_sessions s ON s.id = m.session_id
+                  WHERE m.{column} IS NOT NULL'''
+        params = ()
+        if username is not None:
+            sql += " AND s.username = ?"
+            params = (username,)
+        for (name,) in fetch_rows(conn.execute(sql, params)):
+            yield folder, name
+            if folder == "uploads":
+                yield folder, thumbnail_name(name)
+                yield folder, vision_name(name)
+
+
+class _Chunks:
+    """Write-only file for zipfile that keeps what was written until take() hands it on.
+
+    Having no tell() makes zipfile treat it as unseekable and write each
+    entry's sizes after its data, so nothing has to be rewound.
+    """
+
+    def __init__(self):
+        self.parts = []
+
+    def write(self, data):
+        self.parts.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b"".join(self.parts)
+        self.parts.clear()
+        return data
+
+
+def bundle_chunks(conn, username, fmt, uploads_dir, voices_dir):
+    """A zip of the export and the files it references, as bytes chunks."""
+    directories = {"uploads": uploads_dir, "voices": voices_dir}
+    sink = _Chunks()
+    with zipfile.ZipFile(sink, "w", zipfile.ZIP_DEFLATED) as bundle:
+        with bundle.open(FORMATS[fmt][0], "w", force_zip64=True) as entry:
+            for text in export_lines(conn, username, fmt):
+                entry.write(text.encode("utf-8"))
+                if sum(len(part) for part in sink.parts) >= CHUNK_SIZE:
+                    yield sink.take()
+        for folder, name in referenced_files(conn, username):
+            path = os.path.join(directories[folder], name)
+            if not os.path.isfile(path):
+                continue
+            # Photos and mp3s are compressed already, so they are stored as is
+            info = zipfile.ZipInfo.from_file(path, f"{folder}/{name}")
+            with open(path, "rb") as source, bundle.open(info, "w", force_zip64=True) as entry:
+                while True:
+                    data = source.read(CHUNK_SIZE)
+                    if not data:
+                        break
+                    entry.write(data)
+                    yield sink.take()
+            yield sink.take()
+    yield sink.take()
+
+
+# ---------------- import ----------------
+
+def format_of(filename):
+    """"ndjson", "csv" or "zip" from a file name's extension, or None."""
+    extension = os.path.splitext(filename or "")[1].lower()
+    return {".ndjson": "ndjson", ".jsonl": "ndjson", ".csv": "csv", ".zip": "zip"}.get(extension)
+
+
+def read_records(stream, fmt):
+    """Yield ("session", dict) and ("message", dict) from an NDJSON or CSV text stream."""
+    if fmt == "ndjson":
+        for number, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                raise ArchiveError(f"Line {number} is not valid JSON.")
+            kind = record.pop("type", None) if isinstance(record, dict) else None
+            if kind not in ("session", "message"):
+                raise ArchiveError(f"Line {number} is neither a session nor a message.")
+            yield kind, record
+        return
+
+    reader = csv.DictReader(stream)
+    missing = set(CSV_FIELDS) - set(reader.fieldnames or ())
+    if missing:
+        raise ArchiveError(f"Missing CSV columns: {', '.join(sorted(missing))}.")
+    current = None
+    for row in reader:
+        if row["session_id"] != current:
+            current = row["session_id"]
+            yield "session", {"id": current, "username": row["username"], "session_name": row["session_name"],
+                              "created_at": row["session_created_at"] or None,
+                              "updated_at": row["session_updated_at"] or None}
+        if row["message_id"]:
+            yield "message", {"session_id": current, "message_type": row["message_type"],
+                              "message_text": row["message_text"], "response_text": row["response_text"],
+                              "image_filename": row["image_filename"] or None,
+                              "voice_filename": row["voice_filename"] or None,
+                              "language": row["language"], "timestamp": row["timestamp"] or None}
+
+
+def import_records(conn, records, username=None, batch_rows=IMPORT_BATCH_ROWS, keep_files=True):
+    """Insert the sessions and messages of read_records(); returns the counts.
+
+    Messages must follow their session, the way exports write them. With
+    ``username`` every session is imported as that user's, and without
+    ``keep_files`` messages lose their image and voice names. Each batch of
+    messages is committed with the sessions created since the last one;
+    if the input turns out to be broken, what was committed stays.
+    """
+    counts = {"sessions": 0, "messages": 0}
+    current = None
+    pending = []
+
+    def flush():
+        with conn:
+            conn.executemany('''INSERT INTO chat_messages
+                                (session_id, message_type, message_text, response_text,
+                                 image_filename, voice_filename, language, timestamp)
+                                VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, CURRENT_TIMESTAMP))''', pending)
+        counts["messages"] += len(pending)
+        pending.clear()
+
+    try:
+        for kind, record in records:
+            if kind == "session":
+                owner = username or record.get("username")
+                if not owner:
+                    raise ArchiveError(f"Session {record.get('id')} has no username.")
+                cursor = conn.execute('''INSERT INTO chat_sessions (username, session_name, created_at, updated_at)
+                                         VALUES (?, ?, COALESCE(?, CURRENT_TIMESTAMP), COALESCE(?, CURRENT_TIMESTAMP))''',
+                                      (owner, record.get("session_name") or "Chat Session",
+                                       record.get("created_at"), record.get("updated_at")))
+                current = (record.get("id"), cursor.lastrowid)
+                counts["sessions"] += 1
+                continue
+
+            if current is None or record.get("session_id") != current[0]:
+                raise ArchiveError(f"Message {record.get('id')} does not follow its session.")
+            image_filename = record.get("image_filename") if keep_files else None
+            voice_filename = record.get("voice_filename") if keep_files else None
+            pending.append((current[1], record.get("message_type") or "text", record.get("message_text"),
+                            record.get("response_text"), image_filename, voice_filename,
+                            record.get("language") or "en", record.get("timestamp")))
+            if len(pending) >= batch_rows:
+                flush()
+        flush()
+    except Exception:
+        conn.rollback()
+        raise
+    return counts
+
+
+def import_bundle(conn, file, uploads_dir, voices_dir, username=None, batch_rows=IMPORT_BATCH_ROWS):
+    """Import a zip written by bundle_chunks(), history first and then its files."""
+    directories = {"uploads": uploads_dir, "voices": voices_dir}
+    try:
+        bundle = zipfile.ZipFile(file)
+    except zipfile.BadZipFile:
+        raise ArchiveError("Not a zip file.")
+    with bundle:
+        names = set(bundle.namelist())
+        fmt = next((fmt for fmt, (name, _) in FORMATS.items() if name in names), None)
+        if fmt is None:
+            raise ArchiveError("The zip has no history.ndjson or history.csv.")
+        with bundle.open(FORMATS[fmt][0]) as raw:
+            text = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+            counts = import_records(conn, read_records(text, fmt), username, batch_rows)
+
+        counts["files"] = 0
+        for info in bundle.infolist():
+            folder, _, name = info.filename.partition("/")
+            directory = directories.get(folder)
+            # Only plain names: nothing may land outside the two directories
+            if directory is None or not name or name != os.path.basename(name) or name.startswith("."):
+                continue
+            target = os.path.join(directory, name)
+            if os.path.exists(target):
+                continue
+            tmp_path = f"{target}.import.tmp"
+            with bundle.open(info) as source, open(tmp_path, "wb") as dest:
+                shutil.copyfileobj(source, dest, CHUNK_SIZE)
+            os.replace(tmp_path, target)
+            counts["files"] += 1
+    return counts
+
+
+def import_file(conn, path, uploads_dir, voices_dir, username=None, batch_rows=IMPORT_BATCH_ROWS):
+    """Import an .ndjson, .csv or .zip export from ``path``; returns the counts."""
+    fmt = format_of(path)
+    if fmt is None:
+        raise ArchiveError("Expected an .ndjson, .csv or .zip file.")
+    if fmt == "zip":
+        return import_bundle(conn, path, uploads_dir, voices_dir, username, batch_rows)
+    with open(path, encoding="utf-8", newline="") as stream:
+        return import_records(conn, read_records(stream, fmt), username, batch_rows)
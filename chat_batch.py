@@ -0,0 +1,134 @@
+"""Batches of questions for /chat/batch.
+
+Extension officers collect questions from many farmers and submit them
+together instead of one /chat round trip each. A batch is a JSON body:
+
+    {"items": [{"message": "...", "lang": "kn", "voice": true}, "...", ...],
+     "lang": "en", "voice": false, "session_id": 12}
+
+An item is an object or just the message; the batch's ``lang`` and
+``voice`` are the defaults for its items. Items asking the same question in
+the same language (compared the way the reply cache compares prompts) are
+answered once. Up to CHAT_BATCH_PARALLELISM questions are answered at a
+time, each still taking an LLM admission slot, and the response streams one
+NDJSON line per question as soon as its answer is ready, so lines arrive in
+completion order:
+
+    {"event": "reply", "items": [0, 3], "lang": "kn", "reply": "..."}
+    {"event": "voice", "items": [0, 3], "voice": ..., "voice_job": ..., "voice_stream": ...}
+    {"event": "done", "session_id": 41, "saved": 12, "questions": 11, "items": 12}
+
+Once every question is answered, all of them are saved in one transaction,
+one message per item, in a new session unless ``session_id`` names one of
+the user's sessions; voices are then queued for the questions that asked for
+one. A question shed by admission control gets ``"error": "busy"`` with a
+``retry_after`` and is not saved. If the client goes away before the end,
+the questions answered by then are still saved.
+
+    CHAT_BATCH_MAX_ITEMS    items accepted in one batch (default 100)
+    CHAT_BATCH_PARALLELISM  questions answered at once per batch (default 4)
+"""
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from reply_cache import normalize_prompt
+
+MAX_ITEMS = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "100"))
+PARALLELISM = int(os.getenv("CHAT_BATCH_PARALLELISM", "4"))
+
+# Longest message accepted in a batch item
+MAX_MESSAGE_CHARS = 4000
+
+
+class BatchRejected(ValueError):
+    """The batch body can't be processed; the message says why."""
+
+
+class Question:
+    """One distinct question of a batch and the (index, message) items that asked it."""
+
+    __slots__ = ("message", "lang", "voice", "items")
+
+    def __init__(self, message, lang):
+        self.message = message
+        self.lang = lang
+        self.voice = False
+        self.items = []
+
+    @property
+    def indexes(self):
+        return [index for index, _ in self.items]
+
+
+def parse(payload, max_items=MAX_ITEMS):
+    """The distinct Questions of a batch body, in order of first appearance."""
+    if not isinstance(payload, dict) or not isinstance(payload.get("items"), list):
+        raise BatchRejected('Expected a JSON object with an "items" list.')
+    items = payload["items"]
+    if not items:
+        raise BatchRejected("The batch has no items.")
+    if len(items) > max_items:
+        raise BatchRejected(f"At most {max_items} items per batch.")
+
+    default_lang = str(payload.get("lang") or "en")
+    default_voice = bool(payload.get("voice", False))
+    questions = {}
+    for index, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"message": item}
+        if not isinstance(item, dict):
+            raise BatchRejected(f"Item {index} is neither a message nor an object.")
+        message = str(item.get("message") or "").strip()
+        if not message:
+            raise BatchRejected(f"Item {index} has no message.")
+        if len(message) > MAX_MESSAGE_CHARS:
+            raise BatchRejected(f"Item {index} is longer than {MAX_MESSAGE_CHARS} characters.")
+        lang = str(item.get("lang") or default_lang)
+
+        key = (lang, normalize_prompt(message))
+        question = questions.get(key)
+        if question is None:
+            question = questions[key] = Question(message, lang)
+        question.items.append((index, message))
+        question.voice = question.voice or bool(item.get("voice", default_voice))
+    return list(questions.values())
+
+
+def ndjson(payload):
+    return (json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8")
+
+
+def answer_all(questions, answer, parallelism=None):
+    """Yield (question, answer(question)) in completion order.
+
+    ``parallelism`` questions (default CHAT_BATCH_PARALLELISM) are answered
+    at a time. If the caller stops early (the client went away), questions not
+    started yet are dropped and the running ones are waited for.
+    """
+    with ThreadPoolExecutor(max(1, parallelism or PARALLELISM), thread_name_prefix="chat-batch") as pool:
+        futures = {pool.submit(answer, question): question for question in questions}
+        try:
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+        finally:
+            for future in futures:
+                future.cancel()
+
+
+async def aanswer_all(questions, answer, parallelism=None):
+    """answer_all() for coroutines: ``answer(question)`` is awaited."""
+    slots = asyncio.Semaphore(max(1, parallelism or PARALLELISM))
+
+    async def one(question):
+        async with slots:
+            return question, await answer(question)
+
+    tasks = [asyncio.ensure_future(one(question)) for question in questions]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,180 @@
+"""Multi-turn context for chat replies.
+
+Each request sends the model the last few turns of the session verbatim
+plus a short rolling summary of everything before them, trimmed to a token
+budget, so follow-up questions keep their context while the prompt stays
+bounded. The summary lives on the chat_sessions row. After each exchange
+the turns that slid out of the verbatim window are folded into it by a
+background thread; requests only ever read it.
+
+    CONTEXT_TURNS         turns sent verbatim (default 4)
+    CONTEXT_TOKEN_BUDGET  estimated tokens for summary plus turns (default 1200)
+    SUMMARY_ASYNC         "0" updates summaries inline in the request (default "1",
+                          "0" on Vercel where background threads are frozen once
+                          the response is sent)
+"""
+import logging
+import os
+import queue
+import threading
+
+TURNS = int(os.getenv("CONTEXT_TURNS", "4"))
+TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1200"))
+ASYNC = os.getenv("SUMMARY_ASYNC", "0" if os.getenv("VERCEL") == "1" else "1") == "1"
+
+# Out-of-window turns folded into the summary in one update; older ones in a
+# long legacy session are skipped rather than summarized a batch at a time
+FOLD_LIMIT = 10
+SUMMARY_MAX_CHARS = 2000
+
+
+def estimate_tokens(text):
+    """Rough token count without a tokenizer.
+
+    About four characters per token for ASCII text and one per two for
+    Indic scripts, which BPE vocabularies split much more finely.
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode("ascii", "ignore"))
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+
+class ConversationContext:
+    """Builds per-session prompt context and keeps session summaries current.
+
+    ``connect`` returns the sqlite3 connection to use (see db.get_connection).
+    ``summarize(summary, turns)`` returns the previous summary extended with
+    ``turns`` (a list of (question, answer)), or None if it failed.
+    ``skip_reply(text)`` marks stored replies that aren't real answers.
+    """
+
+    def __init__(self, connect, summarize, system_prompt="", skip_reply=None,
+                 turns=TURNS, token_budget=TOKEN_BUDGET, run_async=ASYNC):
+        self.connect = connect
+        self.summarize = summarize
+        self.system_tokens = estimate_tokens(system_prompt)
+        self.skip_reply = skip_reply or (lambda text: False)
+        self.turns = turns
+        self.token_budget = token_budget
+        self.run_async = run_async
+
+        self.queue = queue.Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+        self.counters = {"requests": 0, "prompt_tokens": 0, "summaries_updated": 0, "summary_failures": 0}
+
+    def build(self, session_id, prompt):
+        """Messages to place between the system prompt and the new message."""
+        conn = self.connect()
+        row = conn.execute("SELECT summary FROM chat_sessions WHERE id = ?", (session_id,)).fetchone()
+        summary = row[0] if row else None
+        recent = conn.execute('''SELECT message_text, response_text FROM chat_messages
+                                 WHERE session_id = ?
+                                 ORDER BY timestamp DESC, id DESC
+                                 LIMIT ?''', (session_id, self.turns)).fetchall()
+
+        budget = self.token_budget
+        messages = []
+        if summary:
+            summary_message = f"Summary of the earlier conversation with this farmer:\n{summary}"
+            budget -= estimate_tokens(summary_message)
+            messages.append({"role": "system", "content": summary_message})
+
+        # Newest turns first, so the oldest are the ones that don't fit
+        kept = []
+        for question, answer in recent:
+            if not question or not answer or self.skip_reply(answer):
+                continue
+            cost = estimate_tokens(question) + estimate_tokens(answer)
+            if cost > budget:
+                break
+            budget -= cost
+            kept.append(({"role": "user", "content": question}, {"role": "assistant", "content": answer}))
+        for question, answer in reversed(kept):
+            messages.extend((question, answer))
+
+        context_tokens = self.token_budget - budget
+        prompt_tokens = self.system_tokens + context_tokens + estimate_tokens(prompt)
+        with self.lock:
+            self.counters["requests"] += 1
+            self.counters["prompt_tokens"] += prompt_tokens
+        logging.info(f"Prompt for session {session_id}: ~{prompt_tokens} tokens "
+                     f"({len(kept)} turns, summary {'yes' if summary else 'no'}, context {context_tokens})")
+        return messages
+
+    def update(self, session_id):
+        """Fold turns that left the verbatim window into the session summary."""
+        if not self.run_async:
+            self._refresh(session_id)
+            return
+
+        self._start_worker()
+        with self.lock:
+            if session_id in self.pending:
+                return
+            self.pending.add(session_id)
+        self.queue.put(session_id)
+
+    def _start_worker(self):
+        # Threads don't survive a fork, so start the worker lazily in each process
+        pid = os.getpid()
+        with self.lock:
+            if self.thread_pid == pid:
+                return
+            self.pending.clear()
+            self.thread = threading.Thread(target=self._work, name="session-summary", daemon=True)
+            self.thread.start()
+            self.thread_pid = pid
+
+    def _work(self):
+        while True:
+            session_id = self.queue.get()
+            with self.lock:
+                self.pending.discard(session_id)
+            try:
+                self._refresh(session_id)
+            except Exception as e:
+                logging.error(f"Summary update for session {session_id} failed: {e}")
+
+    def _refresh(self, session_id):
+        conn = self.connect()
+        row = conn.execute("SELECT summary, summary_through FROM chat_sessions WHERE id = ?",
+                           (session_id,)).fetchone()
+        if not row:
+            return
+        summary, through = row[0], row[1] or 0
+
+        rows = conn.execute('''SELECT id, message_text, response_text FROM chat_messages
+                               WHERE session_id = ? AND id > ?
+                               ORDER BY id DESC
+                               LIMIT ?''', (session_id, through, self.turns + FOLD_LIMIT)).fetchall()
+        outside = rows[self.turns:][::-1]
+        if not outside:
+            return
+
+        turns = [(question, answer) for _, question, answer in outside
+                 if question and answer and not self.skip_reply(answer)]
+        new_summary = self.summarize(summary, turns) if turns else summary
+        if turns and not new_summary:
+            with self.lock:
+                self.counters["summary_failures"] += 1
+            return
+
+        with conn:
+            # Another process may have folded the same turns meanwhile
+            conn.execute('''UPDATE chat_sessions SET summary = ?, summary_through = ?
+                            WHERE id = ? AND COALESCE(summary_through, 0) = ?''',
+                         ((new_summary or "")[:SUMMARY_MAX_CHARS] or None, outside[-1][0], session_id, through))
+        with self.lock:
+            self.counters["summaries_updated"] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["avg_prompt_tokens"] = (round(stats["prompt_tokens"] / stats["requests"], 1)
+                                          if stats["requests"] else 0.0)
+            stats["pending"] = len(self.pending)
+        return stats
@@ -0,0 +1,570 @@
+"""SQLite data access for Krishi Mitra.
+
+Connections are opened once per thread and reused for every query that
+thread runs, instead of a connect/close around each helper. Each connection
+is switched to WAL so readers don't block the writer, and gets a busy
+timeout so concurrent writers wait rather than fail with "database is
+locked".
+
+The schema is managed by numbered migrations recorded in PRAGMA
+user_version; migrate() applies the ones a database hasn't seen yet. A fresh
+database can instead be seeded from a snapshot file that already has the
+current schema (see seed_from_snapshot()), so a serverless instance starting
+with an empty /tmp doesn't replay every migration.
+"""
+import datetime
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import unicodedata
+
+from metrics import timed
+
+DB_PATH = None
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+)
+
+_local = threading.local()
+
+
+def configure(path):
+    """Point the module at a database file (connections are reopened)."""
+    global DB_PATH
+    DB_PATH = path
+    close_connection()
+
+
+def connect(path=None):
+    """Open a new connection with the tuned pragmas applied."""
+    conn = sqlite3.connect(path or DB_PATH, timeout=5, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def get_connection():
+    """Return this thread's connection, opening it on first use.
+
+    A connection inherited through fork() is never reused; the child opens
+    its own.
+    """
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid() and _local.path == DB_PATH:
+        return conn
+    conn = connect()
+    _local.conn = conn
+    _local.pid = os.getpid()
+    _local.path = DB_PATH
+    return conn
+
+
+def close_connection():
+    conn = getattr(_local, "conn", None)
+    if conn is not None and _local.pid == os.getpid():
+        conn.close()
+    _local.conn = None
+
+
+# ---------------- MIGRATIONS ----------------
+
+def _indic_tokenchars():
+    """Combining marks of the Indic scripts plus ZWNJ/ZWJ.
+
+    unicode61 treats vowel signs and viramas as separators, which would cut
+    "ಟೊಮೆಟೊ" into "ಟ", "ಮ", "ಟ"; declaring them token characters keeps Kannada,
+    Hindi, Telugu, Tamil and Malayalam words whole.
+    """
+    marks = [chr(c) for c in range(0x0900, 0x0D80) if unicodedata.category(chr(c)) in ("Mn", "Mc")]
+    return "".join(marks) + "\u200c\u200d"
+
+
+FTS_TOKENIZE = f"unicode61 remove_diacritics 0 tokenchars '{_indic_tokenchars()}'"
+
+# (version, description, statements). Never edit a released migration; add a
+# new one. The first ones use IF NOT EXISTS because databases created before
+# migrations existed already have those tables.
+MIGRATIONS = [
+    (1, "users, chat sessions and messages", [
+        '''CREATE TABLE IF NOT EXISTS users
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            email TEXT UNIQUE,
+            username TEXT,
+            password TEXT,
+            is_verified INTEGER DEFAULT 0,
+            verification_code TEXT)''',
+        '''CREATE TABLE IF NOT EXISTS chat_sessions
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT,
+            session_name TEXT DEFAULT 'Chat Session',
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (username) REFERENCES users (username))''',
+        '''CREATE TABLE IF NOT EXISTS chat_messages
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id INTEGER,
+            message_type TEXT,
+            message_text TEXT,
+            response_text TEXT,
+            image_filename TEXT,
+            voice_filename TEXT,
+            language TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id))''',
+    ]),
+    (2, "reply cache", [
+        '''CREATE TABLE IF NOT EXISTS reply_cache
+           (cache_key TEXT PRIMARY KEY,
+            language TEXT,
+            reply TEXT,
+            created_at REAL,
+            last_used_at REAL,
+            expires_at REAL,
+            hits INTEGER DEFAULT 0)''',
+        "CREATE INDEX IF NOT EXISTS idx_reply_cache_last_used ON reply_cache (last_used_at)",
+    ]),
+    (3, "voice jobs", [
+        '''CREATE TABLE IF NOT EXISTS voice_jobs
+           (id TEXT PRIMARY KEY,
+            username TEXT,
+            message_id INTEGER,
+            status TEXT,
+            voice_filename TEXT,
+            error TEXT,
+            created_at REAL,
+            started_at REAL,
+            finished_at REAL)''',
+    ]),
+    (4, "history indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_chat_sessions_user_updated ON chat_sessions (username, updated_at)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_session_time ON chat_messages (session_id, timestamp)",
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_voice ON chat_messages (voice_filename)",
+        "CREATE INDEX IF NOT EXISTS idx_users_username ON users (username)",
+    ]),
+    # Full-text index over questions and answers. The owner column holds
+    # 'u' || hex(username) as a single token so a search is narrowed to one
+    # user's messages inside the index rather than after ranking everyone's.
+    (5, "full-text search", [
+        '''CREATE VIEW IF NOT EXISTS chat_messages_search AS
+           SELECT m.id AS id, 'u' || hex(s.username) AS owner, m.message_text, m.response_text
+           FROM chat_messages m JOIN chat_sessions s ON s.id = m.session_id''',
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS chat_messages_fts USING fts5
+            (owner, message_text, response_text,
+             content='chat_messages_search', content_rowid='id',
+             tokenize="{FTS_TOKENIZE}", prefix='2 3')''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_messages_fts_insert AFTER INSERT ON chat_messages BEGIN
+               INSERT INTO chat_messages_fts (rowid, owner, message_text, response_text)
+               SELECT new.id, 'u' || hex(username), new.message_text, new.response_text
+               FROM chat_sessions WHERE id = new.session_id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_messages_fts_delete AFTER DELETE ON chat_messages BEGIN
+               INSERT INTO chat_messages_fts (chat_messages_fts, rowid, owner, message_text, response_text)
+               SELECT 'delete', old.id, 'u' || hex(username), old.message_text, old.response_text
+               FROM chat_sessions WHERE id = old.session_id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS chat_messages_fts_update
+           AFTER UPDATE OF message_text, response_text ON chat_messages BEGIN
+               INSERT INTO chat_messages_fts (chat_messages_fts, rowid, owner, message_text, response_text)
+               SELECT 'delete', old.id, 'u' || hex(username), old.message_text, old.response_text
+               FROM chat_sessions WHERE id = old.session_id;
+               INSERT INTO chat_messages_fts (rowid, owner, message_text, response_text)
+               SELECT new.id, 'u' || hex(username), new.message_text, new.response_text
+               FROM chat_sessions WHERE id = new.session_id;
+           END''',
+        "INSERT INTO chat_messages_fts (chat_messages_fts) VALUES ('rebuild')",
+    ]),
+    (6, "email outbox", [
+        '''CREATE TABLE IF NOT EXISTS email_outbox
+           (id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipient TEXT,
+            subject TEXT,
+            body_html TEXT,
+            status TEXT,
+            attempts INTEGER DEFAULT 0,
+            next_attempt_at REAL,
+            claimed_at REAL,
+            last_error TEXT,
+            created_at REAL,
+            sent_at REAL)''',
+        "CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox (status, next_attempt_at)",
+    ]),
+    (7, "session summaries", [
+        # summary_through is the id of the last message folded into the summary
+        "ALTER TABLE chat_sessions ADD COLUMN summary TEXT",
+        "ALTER TABLE chat_sessions ADD COLUMN summary_through INTEGER DEFAULT 0",
+    ]),
+    (8, "image reference index", [
+        "CREATE INDEX IF NOT EXISTS idx_chat_messages_image ON chat_messages (image_filename)",
+    ]),
+    # Offline answer index (see local_answers.py): curated knowledge base
+    # entries and frequently asked questions harvested from chat history
+    (9, "local answer index", [
+        f'''CREATE VIRTUAL TABLE IF NOT EXISTS local_answers USING fts5
+            (question, keywords, answer UNINDEXED, lang UNINDEXED, source UNINDEXED, ref UNINDEXED,
+             tokenize="{FTS_TOKENIZE}", prefix='3 4')''',
+        '''CREATE TABLE IF NOT EXISTS local_answers_meta
+           (key TEXT PRIMARY KEY,
+            value TEXT)''',
+    ]),
+    # Retention pages through image-bearing messages newest first (see
+    # retention.StorageCollector._expire_images)
+    (10, "image messages by time", [
+        '''CREATE INDEX IF NOT EXISTS idx_chat_messages_image_time ON chat_messages (timestamp, id)
+           WHERE image_filename IS NOT NULL''',
+    ]),
+]
+
+
+def schema_version(conn=None):
+    conn = conn or get_connection()
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def migrate(conn=None):
+    """Apply pending migrations in order, each in its own transaction.
+
+    Every worker runs this when it imports the app, so several processes may
+    migrate the same fresh database at once. Each migration therefore runs
+    under BEGIN IMMEDIATE, which takes the write lock up front, and
+    user_version is read again once the lock is held: a migration another
+    process applied meanwhile is skipped instead of failing halfway (the
+    sqlite3 module doesn't open a transaction around DDL by itself, so
+    ``with conn`` would not cover the statements).
+    """
+    conn = conn or get_connection()
+    current = schema_version(conn)
+    if current >= LATEST_VERSION:
+        return current
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                current = schema_version(conn)
+                if version <= current:
+                    conn.execute("ROLLBACK")
+                    continue
+                for statement in statements:
+                    conn.execute(statement)
+                conn.execute(f"PRAGMA user_version = {version}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            current = version
+            logging.info(f"Applied migration {version}: {description}")
+    finally:
+        conn.isolation_level = isolation_level
+    return schema_version(conn)
+
+
+def build_snapshot(path):
+    """Write an empty database with the current schema to ``path``."""
+    tmp_path = f"{path}.tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    try:
+        migrate(conn)
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+    os.replace(tmp_path, path)
+    return LATEST_VERSION
+
+
+def seed_from_snapshot(path, snapshot):
+    """Copy ``snapshot`` to ``path`` if there is no database there yet.
+
+    Returns True if the database was seeded. A missing snapshot is not an
+    error: migrate() then builds the schema as usual, and so it does for
+    anything the snapshot is behind on.
+    """
+    if not snapshot or os.path.exists(path):
+        return False
+    if not os.path.exists(snapshot):
+        logging.warning(f"Database snapshot {snapshot} not found, building the schema instead")
+        return False
+    tmp_path = f"{path}.seed.tmp"
+    shutil.copyfile(snapshot, tmp_path)
+    os.replace(tmp_path, path)
+    return True
+
+
+# ---------------- USERS ----------------
+
+@timed()
+def user_exists(email, username):
+    conn = get_connection()
+    row = conn.execute("SELECT 1 FROM users WHERE email = ? OR username = ?", (email, username)).fetchone()
+    return row is not None
+
+
+@timed()
+def create_user(email, username, password, verification_code):
+    conn = get_connection()
+    with conn:
+        conn.execute("INSERT INTO users (email, username, password, verification_code) VALUES (?, ?, ?, ?)",
+                     (email, username, password, verification_code))
+
+
+@timed()
+def verify_user(email, verification_code):
+    """Mark the user verified if the code matches. Returns True on success."""
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute('''UPDATE users SET is_verified = 1, verification_code = NULL
+                                 WHERE email = ? AND verification_code = ?''', (email, verification_code))
+    return cursor.rowcount > 0
+
+
+@timed()
+def find_user(email, password):
+    conn = get_connection()
+    return conn.execute("SELECT * FROM users WHERE email = ? AND password = ?", (email, password)).fetchone()
+
+
+# ---------------- CHAT HISTORY ----------------
+
+@timed()
+def get_or_create_session(username, session_id=None):
+    """Get existing session or create new one."""
+    conn = get_connection()
+
+    if session_id:
+        session = conn.execute("SELECT id, session_name FROM chat_sessions WHERE id = ? AND username = ?",
+                               (session_id, username)).fetchone()
+        if session:
+            return session[0], session[1]
+
+    session_name = f"Chat {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
+    with conn:
+        cursor = conn.execute("INSERT INTO chat_sessions (username, session_name) VALUES (?, ?)",
+                              (username, session_name))
+    return cursor.lastrowid, session_name
+
+
+@timed()
+def save_chat_message(session_id, message_type, message_text, response_text, image_filename=None, voice_filename=None, language="en"):
+    """Save chat message to database and return its id (None on failure)."""
+    try:
+        conn = get_connection()
+        with conn:
+            cursor = conn.execute('''INSERT INTO chat_messages
+                                     (session_id, message_type, message_text, response_text, image_filename, voice_filename, language)
+                                     VALUES (?, ?, ?, ?, ?, ?, ?)''',
+                                  (session_id, message_type, message_text, response_text, image_filename, voice_filename, language))
+            conn.execute("UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (session_id,))
+        return cursor.lastrowid
+    except Exception as e:
+        print("Error saving chat message:", e)
+        return None
+
+
+@timed()
+def save_chat_batch(username, session_id, rows):
+    """Save (message_text, response_text, language) text messages in one transaction.
+
+    The messages go into ``session_id``, or into a new session when it is
+    None. Returns (session_id, message ids in the order of ``rows``).
+    """
+    conn = get_connection()
+    with conn:
+        if session_id is None:
+            session_name = f"Batch {datetime.datetime.now().strftime('%Y-%m-%d %H:%M')}"
+            session_id = conn.execute("INSERT INTO chat_sessions (username, session_name) VALUES (?, ?)",
+                                      (username, session_name)).lastrowid
+        ids = [conn.execute('''INSERT INTO chat_messages
+                                 (session_id, message_type, message_text, response_text, language)
+                                 VALUES (?, 'text', ?, ?, ?)''',
+                              (session_id, message_text, response_text, language)).lastrowid
+               for message_text, response_text, language in rows]
+        conn.execute("UPDATE chat_sessions SET updated_at = CURRENT_TIMESTAMP WHERE id = ?", (session_id,))
+    return session_id, ids
+
+
+@timed()
+def get_chat_sessions(username):
+    """Get all chat sessions for a user."""
+    try:
+        conn = get_connection()
+        return conn.execute('''SELECT id, session_name, created_at, updated_at
+                               FROM chat_sessions
+                               WHERE username = ?
+                               ORDER BY updated_at DESC''', (username,)).fetchall()
+    except Exception as e:
+        print("Error retrieving chat sessions:", e)
+        return []
+
+
+@timed()
+def get_chat_messages(session_id):
+    """Get all messages for a chat session."""
+    try:
+        conn = get_connection()
+        return conn.execute('''SELECT message_type, message_text, response_text, image_filename, voice_filename, language, timestamp
+                               FROM chat_messages
+                               WHERE session_id = ?
+                               ORDER BY timestamp ASC, id ASC''', (session_id,)).fetchall()
+    except Exception as e:
+        print("Error retrieving chat messages:", e)
+        return []
+
+
+@timed()
+def get_chat_sessions_page(username, limit, before=None):
+    """One page of a user's sessions, most recently updated first.
+
+    ``before`` is the (updated_at, id) of the last session of the previous
+    page. Returns (rows, has_more).
+    """
+    conn = get_connection()
+    if before is None:
+        rows = conn.execute('''SELECT id, session_name, created_at, updated_at
+                               FROM chat_sessions
+                               WHERE username = ?
+                               ORDER BY updated_at DESC, id DESC
+                               LIMIT ?''', (username, limit + 1)).fetchall()
+    else:
+        updated_at, session_id = before
+        rows = conn.execute('''SELECT id, session_name, created_at, updated_at
+                               FROM chat_sessions
+                               WHERE username = ? AND (updated_at < ? OR (updated_at = ? AND id < ?))
+                               ORDER BY updated_at DESC, id DESC
+                               LIMIT ?''', (username, updated_at, updated_at, session_id, limit + 1)).fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+@timed()
+def get_chat_messages_page(session_id, limit, before=None):
+    """The ``limit`` messages of a session that precede ``before``.
+
+    ``before`` is the (timestamp, id) of the oldest message already shown;
+    None means start from the newest message. Rows come back oldest first,
+    with the message id appended. Returns (rows, has_more).
+    """
+    conn = get_connection()
+    if before is None:
+        rows = conn.execute('''SELECT message_type, message_text, response_text, image_filename, voice_filename, language, timestamp, id
+                               FROM chat_messages
+                               WHERE session_id = ?
+                               ORDER BY timestamp DESC, id DESC
+                               LIMIT ?''', (session_id, limit + 1)).fetchall()
+    else:
+        timestamp, message_id = before
+        rows = conn.execute('''SELECT message_type, message_text, response_text, image_filename, voice_filename, language, timestamp, id
+                               FROM chat_messages
+                               WHERE session_id = ? AND (timestamp < ? OR (timestamp = ? AND id < ?))
+                               ORDER BY timestamp DESC, id DESC
+                               LIMIT ?''', (session_id, timestamp, timestamp, message_id, limit + 1)).fetchall()
+    has_more = len(rows) > limit
+    return rows[:limit][::-1], has_more
+
+
+@timed()
+def session_belongs_to(session_id, username):
+    conn = get_connection()
+    row = conn.execute("SELECT 1 FROM chat_sessions WHERE id = ? AND username = ?", (session_id, username)).fetchone()
+    return row is not None
+
+
+# Snippet markers; the caller escapes the text and turns these into tags
+SNIPPET_START = "\x02"
+SNIPPET_END = "\x03"
+
+
+def search_terms(query):
+    """Split a search box query into terms, keeping Indic combining marks."""
+    text = unicodedata.normalize("NFC", query)
+    cleaned = "".join(" " if unicodedata.category(ch)[0] in "PSZC" and ch not in "\u200c\u200d" else ch
+                      for ch in text)
+    return cleaned.split()
+
+
+@timed()
+def search_messages(username, terms, limit, offset=0, since=None, until=None):
+    """Rank a user's messages against ``terms`` (every term must match).
+
+    Terms are prefix-matched so inflected forms ("ಟೊಮೆಟೊಗೆ", "tomatoes")
+    are found. ``since``/``until`` are inclusive YYYY-MM-DD dates. Returns
+    (rows, has_more); each row is (id, session_id, session_name, message_type,
+    language, timestamp, question snippet, answer snippet).
+    """
+    owner = "u" + username.encode("utf-8").hex().upper()
+    match = f'owner : "{owner}" AND (' + " ".join('"' + term.replace('"', '""') + '"*' for term in terms) + ")"
+
+    sql = '''SELECT m.id, m.session_id, s.session_name, m.message_type, m.language, m.timestamp,
+                    snippet(chat_messages_fts, 1, ?, ?, '…', 12),
+                    snippet(chat_messages_fts, 2, ?, ?, '…', 16)
+             FROM chat_messages_fts
+             JOIN chat_messages m ON m.id = chat_messages_fts.rowid
+             JOIN chat_sessions s ON s.id = m.session_id
+             WHERE chat_messages_fts MATCH ? AND s.username = ?'''
+    params = [SNIPPET_START, SNIPPET_END, SNIPPET_START, SNIPPET_END, match, username]
+    if since:
+        sql += " AND m.timestamp >= ?"
+        params.append(since)
+    if until:
+        sql += " AND m.timestamp < date(?, '+1 day')"
+        params.append(until)
+    # Column weights: owner, question, answer
+    sql += " ORDER BY bm25(chat_messages_fts, 0.0, 2.0, 1.0) LIMIT ? OFFSET ?"
+    params.extend([limit + 1, offset])
+
+    rows = get_connection().execute(sql, params).fetchall()
+    return rows[:limit], len(rows) > limit
+
+
+@timed()
+def delete_chat_session(session_id, username):
+    """Delete a chat session and all its messages."""
+    try:
+        conn = get_connection()
+        with conn:
+            owned = conn.execute("SELECT 1 FROM chat_sessions WHERE id = ? AND username = ?",
+                                 (session_id, username)).fetchone()
+            if owned:
+                conn.execute("DELETE FROM chat_messages WHERE session_id = ?", (session_id,))
+                conn.execute("DELETE FROM chat_sessions WHERE id = ?", (session_id,))
+        return True
+    except Exception as e:
+        print("Error deleting chat session:", e)
+        return False
+
+
+@timed()
+def rename_chat_session(session_id, username, new_name):
+    conn = get_connection()
+    with conn:
+        conn.execute("UPDATE chat_sessions SET session_name = ? WHERE id = ? AND username = ?",
+                     (new_name, session_id, username))
+
+
+@timed()
+def find_voice_source(voice_filename):
+    """(response_text, language) of a message that references a voice file."""
+    conn = get_connection()
+    return conn.execute("SELECT response_text, language FROM chat_messages WHERE voice_filename = ? LIMIT 1",
+                        (voice_filename,)).fetchone()
+
+
+@timed()
+def get_voice_job_text(job_id):
+    """(response_text, language) of the message a voice job speaks."""
+    conn = get_connection()
+    return conn.execute('''SELECT m.response_text, m.language FROM voice_jobs j
+                           JOIN chat_messages m ON m.id = j.message_id WHERE j.id = ?''', (job_id,)).fetchone()
@@ -0,0 +1,293 @@
+"""Shared HTTP client for OpenRouter.
+
+One pooled, keep-alive requests.Session per process so every chat message
+reuses an open TLS connection instead of handshaking with openrouter.ai again.
+Transient failures (429/5xx, connection errors) are retried a bounded number
+of times with jittered exponential backoff, and a circuit breaker stops
+calling the upstream altogether for a cool-down period once it keeps failing,
+so users get the localized error message right away instead of waiting for
+timeouts.
+
+Everything is configurable through environment variables:
+
+    OPENROUTER_POOL_SIZE          connections kept per host (default: worker threads)
+    OPENROUTER_CONNECT_TIMEOUT    seconds to establish a connection (default 5)
+    OPENROUTER_READ_TIMEOUT       seconds to wait for response bytes (default 30)
+    OPENROUTER_MAX_RETRIES        extra attempts after the first one (default 2)
+    OPENROUTER_BACKOFF_BASE       first backoff step in seconds (default 0.5)
+    OPENROUTER_BACKOFF_MAX        cap for a single backoff sleep (default 4)
+    OPENROUTER_BREAKER_THRESHOLD  consecutive failed calls that open the breaker (default 5)
+    OPENROUTER_BREAKER_COOLDOWN   seconds the breaker stays open (default 30)
+    OPENROUTER_ASYNC_POOL_SIZE    connections of the async client used by asgi.py (default 200)
+
+The async client (AsyncLLMClient) needs httpx, which only the ASGI mode uses.
+Both HTTP libraries are imported when their client is first created, not at
+import time, so a serverless cold start doesn't load them before it needs to.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+
+POOL_SIZE = int(os.getenv("OPENROUTER_POOL_SIZE", os.getenv("GUNICORN_THREADS", "10")))
+CONNECT_TIMEOUT = float(os.getenv("OPENROUTER_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("OPENROUTER_READ_TIMEOUT", "30"))
+MAX_RETRIES = int(os.getenv("OPENROUTER_MAX_RETRIES", "2"))
+BACKOFF_BASE = float(os.getenv("OPENROUTER_BACKOFF_BASE", "0.5"))
+BACKOFF_MAX = float(os.getenv("OPENROUTER_BACKOFF_MAX", "4"))
+BREAKER_THRESHOLD = int(os.getenv("OPENROUTER_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.getenv("OPENROUTER_BREAKER_COOLDOWN", "30"))
+ASYNC_POOL_SIZE = int(os.getenv("OPENROUTER_ASYNC_POOL_SIZE", "200"))
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the upstream while the breaker is open."""
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker (closed -> open -> half-open)."""
+
+    def __init__(self, threshold=BREAKER_THRESHOLD, cooldown=BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self.lock:
+            return self._state()
+
+    def _state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.clock() - self.opened_at >= self.cooldown:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Return True if a call may go out now.
+
+        In the half-open state exactly one probe call is let through; the
+        others keep failing fast until that probe reports back.
+        """
+        with self.lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.probing:
+                self.probing = True
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probing = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.probing or self.failures >= self.threshold:
+                if self.opened_at is None:
+                    logging.warning(f"OpenRouter circuit breaker opened after {self.failures} failures")
+                self.opened_at = self.clock()
+            self.probing = False
+
+
+class LLMClient:
+    """Thread-safe pooled client with bounded retries and a circuit breaker."""
+
+    def __init__(self, pool_size=POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, breaker=None,
+                 sleep=time.sleep):
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.sleep = sleep
+
+        import requests
+        from requests.adapters import HTTPAdapter
+
+        self.requests = requests
+        self.session = requests.Session()
+        # Retries are handled below so they can respect the breaker and Retry-After
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def backoff(self, attempt, retry_after=None):
+        """Seconds to wait before retry number ``attempt`` (full jitter)."""
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def post(self, url, headers=None, json=None, stream=False, breaker=None, max_retries=None):
+        """POST with retries. Returns the final response, whatever its status.
+
+        Raises CircuitOpenError without touching the network while the breaker
+        is open, and re-raises the last requests exception if every attempt
+        failed at the connection level. ``breaker`` and ``max_retries``
+        override the client's own for this call (see llm_router).
+        """
+        breaker = breaker or self.breaker
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if not breaker.allow():
+            raise CircuitOpenError("OpenRouter circuit breaker is open")
+
+        attempt = 0
+        while True:
+            try:
+                response = self.session.post(url, headers=headers, json=json,
+                                             timeout=self.timeout, stream=stream)
+            except (self.requests.ConnectionError, self.requests.Timeout) as e:
+                if attempt >= max_retries:
+                    breaker.record_failure()
+                    raise
+                logging.warning(f"OpenRouter request failed ({e}), retrying")
+                self.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                return response
+
+            if attempt >= max_retries:
+                breaker.record_failure()
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            logging.warning(f"OpenRouter returned {response.status_code}, retrying")
+            response.close()
+            self.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncLLMClient:
+    """asyncio counterpart of LLMClient with the same retry and breaker rules."""
+
+    backoff = LLMClient.backoff
+
+    def __init__(self, pool_size=ASYNC_POOL_SIZE, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_retries=MAX_RETRIES,
+                 backoff_base=BACKOFF_BASE, backoff_max=BACKOFF_MAX, breaker=None):
+        import httpx
+
+        self.httpx = httpx
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        )
+
+    async def post(self, url, headers=None, json=None, stream=False, breaker=None, max_retries=None):
+        """POST with retries; see LLMClient.post().
+
+        With ``stream`` the body is left unread and the caller must
+        ``await response.aclose()``.
+        """
+        breaker = breaker or self.breaker
+        max_retries = self.max_retries if max_retries is None else max_retries
+        if not breaker.allow():
+            raise CircuitOpenError("OpenRouter circuit breaker is open")
+
+        attempt = 0
+        while True:
+            request = self.client.build_request("POST", url, headers=headers, json=json)
+            try:
+                response = await self.client.send(request, stream=stream)
+            except self.httpx.TransportError as e:
+                if attempt >= max_retries:
+                    breaker.record_failure()
+                    raise
+                logging.warning(f"OpenRouter request failed ({e!r}), retrying")
+                await asyncio.sleep(self.backoff(attempt))
+                attempt += 1
+                continue
+
+            if response.status_code not in RETRY_STATUSES:
+                breaker.record_success()
+                return response
+
+            if attempt >= max_retries:
+                breaker.record_failure()
+                return response
+
+            retry_after = parse_retry_after(response.headers.get("Retry-After"))
+            logging.warning(f"OpenRouter returned {response.status_code}, retrying")
+            await response.aclose()
+            await asyncio.sleep(self.backoff(attempt, retry_after))
+            attempt += 1
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header, or None if absent or a date."""
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+_client = None
+_client_pid = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Return the process-wide client, recreating it after a fork."""
+    global _client, _client_pid
+    pid = os.getpid()
+    if _client is None or _client_pid != pid:
+        with _client_lock:
+            if _client is None or _client_pid != pid:
+                _client = LLMClient()
+                _client_pid = pid
+    return _client
+
+
+_async_client = None
+_async_client_pid = None
+
+
+def get_async_client():
+    """Return the process-wide async client.
+
+    It shares the circuit breaker of get_client(), so sync and async calls
+    in one process see the same upstream health. Call it from the event
+    loop thread only; the connections belong to that loop.
+    """
+    global _async_client, _async_client_pid
+    pid = os.getpid()
+    if _async_client is None or _async_client_pid != pid:
+        _async_client = AsyncLLMClient(breaker=get_client().breaker)
+        _async_client_pid = pid
+    return _async_client
+
+
+async def close_async_client():
+    global _async_client
+    if _async_client is not None:
+        await _async_client.close()
+        _async_client = None
@@ -0,0 +1,480 @@
+"""Route chat completions across an ordered list of models.
+
+Every call goes to the most preferred model that is healthy. Each model has
+a window of its recent calls (latency and outcome), its own circuit breaker,
+and its provider (the part of the model id before "/") has a cap on
+concurrent calls. Models that are failing or much slower than the others
+move behind the rest until their window ages out. When the answer takes
+longer than the model's usual latency percentile, a hedged request goes to
+the next model (or the same one if only one is configured): whichever
+answers first is used and the other is cancelled. A failed call falls back
+to the next model right away instead of retrying the same one.
+
+    LLM_MODELS             comma-separated model ids, most preferred first
+                           (default OPENROUTER_MODEL)
+    LLM_PROVIDER_LIMITS    concurrent calls per provider, e.g. "google=32,openai=16"
+    LLM_PROVIDER_LIMIT     cap for providers not listed (default 64)
+    LLM_WINDOW             recent calls kept per model (default 100)
+    LLM_WINDOW_SECONDS     calls older than this are forgotten (default 300)
+    LLM_HEDGE_PERCENTILE   latency percentile after which to hedge (default 95, 0 disables)
+    LLM_HEDGE_MIN_MS       never hedge earlier than this (default 1000)
+    LLM_HEDGE_MIN_SAMPLES  successful calls a model needs before it is hedged (default 20)
+    LLM_ERROR_THRESHOLD    error rate that moves a model to the back (default 0.5)
+    LLM_SLOW_FACTOR        median latency, relative to the fastest model, that moves
+                           a model behind the others (default 3)
+
+In sync mode the losing thread can't be interrupted, so its result is
+dropped when it arrives (a streamed response is closed); async callers get
+real cancellation.
+"""
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import llm_client
+import metrics
+from llm_client import CircuitBreaker, CircuitOpenError
+
+MODELS = [m.strip() for m in os.getenv("LLM_MODELS", os.getenv("OPENROUTER_MODEL", "google/gemini-2.0-flash-001")).split(",")
+          if m.strip()]
+PROVIDER_LIMIT = int(os.getenv("LLM_PROVIDER_LIMIT", "64"))
+PROVIDER_LIMITS = {
+    name.strip(): int(limit)
+    for name, _, limit in (item.partition("=") for item in os.getenv("LLM_PROVIDER_LIMITS", "").split(","))
+    if name.strip() and limit.strip()
+}
+WINDOW = int(os.getenv("LLM_WINDOW", "100"))
+WINDOW_SECONDS = float(os.getenv("LLM_WINDOW_SECONDS", "300"))
+HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_MS = float(os.getenv("LLM_HEDGE_MIN_MS", "1000"))
+HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+ERROR_THRESHOLD = float(os.getenv("LLM_ERROR_THRESHOLD", "0.5"))
+SLOW_FACTOR = float(os.getenv("LLM_SLOW_FACTOR", "3"))
+
+# Calls a model needs in its window before its error rate or speed count
+MIN_HEALTH_SAMPLES = 5
+
+# How often an async caller re-checks a provider cap it is waiting on
+SLOT_POLL_SECONDS = 0.05
+
+
+class ProvidersBusyError(CircuitOpenError):
+    """Every candidate model's provider stayed at its concurrency cap."""
+
+
+def provider_of(model):
+    return model.split("/", 1)[0] if "/" in model else model
+
+
+class ProviderSlots:
+    """Counting semaphore for one provider that also supports non-blocking use."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.cond = threading.Condition()
+
+    def try_acquire(self):
+        with self.cond:
+            if self.in_use >= self.limit:
+                return False
+            self.in_use += 1
+            return True
+
+    def acquire(self, timeout):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.in_use < self.limit, timeout):
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self):
+        with self.cond:
+            self.in_use -= 1
+            self.cond.notify()
+
+    def releaser(self):
+        """A release() for one acquired slot that only counts the first call."""
+        released = threading.Event()
+
+        def release():
+            if not released.is_set():
+                released.set()
+                self.release()
+        return release
+
+
+class ModelWindow:
+    """Recent calls of one model: (finished at, seconds, ok)."""
+
+    def __init__(self, size=WINDOW, max_age=WINDOW_SECONDS, clock=time.monotonic):
+        self.calls = deque(maxlen=size)
+        self.max_age = max_age
+        self.clock = clock
+
+    def add(self, seconds, ok):
+        self.calls.append((self.clock(), seconds, ok))
+
+    def recent(self):
+        cutoff = self.clock() - self.max_age
+        while self.calls and self.calls[0][0] < cutoff:
+            self.calls.popleft()
+        return self.calls
+
+    def error_rate(self):
+        calls = self.recent()
+        if len(calls) < MIN_HEALTH_SAMPLES:
+            return 0.0
+        return sum(1 for _, _, ok in calls if not ok) / len(calls)
+
+    def latencies(self):
+        return sorted(seconds for _, seconds, ok in self.recent() if ok)
+
+    @staticmethod
+    def quantile(latencies, share):
+        return latencies[min(len(latencies) - 1, int(share * len(latencies)))]
+
+
+class ModelRouter:
+    """Send chat completions to ``models`` with hedging and fallback.
+
+    post() and apost() take the request like LLMClient.post() and put each
+    model's id into the JSON body; they return the winning response (the
+    last failed one if no model answered) or raise the last error.
+    """
+
+    def __init__(self, models=None, provider_limits=None, provider_limit=PROVIDER_LIMIT, window=WINDOW,
+                 window_seconds=WINDOW_SECONDS, hedge_percentile=HEDGE_PERCENTILE, hedge_min_ms=HEDGE_MIN_MS,
+                 hedge_min_samples=HEDGE_MIN_SAMPLES, error_threshold=ERROR_THRESHOLD, slow_factor=SLOW_FACTOR,
+                 queue_timeout=llm_client.READ_TIMEOUT):
+        self.models = list(models or MODELS)
+        if not self.models:
+            raise ValueError("ModelRouter needs at least one model")
+        limits = PROVIDER_LIMITS if provider_limits is None else provider_limits
+        self.slots = {provider: ProviderSlots(limits.get(provider, provider_limit))
+                      for provider in {provider_of(model) for model in self.models}}
+        self.windows = {model: ModelWindow(window, window_seconds) for model in self.models}
+        self.breakers = {model: CircuitBreaker() for model in self.models}
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min = hedge_min_ms / 1000
+        self.hedge_min_samples = hedge_min_samples
+        self.error_threshold = error_threshold
+        self.slow_factor = slow_factor
+        self.queue_timeout = queue_timeout
+        # A single model gets the client's retries; with several, a failure
+        # moves on to the next model instead
+        self.retries = None if len(self.models) == 1 else 0
+
+        self.lock = threading.Lock()
+        self.counters = {model: {"ok": 0, "error": 0, "hedged": 0, "hedge_won": 0, "cancelled": 0,
+                                 "fallback": 0, "capped": 0}
+                         for model in self.models}
+        self._executor = None
+        self._executor_pid = None
+
+    def executor(self):
+        """Threads for sync attempts; enough for every provider to be at its cap."""
+        pid = os.getpid()
+        if self._executor is None or self._executor_pid != pid:
+            with self.lock:
+                if self._executor is None or self._executor_pid != pid:
+                    workers = sum(slots.limit for slots in self.slots.values())
+                    self._executor = ThreadPoolExecutor(workers, thread_name_prefix="llm-router")
+                    self._executor_pid = pid
+        return self._executor
+
+    # ---------------- model health ----------------
+
+    def ranked(self):
+        """Models in the order to try them: healthy, then slow, then failing."""
+        with self.lock:
+            medians = {}
+            for model, window in self.windows.items():
+                latencies = window.latencies()
+                if len(latencies) >= MIN_HEALTH_SAMPLES:
+                    medians[model] = window.quantile(latencies, 0.5)
+            failing = {model for model in self.models
+                       if self.breakers[model].state == "open"
+                       or self.windows[model].error_rate() > self.error_threshold}
+        fastest = min((medians[m] for m in medians if m not in failing), default=None)
+        slow = {model for model, median in medians.items()
+                if fastest is not None and median > fastest * self.slow_factor}
+        return sorted(self.models, key=lambda m: (m in failing, m in slow))
+
+    def hedge_after(self, model):
+        """Seconds to wait on ``model`` before hedging, or None to not hedge."""
+        if self.hedge_percentile <= 0:
+            return None
+        with self.lock:
+            latencies = self.windows[model].latencies()
+        if len(latencies) < self.hedge_min_samples:
+            return None
+        return max(self.hedge_min, ModelWindow.quantile(latencies, self.hedge_percentile / 100))
+
+    def record(self, model, seconds, ok):
+        with self.lock:
+            self.windows[model].add(seconds, ok)
+            self.counters[model]["ok" if ok else "error"] += 1
+        if metrics.ENABLED:
+            metrics.observe("krishi_llm_seconds", seconds, model=model, ok=str(ok).lower())
+
+    def count(self, model, outcome):
+        with self.lock:
+            self.counters[model][outcome] += 1
+        if metrics.ENABLED:
+            metrics.inc("krishi_llm_router_total", model=model, outcome=outcome)
+
+    def stats(self):
+        with self.lock:
+            models = {}
+            for model in self.models:
+                latencies = self.windows[model].latencies()
+                models[model] = {
+                    **self.counters[model],
+                    "breaker": self.breakers[model].state,
+                    "error_rate": round(self.windows[model].error_rate(), 3),
+                    "p50_ms": round(ModelWindow.quantile(latencies, 0.5) * 1000, 1) if latencies else None,
+                    "p95_ms": round(ModelWindow.quantile(latencies, 0.95) * 1000, 1) if latencies else None,
+                }
+            providers = {name: {"in_use": slots.in_use, "limit": slots.limit} for name, slots in self.slots.items()}
+        return {"order": self.ranked(), "models": models, "providers": providers}
+
+    @staticmethod
+    def succeeded(result):
+        return not isinstance(result, BaseException) and result.status_code == 200
+
+    def _plan(self):
+        """(ordered candidates, hedge delay for the first one)."""
+        candidates = self.ranked()
+        return candidates, self.hedge_after(candidates[0])
+
+    def _next_free(self, queue):
+        """Pop models off ``queue`` until one gets a provider slot; None if none does."""
+        while queue:
+            model = queue.pop(0)
+            if self.slots[provider_of(model)].try_acquire():
+                return model
+            self.count(model, "capped")
+        return None
+
+    # ---------------- sync ----------------
+
+    def post(self, url, headers=None, json=None, stream=False, hedge=True):
+        candidates, delay = self._plan()
+        if not hedge:
+            delay = None
+        queue = list(candidates)
+        pending = {}
+        started = time.monotonic()
+        hedged = False
+        last = None
+
+        def launch(model, outcome=None):
+            if outcome:
+                self.count(model, outcome)
+            release = self.slots[provider_of(model)].releaser()
+            future = self.executor().submit(self._attempt, model, release, url, headers, json, stream)
+            # A cancelled attempt that never started still holds its slot
+            future.add_done_callback(lambda f: f.cancelled() and release())
+            pending[future] = model
+
+        model = self._next_free(queue)
+        if model is None:
+            # Every provider is at its cap: wait for the preferred one
+            model = candidates[0]
+            if not self.slots[provider_of(model)].acquire(self.queue_timeout):
+                raise ProvidersBusyError("All LLM providers are at their concurrency cap")
+        launch(model)
+
+        while pending:
+            timeout = None
+            if delay is not None and not hedged:
+                timeout = max(0.0, started + delay - time.monotonic())
+            done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            if not done:
+                hedged = True
+                if not queue and len(self.models) == 1:
+                    queue.append(self.models[0])
+                target = self._next_free(queue)
+                if target is not None:
+                    launch(target, "hedged")
+                continue
+
+            winner = None
+            for future in done:
+                model = pending.pop(future)
+                result = future.exception() or future.result()
+                if winner is None and self.succeeded(result):
+                    winner = (model, result)
+                else:
+                    # Keep the latest failure open for the caller to inspect
+                    if last is not None:
+                        self._discard(last)
+                    last = result
+            if winner is not None:
+                model, response = winner
+                if last is not None:
+                    self._discard(last)
+                if hedged and len(pending) + len(done) > 1:
+                    self.count(model, "hedge_won")
+                for future in pending:
+                    self.count(pending[future], "cancelled")
+                    if not future.cancel():
+                        future.add_done_callback(lambda f: self._discard(f.exception() or f.result()))
+                return response
+
+            if not pending:
+                target = self._next_free(queue)
+                if target is not None:
+                    launch(target, "fallback")
+
+        if isinstance(last, BaseException):
+            raise last
+        return last
+
+    def _attempt(self, model, release, url, headers, json, stream):
+        client = llm_client.get_client()
+        started = time.monotonic()
+        try:
+            response = client.post(url, headers=headers, json={**(json or {}), "model": model}, stream=stream,
+                                   breaker=self.breakers[model], max_retries=self.retries)
+        except Exception:
+            self.record(model, time.monotonic() - started, False)
+            release()
+            raise
+        ok = response.status_code == 200
+        self.record(model, time.monotonic() - started, ok)
+        if stream and ok:
+            # Hold the provider slot until the caller has read the stream
+            close = response.close
+
+            def close_and_release():
+                try:
+                    close()
+                finally:
+                    release()
+            response.close = close_and_release
+        else:
+            release()
+        return response
+
+    @staticmethod
+    def _discard(result):
+        if not isinstance(result, BaseException):
+            result.close()
+
+    # ---------------- async ----------------
+
+    async def apost(self, url, headers=None, json=None, stream=False, hedge=True):
+        candidates, delay = self._plan()
+        if not hedge:
+            delay = None
+        queue = list(candidates)
+        pending = {}
+        started = time.monotonic()
+        hedged = False
+        last = None
+
+        def launch(model, outcome=None):
+            if outcome:
+                self.count(model, outcome)
+            release = self.slots[provider_of(model)].releaser()
+            task = asyncio.ensure_future(self._aattempt(model, release, url, headers, json, stream))
+            task.add_done_callback(lambda t: t.cancelled() and release())
+            pending[task] = model
+
+        model = self._next_free(queue)
+        if model is None:
+            model = candidates[0]
+            slots = self.slots[provider_of(model)]
+            deadline = time.monotonic() + self.queue_timeout
+            while not slots.try_acquire():
+                if time.monotonic() >= deadline:
+                    raise ProvidersBusyError("All LLM providers are at their concurrency cap")
+                await asyncio.sleep(SLOT_POLL_SECONDS)
+        launch(model)
+
+        try:
+            while pending:
+                timeout = None
+                if delay is not None and not hedged:
+                    timeout = max(0.0, started + delay - time.monotonic())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    if not queue and len(self.models) == 1:
+                        queue.append(self.models[0])
+                    target = self._next_free(queue)
+                    if target is not None:
+                        launch(target, "hedged")
+                    continue
+
+                winner = None
+                for task in done:
+                    model = pending.pop(task)
+                    result = task.exception() or task.result()
+                    if winner is None and self.succeeded(result):
+                        winner = (model, result)
+                    else:
+                        if last is not None:
+                            await self._adiscard(last)
+                        last = result
+                if winner is not None:
+                    model, response = winner
+                    if last is not None:
+                        await self._adiscard(last)
+                    if hedged and len(pending) + len(done) > 1:
+                        self.count(model, "hedge_won")
+                    return response
+
+                if not pending:
+                    target = self._next_free(queue)
+                    if target is not None:
+                        launch(target, "fallback")
+        finally:
+            for task, model in pending.items():
+                self.count(model, "cancelled")
+                if not task.cancel():
+                    # Finished before we got to it: close the response it holds
+                    task.add_done_callback(
+                        lambda t: t.exception() or asyncio.ensure_future(self._adiscard(t.result())))
+
+        if isinstance(last, BaseException):
+            raise last
+        return last
+
+    async def _aattempt(self, model, release, url, headers, json, stream):
+        client = llm_client.get_async_client()
+        started = time.monotonic()
+        try:
+            response = await client.post(url, headers=headers, json={**(json or {}), "model": model},
+                                         stream=stream, breaker=self.breakers[model], max_retries=self.retries)
+        except asyncio.CancelledError:
+            release()
+            raise
+        except Exception:
+            self.record(model, time.monotonic() - started, False)
+            release()
+            raise
+        ok = response.status_code == 200
+        self.record(model, time.monotonic() - started, ok)
+        if stream and ok:
+            aclose = response.aclose
+
+            async def aclose_and_release():
+                try:
+                    await aclose()
+                finally:
+                    release()
+            response.aclose = aclose_and_release
+        else:
+            release()
+        return response
+
+    @staticmethod
+    async def _adiscard(result):
+        if not isinstance(result, BaseException):
+            await result.aclose()
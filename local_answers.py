@@ -0,0 +1,393 @@
+"""Offline answers from a local index of questions answered before.
+
+Most questions farmers ask have been asked, and answered, many times. An
+FTS5 table keeps question/answer pairs from two sources:
+
+* the curated knowledge base in knowledge/*.json, each entry written in
+  Kannada, Hindi and English (there are no Telugu, Malayalam or Tamil
+  entries yet: those prompts only ever get the English fallback, and their
+  words aren't in STOPWORDS or ENTITY_TERMS either);
+* questions several farmers opened a chat session with, word for word
+  after reply_cache.normalize_prompt(), with the latest answer given.
+
+A lookup lets bm25 pick a few candidates by word stems, then scores each by
+how well its question overlaps the prompt (an F1 over words, inflected forms
+matched by their common prefix). Word overlap can't tell crops, pests or
+inputs apart ("urea for paddy" reads much like "urea for sugarcane"), so
+before scoring, a candidate must agree with the prompt on them: every entity
+a knowledge base entry lists (a crop, pest or input, with its synonyms) must
+be in the prompt, and every ENTITY_TERMS word of the prompt must be one the
+entry knows. A history entry's entities are the ENTITY_TERMS words of its
+question. A confident answer also needs a prompt word beyond the entities
+("dose", "yellow"), so "paddy urea" alone is left to the model. At
+LOCAL_CONFIDENCE or above the local answer is served without calling the
+model. When the model can't be reached, anything at
+LOCAL_FALLBACK_CONFIDENCE or above is served instead of the "try again
+later" message, in English if nothing in the farmer's own language is close
+enough. A lookup takes a millisecond or two.
+
+    LOCAL_ANSWERS_ENABLED      "0" disables the index (default "1")
+    LOCAL_KNOWLEDGE_DIR        directory of knowledge base files (default knowledge/)
+    LOCAL_CONFIDENCE           score needed to answer before asking the model (default 0.75)
+    LOCAL_FALLBACK_CONFIDENCE  score needed to answer when the model is unavailable (default 0.7)
+    LOCAL_HISTORY_MIN_USERS    distinct users who must have asked a question before its
+                               answer is reused (default 3, 0 leaves history out)
+    LOCAL_HISTORY_INTERVAL     seconds between history harvests (default 3600)
+    LOCAL_HISTORY_ASYNC        "0" leaves harvesting to ``flask --app app local-index``
+                               (default "1", "0" on Vercel where background threads are
+                               frozen once the response is sent)
+"""
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import metrics
+from reply_cache import normalize_prompt
+
+ENABLED = os.getenv("LOCAL_ANSWERS_ENABLED", "1") == "1"
+KNOWLEDGE_DIR = os.getenv("LOCAL_KNOWLEDGE_DIR",
+                          os.path.join(os.path.dirname(os.path.abspath(__file__)), "knowledge"))
+CONFIDENCE = float(os.getenv("LOCAL_CONFIDENCE", "0.75"))
+FALLBACK_CONFIDENCE = float(os.getenv("LOCAL_FALLBACK_CONFIDENCE", "0.7"))
+HISTORY_MIN_USERS = int(os.getenv("LOCAL_HISTORY_MIN_USERS", "3"))
+HISTORY_INTERVAL = float(os.getenv("LOCAL_HISTORY_INTERVAL", "3600"))
+ASYNC = os.getenv("LOCAL_HISTORY_ASYNC", "0" if os.getenv("VERCEL") == "1" else "1") == "1"
+
+# Candidates bm25 hands to the overlap scoring
+CANDIDATES = 20
+# Most recent first messages a harvest looks at, and history entries kept
+HISTORY_SCAN_ROWS = 50000
+HISTORY_MAX_ENTRIES = 2000
+# Words sharing at least this many leading characters (and all but the last
+# character of the shorter one) count as the same word: "leaf"/"leaves",
+# "ಎಲೆ"/"ಎಲೆಗಳು", "धान"/"धानों"
+MIN_PREFIX = 3
+# Stems sent to the index; short so inflected forms are still candidates
+STEM_CHARS = 4
+
+# Question words and fillers that say nothing about the topic
+STOPWORDS = frozenset("""
+    a an the is are am was were be been to of for in on at by with and or not no my i me we our
+    you your it its this that these those what which how why when where who whom do does did can
+    could should would will shall may much many per please tell about give need want from some
+    any there have has had get use
+    का की के है हैं था थे में से को पर और या क्या कैसे कब कहां कहाँ क्यों कौन कितना कितनी कितने
+    करें करना करे कर मेरे मेरी मेरा हम मैं हो रहे रही रहा भी यह वह ये वो लिए जी प्रति बताएं बताइए
+    ನನ್ನ ನಮ್ಮ ಏನು ಹೇಗೆ ಯಾವಾಗ ಎಲ್ಲಿ ಯಾಕೆ ಏಕೆ ಎಷ್ಟು ಯಾವ ಮಾಡಬೇಕು ಬೇಕು ಮತ್ತು ಅಥವಾ ಇದೆ ಇವೆ
+    ದಯವಿಟ್ಟು ತಿಳಿಸಿ ಹೇಳಿ ಮಾಡುವುದು ಮಾಡಿಸಬೇಕು
+""".split())
+
+# Crops, pests and inputs: an answer about one of them is wrong for another
+# however alike the two questions read
+ENTITY_TERMS = frozenset("""
+    paddy rice wheat maize corn tomato chilli chili brinjal potato onion cotton sugarcane groundnut
+    peanut soybean mustard ragi millet jowar bajra banana coconut arecanut mango grapes turmeric
+    urea dap potash npk nitrogen phosphorus potassium zinc sulphur gypsum
+    aphids whitefly armyworm bollworm thrips mites stemborer neem
+    धान चावल गेहूं मक्का टमाटर मिर्च बैंगन आलू प्याज कपास गन्ना मूंगफली सोयाबीन सरसों बाजरा ज्वार केला नारियल
+    यूरिया डीएपी पोटाश नाइट्रोजन फास्फोरस जिंक सल्फर माहू एफिड आर्मीवर्म नीम
+    ಭತ್ತ ಗೋಧಿ ಮೆಕ್ಕೆಜೋಳ ಟೊಮೆಟೊ ಮೆಣಸಿನಕಾಯಿ ಬದನೆ ಆಲೂಗಡ್ಡೆ ಈರುಳ್ಳಿ ಹತ್ತಿ ಕಬ್ಬು ಶೇಂಗಾ ರಾಗಿ ಬಾಳೆ ತೆಂಗು ಅಡಿಕೆ
+    ಯೂರಿಯಾ ಡಿಎಪಿ ಪೊಟ್ಯಾಷ್ ಸಾರಜನಕ ಸತು ಸಸ್ಯಹೇನು ಬಿಳಿನೊಣ ಬೇವಿನ
+""".split())
+
+
+def content_terms(text):
+    """Distinct normalized words of ``text`` without stopwords, in order."""
+    seen = []
+    for word in normalize_prompt(text or "").split():
+        if len(word) > 1 and word not in STOPWORDS and word not in seen:
+            seen.append(word)
+    return seen
+
+
+def same_word(a, b):
+    if a == b:
+        return True
+    shared = len(os.path.commonprefix((a, b)))
+    return shared >= max(MIN_PREFIX, min(len(a), len(b)) - 1)
+
+
+def overlap_score(query, question, keywords=()):
+    """F1 of the word overlap between a prompt and a known question.
+
+    Recall is the share of the prompt's words found in the question or its
+    keywords; precision the share of the question's words found in the
+    prompt, so "tomato" alone doesn't claim the whole leaf curl answer.
+    """
+    if not query or not question:
+        return 0.0
+    known = list(question) + list(keywords)
+    recall = sum(1 for word in query if any(same_word(word, other) for other in known)) / len(query)
+    precision = sum(1 for word in question if any(same_word(word, other) for other in query)) / len(question)
+    if not recall or not precision:
+        return 0.0
+    return 2 * recall * precision / (recall + precision)
+
+
+def entity_terms(words):
+    return [word for word in words if any(same_word(word, term) for term in ENTITY_TERMS)]
+
+
+def entities_agree(query, groups, known):
+    """Whether a prompt names what an answer is about, and nothing else.
+
+    Each group of synonyms in ``groups`` needs one of its words in the
+    prompt, and each crop, pest or input the prompt names must be among
+    ``known``, the words of the answer's question, keywords and groups.
+    """
+    for group in groups:
+        if not any(same_word(word, synonym) for word in query for synonym in group):
+            return False
+    return all(any(same_word(word, other) for other in known) for word in entity_terms(query))
+
+
+def stem(word):
+    if len(word) <= MIN_PREFIX:
+        return word
+    return word[:max(MIN_PREFIX, min(STEM_CHARS, len(word) - 1))]
+
+
+class LocalAnswers:
+    """Knowledge base and frequently asked questions, answered without the model.
+
+    ``connect`` returns the sqlite3 connection to use (see db.get_connection).
+    ``skip_reply(text)`` tells stand-in replies (error messages) apart so
+    they are never harvested as answers.
+    """
+
+    def __init__(self, connect, knowledge_dir=KNOWLEDGE_DIR, confidence=CONFIDENCE,
+                 fallback_confidence=FALLBACK_CONFIDENCE, history_min_users=HISTORY_MIN_USERS,
+                 interval=HISTORY_INTERVAL, run_async=ASYNC, skip_reply=None):
+        self.connect = connect
+        self.knowledge_dir = knowledge_dir
+        self.confidence = confidence
+        self.fallback_confidence = fallback_confidence
+        self.history_min_users = history_min_users
+        self.interval = interval
+        self.run_async = run_async
+        self.skip_reply = skip_reply or (lambda reply: False)
+
+        self.lock = threading.Lock()
+        self.loaded = False
+        # (entry id, lang): entity synonym groups of the knowledge base entries
+        self.entities = {}
+        self.thread = None
+        self.thread_pid = None
+        self.last_harvest = None
+        self.counters = {"hits": 0, "misses": 0, "fallbacks": 0, "fallback_misses": 0, "errors": 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    # ---------------- indexing ----------------
+
+    def _meta(self, conn, key):
+        row = conn.execute("SELECT value FROM local_answers_meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def load_knowledge(self, force=False):
+        """Index the knowledge base files unless the indexed copy is current.
+
+        Returns the number of entries indexed, or None when nothing changed.
+        """
+        files = []
+        if os.path.isdir(self.knowledge_dir):
+            files = sorted(name for name in os.listdir(self.knowledge_dir) if name.endswith(".json"))
+        digest = hashlib.sha256()
+        contents = []
+        for name in files:
+            with open(os.path.join(self.knowledge_dir, name), "rb") as f:
+                data = f.read()
+            digest.update(name.encode("utf-8") + b"\0" + data)
+            contents.append(data)
+        digest = digest.hexdigest()
+
+        rows = []
+        entities = {}
+        for data in contents:
+            for entry in json.loads(data):
+                lang = entry.get("lang", "en")
+                rows.append((normalize_prompt(entry["question"]), normalize_prompt(entry.get("keywords", "")),
+                             entry["answer"], lang, entry.get("id")))
+                groups = [content_terms(group) for group in entry.get("entities", "").split(",")]
+                entities[(entry.get("id"), lang)] = [group for group in groups if group]
+        # Kept in memory, so every process has them even when another one indexed the files
+        self.entities = entities
+
+        conn = self.connect()
+        if not force and self._meta(conn, "knowledge_digest") == digest:
+            return None
+        with conn:
+            conn.execute("DELETE FROM local_answers WHERE source = 'kb'")
+            conn.executemany('''INSERT INTO local_answers (question, keywords, answer, lang, source, ref)
+                                VALUES (?, ?, ?, ?, 'kb', ?)''', rows)
+            conn.execute("INSERT OR REPLACE INTO local_answers_meta (key, value) VALUES ('knowledge_digest', ?)",
+                         (digest,))
+        logging.info(f"Indexed {len(rows)} knowledge base answers from {self.knowledge_dir}")
+        return len(rows)
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        with self.lock:
+            if self.loaded:
+                return
+            try:
+                self.load_knowledge()
+            except (OSError, ValueError, KeyError, sqlite3.Error) as e:
+                logging.error(f"Loading the knowledge base failed: {e}")
+            self.loaded = True
+
+    def harvest(self, force=False):
+        """Replace the history entries with questions enough users asked.
+
+        Only the first message of a text session counts, since a follow-up
+        depends on what came before it; the latest real answer is kept.
+        Workers share the table, so a harvest another process ran less than
+        an interval ago is not repeated unless ``force`` is set. Returns the
+        number of entries indexed, or None when skipped.
+        """
+        if self.history_min_users <= 0:
+            return None
+        conn = self.connect()
+        harvested_at = self._meta(conn, "history_harvested_at")
+        if not force and harvested_at and time.time() - float(harvested_at) < self.interval:
+            return None
+
+        curated = {answer for (answer,) in conn.execute("SELECT answer FROM local_answers WHERE source = 'kb'")}
+        rows = conn.execute('''SELECT m.id, s.username, m.message_text, m.response_text, m.language
+                               FROM chat_messages m JOIN chat_sessions s ON s.id = m.session_id
+                               WHERE m.message_type = 'text'
+                                 AND m.id = (SELECT MIN(id) FROM chat_messages WHERE session_id = m.session_id)
+                               ORDER BY m.id DESC LIMIT ?''', (HISTORY_SCAN_ROWS,)).fetchall()
+        groups = {}
+        for message_id, username, question, answer, lang in rows:
+            if not question or not answer or answer in curated or self.skip_reply(answer):
+                continue
+            normalized = normalize_prompt(question)
+            if not normalized:
+                continue
+            group = groups.setdefault((lang or "en", normalized), {"users": set(), "latest": None})
+            group["users"].add(username)
+            # Rows come newest first
+            if group["latest"] is None:
+                group["latest"] = (message_id, answer)
+
+        popular = sorted(((len(group["users"]), key, group["latest"]) for key, group in groups.items()
+                          if len(group["users"]) >= self.history_min_users), reverse=True)[:HISTORY_MAX_ENTRIES]
+        with conn:
+            conn.execute("DELETE FROM local_answers WHERE source = 'history'")
+            conn.executemany('''INSERT INTO local_answers (question, keywords, answer, lang, source, ref)
+                                VALUES (?, '', ?, ?, 'history', ?)''',
+                             [(question, answer, lang, str(message_id))
+                              for _, (lang, question), (message_id, answer) in popular])
+            conn.execute("INSERT OR REPLACE INTO local_answers_meta (key, value) VALUES ('history_harvested_at', ?)",
+                         (str(time.time()),))
+        self.last_harvest = {"finished": time.time(), "scanned": len(rows), "entries": len(popular)}
+        logging.info(f"Harvested {len(popular)} frequently asked questions from {len(rows)} sessions")
+        return len(popular)
+
+    # ---------------- scheduling ----------------
+
+    def start(self):
+        """Make sure this process has a harvester thread (no-op when not async)."""
+        if not self.run_async or self.history_min_users <= 0 or self.thread_pid == os.getpid():
+            return
+        # Threads don't survive a fork, so start the harvester lazily in each worker process
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread = threading.Thread(target=self._run, name="local-answers", daemon=True)
+            self.thread.start()
+            self.thread_pid = os.getpid()
+
+    def _run(self):
+        while True:
+            try:
+                self.harvest()
+            except Exception as e:
+                logging.error(f"Local answer harvest failed: {e}")
+            time.sleep(self.interval)
+
+    # ---------------- lookup ----------------
+
+    @metrics.timed("local_answer")
+    def lookup(self, prompt, lang, min_score, fallback_lang=None, require_topic=False):
+        """The best known answer scoring ``min_score`` or more, as (score, answer).
+
+        Only answers whose entities agree with the prompt count; with
+        ``require_topic`` the prompt must also share a word with the answer
+        other than those. An answer in ``fallback_lang`` is only taken when
+        nothing in ``lang`` qualifies. Returns None when nothing does.
+        """
+        self._ensure_loaded()
+        query = content_terms(prompt)
+        if not query:
+            return None
+        stems = dict.fromkeys(stem(word) for word in query)
+        match = "{question keywords} : (" + " OR ".join('"' + s.replace('"', '""') + '"*' for s in stems) + ")"
+        langs = [lang] + ([fallback_lang] if fallback_lang and fallback_lang != lang else [])
+        placeholders = ", ".join("?" for _ in langs)
+        rows = self.connect().execute(
+            f'''SELECT question, keywords, answer, lang, source, ref FROM local_answers
+                WHERE local_answers MATCH ? AND lang IN ({placeholders})
+                ORDER BY bm25(local_answers, 2.0, 1.0) LIMIT ?''',
+            [match, *langs, CANDIDATES]).fetchall()
+
+        named = set(entity_terms(query))
+        best = {}
+        for question, keywords, answer, row_lang, source, ref in rows:
+            terms, keys = content_terms(question), content_terms(keywords)
+            if source == "kb":
+                groups = self.entities.get((ref, row_lang), [])
+            else:
+                groups = [[word] for word in entity_terms(terms)]
+            known = terms + keys + [word for group in groups for word in group]
+            if not entities_agree(query, groups, known):
+                continue
+            if require_topic and not any(word not in named and any(same_word(word, other) for other in known)
+                                         for word in query):
+                continue
+            score = overlap_score(query, terms, keys)
+            if score >= min_score and score > best.get(row_lang, (0.0, None))[0]:
+                best[row_lang] = (score, answer)
+        for candidate_lang in langs:
+            if candidate_lang in best:
+                return best[candidate_lang]
+        return None
+
+    def _find(self, prompt, lang, min_score, fallback_lang=None, require_topic=False):
+        try:
+            return self.lookup(prompt, lang, min_score, fallback_lang, require_topic)
+        except sqlite3.Error as e:
+            # The index only ever saves a model call; never fail a reply over it
+            logging.error(f"Local answer lookup failed: {e}")
+            self._count("errors")
+            return None
+
+    def answer(self, prompt, lang):
+        """A confident local answer to ``prompt``, or None to ask the model."""
+        found = self._find(prompt, lang, self.confidence, require_topic=True)
+        self._count("hits" if found else "misses")
+        return found[1] if found else None
+
+    def fallback(self, prompt, lang):
+        """The closest local answer for when the model is unavailable, or None."""
+        found = self._find(prompt, lang, self.fallback_confidence, fallback_lang="en")
+        self._count("fallbacks" if found else "fallback_misses")
+        return found[1] if found else None
+
+    def stats(self):
+        try:
+            entries = dict(self.connect().execute(
+                "SELECT source, COUNT(*) FROM local_answers GROUP BY source").fetchall())
+        except sqlite3.Error:
+            entries = {}
+        with self.lock:
+            return {**self.counters, "entries": entries, "last_harvest": self.last_harvest,
+                    "confidence": self.confidence, "fallback_confidence": self.fallback_confidence}
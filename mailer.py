@@ -0,0 +1,219 @@
+"""Outbox-based email delivery.
+
+Requests never talk to the SMTP server. They insert a row into the
+email_outbox table and return; a background sender thread drains the
+outbox over one authenticated SMTP connection that is kept open and
+reused across messages. Failed sends are retried with exponential backoff,
+and sending is rate limited so a burst of registrations doesn't get the
+account throttled.
+
+    EMAIL_RATE_PER_MINUTE  messages sent per minute at most (default 20)
+    EMAIL_MAX_ATTEMPTS     attempts before a message is marked failed (default 6)
+    EMAIL_IDLE_SECONDS     idle time before the SMTP connection is closed (default 60)
+    EMAIL_ASYNC            "0" sends inline in the request (default "1", "0" on Vercel
+                           where background threads are frozen once the response is sent)
+"""
+import logging
+import os
+import threading
+import time
+
+import metrics
+
+RATE_PER_MINUTE = float(os.getenv("EMAIL_RATE_PER_MINUTE", "20"))
+MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "6"))
+IDLE_SECONDS = float(os.getenv("EMAIL_IDLE_SECONDS", "60"))
+ASYNC = os.getenv("EMAIL_ASYNC", "0" if os.getenv("VERCEL") == "1" else "1") == "1"
+
+BACKOFF_BASE = 30
+BACKOFF_MAX = 3600
+POLL_SECONDS = 5
+# A row left in 'sending' this long belongs to a sender that died mid-send
+STALE_CLAIM_SECONDS = 300
+
+
+class Outbox:
+    """Queue of outgoing emails plus the sender that delivers them.
+
+    ``connect`` returns the sqlite3 connection to use (see db.get_connection).
+    """
+
+    def __init__(self, connect, sender, password, server, port, starttls=True,
+                 rate_per_minute=RATE_PER_MINUTE, max_attempts=MAX_ATTEMPTS,
+                 idle_seconds=IDLE_SECONDS, run_async=ASYNC):
+        self.connect = connect
+        self.sender = sender
+        self.password = password
+        self.server = server
+        self.port = port
+        self.starttls = starttls
+        self.interval = 60.0 / rate_per_minute if rate_per_minute > 0 else 0.0
+        self.max_attempts = max_attempts
+        self.idle_seconds = idle_seconds
+        self.run_async = run_async
+
+        self.smtp = None
+        self.last_used = 0.0
+        self.last_sent = 0.0
+        self.wakeup = threading.Event()
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        self.thread = None
+        self.thread_pid = None
+
+    @property
+    def configured(self):
+        return bool(self.sender and self.password)
+
+    def enqueue(self, recipient, subject, html):
+        """Store a message for delivery and return its outbox id."""
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            cursor = conn.execute('''INSERT INTO email_outbox
+                                     (recipient, subject, body_html, status, attempts, next_attempt_at, created_at)
+                                     VALUES (?, ?, ?, 'pending', 0, ?, ?)''',
+                                  (recipient, subject, html, now, now))
+        outbox_id = cursor.lastrowid
+
+        if self.run_async:
+            self._start_sender()
+            self.wakeup.set()
+        else:
+            self.drain()
+        return outbox_id
+
+    def _start_sender(self):
+        # Threads don't survive a fork, so start the sender lazily in each worker process
+        pid = os.getpid()
+        with self.lock:
+            if self.thread_pid == pid:
+                return
+            self.smtp = None
+            self.thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+            self.thread.start()
+            self.thread_pid = pid
+
+    def _run(self):
+        while True:
+            try:
+                self.drain()
+            except Exception as e:
+                logging.error(f"Email outbox sender error: {e}")
+            self.wakeup.wait(POLL_SECONDS)
+            self.wakeup.clear()
+            with self.send_lock:
+                if self.smtp is not None and time.monotonic() - self.last_used > self.idle_seconds:
+                    self._disconnect()
+
+    def drain(self):
+        """Send every message that is due. Returns the number sent."""
+        sent = 0
+        with self.send_lock:
+            while True:
+                row = self._claim()
+                if row is None:
+                    return sent
+                if self._deliver(row):
+                    sent += 1
+
+    def _claim(self):
+        """Atomically take the next due message, or None."""
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            conn.execute('''UPDATE email_outbox SET status = 'pending'
+                            WHERE status = 'sending' AND claimed_at < ?''', (now - STALE_CLAIM_SECONDS,))
+            row = conn.execute('''SELECT id, recipient, subject, body_html, attempts FROM email_outbox
+                                  WHERE status = 'pending' AND next_attempt_at <= ?
+                                  ORDER BY next_attempt_at LIMIT 1''', (now,)).fetchone()
+            if row is None:
+                return None
+            claimed = conn.execute('''UPDATE email_outbox SET status = 'sending', claimed_at = ?
+                                      WHERE id = ? AND status = 'pending' ''', (now, row[0])).rowcount
+        return row if claimed else self._claim()
+
+    def _deliver(self, row):
+        outbox_id, recipient, subject, html, attempts = row
+        self._throttle()
+        try:
+            self._send(recipient, subject, html)
+        except Exception as e:
+            metrics.count_error(type(e).__name__, "email")
+            self._disconnect()
+            attempts += 1
+            if attempts >= self.max_attempts:
+                status, next_attempt_at = "failed", None
+                logging.error(f"Giving up on email {outbox_id} to {recipient}: {e}")
+            else:
+                status = "pending"
+                next_attempt_at = time.time() + min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempts - 1)))
+                logging.warning(f"Email {outbox_id} to {recipient} failed, retrying: {e}")
+            conn = self.connect()
+            with conn:
+                conn.execute('''UPDATE email_outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?
+                                WHERE id = ?''', (status, attempts, next_attempt_at, str(e), outbox_id))
+            return False
+
+        conn = self.connect()
+        with conn:
+            conn.execute('''UPDATE email_outbox SET status = 'sent', attempts = ?, sent_at = ?, last_error = NULL
+                            WHERE id = ?''', (attempts + 1, time.time(), outbox_id))
+        logging.info(f"Email {outbox_id} sent to {recipient}")
+        return True
+
+    def _throttle(self):
+        wait = self.last_sent + self.interval - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self.last_sent = time.monotonic()
+
+    def _send(self, recipient, subject, html):
+        if not self.configured:
+            raise RuntimeError("EMAIL_ADDRESS/EMAIL_PASSWORD are not configured.")
+
+        # Imported here: most processes never send a mail, so don't pay for it at startup
+        import smtplib
+        from email.mime.multipart import MIMEMultipart
+        from email.mime.text import MIMEText
+
+        msg = MIMEMultipart()
+        msg['From'] = self.sender
+        msg['To'] = recipient
+        msg['Subject'] = subject
+        msg.attach(MIMEText(html, 'html'))
+
+        try:
+            self._connection().send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped the idle connection; reconnect once
+            self._disconnect()
+            self._connection().send_message(msg)
+        self.last_used = time.monotonic()
+
+    def _connection(self):
+        """Return the open SMTP connection, connecting and logging in if needed."""
+        if self.smtp is not None:
+            return self.smtp
+
+        import smtplib
+
+        smtp = smtplib.SMTP(self.server, self.port, timeout=30)
+        if self.starttls:
+            smtp.starttls()
+        smtp.login(self.sender, self.password)
+        self.smtp = smtp
+        return smtp
+
+    def _disconnect(self):
+        smtp, self.smtp = self.smtp, None
+        if smtp is not None:
+            try:
+                smtp.quit()
+            except Exception:
+                pass
+
+    def stats(self):
+        conn = self.connect()
+        counts = dict(conn.execute("SELECT status, COUNT(*) FROM email_outbox GROUP BY status").fetchall())
+        return {status: counts.get(status, 0) for status in ("pending", "sending", "sent", "failed")}
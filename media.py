@@ -0,0 +1,114 @@
+"""Serving of write-once media files: voices and uploads.
+
+Voice and upload files never change once written (their names are content
+hashes, or random for old voices), so responses carry a strong ETag built
+from the name and size, and ``Cache-Control: public, max-age=..., immutable``.
+Browsers replay audio from their cache without asking again. Byte ranges
+are honoured so the audio player can seek. With MEDIA_SENDFILE set, Python
+only checks the request and hands the file to the front proxy, which sends
+the bytes (and serves ranges) without tying up a worker.
+
+Paths are resolved against the working directory, like the code that writes
+the files, so media is found wherever UPLOADS_DIR and VOICES_DIR point (for
+example /tmp on Vercel).
+
+    MEDIA_MAX_AGE       seconds clients may keep a file (default one year)
+    MEDIA_SENDFILE      "" sends files from Python (default), "x-sendfile" passes
+                        the absolute path to the proxy (Apache mod_xsendfile,
+                        lighttpd), "x-accel-redirect" passes an internal URI (nginx)
+    MEDIA_ACCEL_PREFIX  internal nginx location for x-accel-redirect (default
+                        "/_media"), mapped per kind, e.g.
+                        location /_media/voices/ { internal; alias /srv/krishi/static/voices/; }
+"""
+import mimetypes
+import os
+import threading
+
+from flask import Response, request, send_file
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+MAX_AGE = int(os.getenv("MEDIA_MAX_AGE", str(365 * 24 * 3600)))
+SENDFILE = os.getenv("MEDIA_SENDFILE", "").strip().lower()
+ACCEL_PREFIX = os.getenv("MEDIA_ACCEL_PREFIX", "/_media").rstrip("/")
+
+SENDFILE_MODES = ("", "x-sendfile", "x-accel-redirect")
+if SENDFILE not in SENDFILE_MODES:
+    raise ValueError(f"MEDIA_SENDFILE must be one of {SENDFILE_MODES[1:]} or empty, not {SENDFILE!r}")
+
+
+class MediaDirectory:
+    """Serve the files of one directory as immutable, range-capable responses.
+
+    ``kind`` names the directory in X-Accel-Redirect URIs and in stats.
+    """
+
+    def __init__(self, directory, kind, max_age=MAX_AGE, sendfile=SENDFILE, accel_prefix=ACCEL_PREFIX):
+        self.directory = os.path.abspath(directory)
+        self.kind = kind
+        self.max_age = max_age
+        self.sendfile = sendfile
+        self.accel_prefix = accel_prefix
+        self.lock = threading.Lock()
+        self.counters = {"full": 0, "partial": 0, "not_modified": 0, "offloaded": 0, "missing": 0}
+
+    def path(self, filename):
+        """Absolute path of ``filename``, or None if it would leave the directory."""
+        return safe_join(self.directory, filename)
+
+    def exists(self, filename):
+        path = self.path(filename)
+        return path is not None and os.path.isfile(path)
+
+    def send(self, filename):
+        """Response for GET ``filename``; raises NotFound if there is no such file."""
+        path = self.path(filename)
+        try:
+            size = os.stat(path).st_size if path else None
+        except OSError:
+            size = None
+        if size is None:
+            self._count("missing")
+            raise NotFound()
+
+        etag = f"{filename}-{size:x}"
+        if self.sendfile:
+            response = self._offload(filename, path)
+            response.set_etag(etag)
+            self._cache_forever(response)
+            # Answer revalidations here; everything else is left to the proxy
+            response = response.make_conditional(request)
+        else:
+            response = send_file(path, etag=etag, max_age=self.max_age, conditional=True)
+            self._cache_forever(response)
+
+        if response.status_code == 304:
+            self._count("not_modified")
+        elif self.sendfile:
+            self._count("offloaded")
+        else:
+            self._count("partial" if response.status_code == 206 else "full")
+        return response
+
+    def _offload(self, filename, path):
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        response = Response(mimetype=mimetype)
+        if self.sendfile == "x-sendfile":
+            response.headers["X-Sendfile"] = path
+        else:
+            response.headers["X-Accel-Redirect"] = f"{self.accel_prefix}/{self.kind}/{filename}"
+        return response
+
+    def _cache_forever(self, response):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = self.max_age
+        response.cache_control.immutable = True
+
+    def _count(self, key):
+        with self.lock:
+            self.counters[key] += 1
+
+    def stats(self):
+        with self.lock:
+            return {"kind": self.kind, "sendfile": self.sendfile or None, **self.counters}
@@ -0,0 +1,274 @@
+"""Request instrumentation: latency histograms, gauges and error counters.
+
+Hot-path functions are wrapped with timed() or stage(). Each observation
+lands in a histogram that /metrics serves in the Prometheus text format
+and, for the request being handled, in its Server-Timing header. Stage
+timing can be sampled: only METRICS_SAMPLE_RATE of requests (and of
+background calls) time their stages, while request latency, in-flight
+gauges and error counters are always kept since they cost next to nothing.
+Metrics live in process memory, so every gunicorn worker reports its own.
+
+    METRICS_ENABLED        "0" turns all instrumentation into no-ops (default "1")
+    METRICS_SAMPLE_RATE    share of requests whose stages are timed (default 1.0)
+    METRICS_SERVER_TIMING  "0" leaves out the Server-Timing header (default "1")
+"""
+import bisect
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "1.0"))
+SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "1") == "1"
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+HELP = {
+    "krishi_request_seconds": "Request latency by route, method and status.",
+    "krishi_stage_seconds": "Time spent in instrumented stages (sampled).",
+    "krishi_requests_in_flight": "Requests currently being handled.",
+    "krishi_errors_total": "Errors by type and where they happened.",
+    "krishi_llm_seconds": "LLM call latency by model and outcome.",
+    "krishi_llm_router_total": "LLM router decisions (hedged, fallback, capped, ...) by model.",
+}
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_callbacks = {}
+
+# Stage timings of the request being handled: a dict when it is sampled,
+# False when it isn't, None outside of a request
+_request_stages = contextvars.ContextVar("request_stages", default=None)
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def observe(name, seconds, **labels):
+    key = _key(name, labels)
+    index = bisect.bisect_left(BUCKETS, seconds)
+    with _lock:
+        series = _histograms.get(key)
+        if series is None:
+            # Per-bucket counts (the last one is +Inf), then sum and count
+            series = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0, 0]
+        series[index] += 1
+        series[-2] += seconds
+        series[-1] += 1
+
+
+def inc(name, amount=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def gauge_add(name, delta, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def register_gauge(name, callback, help_text):
+    """Report ``callback()`` as a gauge every time metrics are rendered."""
+    HELP[name] = help_text
+    _callbacks[name] = callback
+
+
+def count_error(error_type, source):
+    if ENABLED:
+        inc("krishi_errors_total", type=error_type, source=source)
+
+
+@contextmanager
+def stage(name):
+    """Time the enclosed block as stage ``name`` if this request is sampled."""
+    stages = _request_stages.get()
+    if not ENABLED or stages is False or (stages is None and random.random() >= SAMPLE_RATE):
+        yield
+        return
+
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        count_error(type(e).__name__, name)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        observe("krishi_stage_seconds", elapsed, stage=name)
+        if stages is not None:
+            total, count = stages.get(name, (0.0, 0))
+            stages[name] = (total + elapsed, count + 1)
+
+
+def timed(name=None):
+    """Decorator form of stage(); the name defaults to module.function."""
+    def decorator(func):
+        stage_name = name or f"{func.__module__}.{func.__name__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def server_timing(stages):
+    parts = []
+    for name, (total, count) in stages.items():
+        part = f"{name};dur={total * 1000:.1f}"
+        if count > 1:
+            part += f';desc="{count} calls"'
+        parts.append(part)
+    return ", ".join(parts)
+
+
+@contextmanager
+def track_request(route, method):
+    """Request metrics for handlers served outside of Flask (see asgi.py).
+
+    Yields a dict whose "status" the handler sets once it knows it; pass
+    the dict to timing_header() for the Server-Timing value.
+    """
+    record = {"status": 500, "started": time.perf_counter(),
+              "stages": ({} if random.random() < SAMPLE_RATE else False) if ENABLED else None}
+    if not ENABLED:
+        yield record
+        return
+
+    token = _request_stages.set(record["stages"])
+    gauge_add("krishi_requests_in_flight", 1, route=route)
+    try:
+        yield record
+    except Exception as e:
+        count_error(type(e).__name__, "request")
+        raise
+    finally:
+        observe("krishi_request_seconds", time.perf_counter() - record["started"],
+                route=route, method=method, status=str(record["status"]))
+        gauge_add("krishi_requests_in_flight", -1, route=route)
+        _request_stages.reset(token)
+
+
+def timing_header(record):
+    """Server-Timing value for a track_request() record, or None."""
+    if not SERVER_TIMING or not record["stages"]:
+        return None
+    elapsed = (time.perf_counter() - record["started"]) * 1000
+    return f"{server_timing(record['stages'])}, app;dur={elapsed:.1f}"
+
+
+def init_app(app):
+    """Track every request of a Flask app: latency, in-flight and errors."""
+    from flask import g, request
+
+    @app.before_request
+    def metrics_before_request():
+        if not ENABLED:
+            return
+        g.metrics_started = time.perf_counter()
+        g.metrics_route = request.url_rule.rule if request.url_rule else "unmatched"
+        gauge_add("krishi_requests_in_flight", 1, route=g.metrics_route)
+        _request_stages.set({} if random.random() < SAMPLE_RATE else False)
+
+    @app.after_request
+    def metrics_after_request(response):
+        if not ENABLED or "metrics_started" not in g:
+            return response
+        g.metrics_status = response.status_code
+        stages = _request_stages.get()
+        if SERVER_TIMING and stages:
+            elapsed = (time.perf_counter() - g.metrics_started) * 1000
+            header = f"{server_timing(stages)}, app;dur={elapsed:.1f}"
+            existing = response.headers.get("Server-Timing")
+            response.headers["Server-Timing"] = f"{existing}, {header}" if existing else header
+
+        # A streamed body may still be sending when this request is torn down,
+        # so the request only counts as finished once the response is closed
+        started, route, method = g.metrics_started, g.metrics_route, request.method
+        status = str(response.status_code)
+
+        def finished():
+            observe("krishi_request_seconds", time.perf_counter() - started,
+                    route=route, method=method, status=status)
+            gauge_add("krishi_requests_in_flight", -1, route=route)
+
+        response.call_on_close(finished)
+        g.metrics_closing = True
+        return response
+
+    @app.teardown_request
+    def metrics_teardown_request(exc):
+        if not ENABLED or "metrics_started" not in g:
+            return
+        if exc is not None:
+            count_error(type(exc).__name__, "request")
+        if not g.get("metrics_closing"):
+            # No response to wait for (after_request never ran)
+            observe("krishi_request_seconds", time.perf_counter() - g.metrics_started,
+                    route=g.metrics_route, method=request.method, status=str(g.get("metrics_status", 500)))
+            gauge_add("krishi_requests_in_flight", -1, route=g.metrics_route)
+        _request_stages.set(None)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    pairs = [*labels, *extra]
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _header(lines, name, kind):
+    lines.append(f"# HELP {name} {HELP.get(name, name)}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def render():
+    """All metrics in the Prometheus text exposition format."""
+    with _lock:
+        histograms = {key: list(series) for key, series in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    for name, callback in _callbacks.items():
+        try:
+            gauges[(name, ())] = callback()
+        except Exception:
+            pass
+
+    lines = []
+    for kind, series in (("counter", counters), ("gauge", gauges)):
+        last_name = None
+        for (name, labels), value in sorted(series.items()):
+            if name != last_name:
+                _header(lines, name, kind)
+                last_name = name
+            lines.append(f"{name}{_labels(labels)} {value}")
+
+    last_name = None
+    for (name, labels), series in sorted(histograms.items()):
+        if name != last_name:
+            _header(lines, name, "histogram")
+            last_name = name
+        cumulative = 0
+        for bound, count in zip((*BUCKETS, "+Inf"), series):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(labels, [('le', bound)])} {cumulative}")
+        lines.append(f"{name}_sum{_labels(labels)} {series[-2]:.6f}")
+        lines.append(f"{name}_count{_labels(labels)} {series[-1]}")
+    return "\n".join(lines) + "\n"
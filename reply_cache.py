@@ -0,0 +1,157 @@
+"""Two-tier cache for LLM replies.
+
+Farmers ask the same handful of questions over and over, so replies are
+cached by (normalized prompt, language). A small in-process LRU answers the
+hottest prompts without touching disk; behind it a SQLite table keeps entries
+across restarts and workers, with a TTL and a row budget enforced by evicting
+the least recently used rows.
+
+    REPLY_CACHE_ENABLED      "0" disables the cache entirely (default "1")
+    REPLY_CACHE_MEMORY_SIZE  entries kept in the in-process LRU (default 512)
+    REPLY_CACHE_TTL          seconds an entry stays valid (default 7 days)
+    REPLY_CACHE_MAX_ROWS     rows kept in the SQLite tier (default 10000)
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+ENABLED = os.getenv("REPLY_CACHE_ENABLED", "1") == "1"
+MEMORY_SIZE = int(os.getenv("REPLY_CACHE_MEMORY_SIZE", "512"))
+TTL = int(os.getenv("REPLY_CACHE_TTL", str(7 * 24 * 3600)))
+MAX_ROWS = int(os.getenv("REPLY_CACHE_MAX_ROWS", "10000"))
+
+# Evict in batches so the table isn't trimmed on every single insert
+EVICT_SLACK = 0.1
+
+
+def normalize_prompt(prompt):
+    """Canonical form of a prompt used for cache keys.
+
+    NFKC folds compatibility forms (and the different ways Indic vowel signs
+    can be encoded) into one, then case, punctuation (including the danda)
+    and runs of whitespace are dropped. Combining marks are kept because in
+    Kannada, Hindi etc. they change the word.
+    """
+    text = unicodedata.normalize("NFKC", prompt).casefold()
+    kept = []
+    for ch in text:
+        category = unicodedata.category(ch)
+        if category.startswith("P") or category.startswith("S"):
+            kept.append(" ")
+        elif category in ("Cf", "Cc"):
+            # Zero-width joiners and control characters
+            continue
+        else:
+            kept.append(ch)
+    return " ".join("".join(kept).split())
+
+
+def cache_key(prompt, lang):
+    normalized = normalize_prompt(prompt)
+    return hashlib.sha256(f"{lang}\0{normalized}".encode("utf-8")).hexdigest()
+
+
+class ReplyCache:
+    """In-process LRU in front of a persistent SQLite table.
+
+    ``connect`` returns the sqlite3 connection to use (see db.get_connection).
+    """
+
+    def __init__(self, connect, memory_size=MEMORY_SIZE, ttl=TTL, max_rows=MAX_ROWS):
+        self.connect = connect
+        self.memory_size = memory_size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "evictions": 0}
+
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def _remember(self, key, reply, expires_at):
+        with self.lock:
+            self.memory[key] = (reply, expires_at)
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.memory_size:
+                self.memory.popitem(last=False)
+
+    def get(self, prompt, lang):
+        """Return the cached reply or None."""
+        key = cache_key(prompt, lang)
+        now = time.time()
+
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry and entry[1] > now:
+                self.memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[0]
+            if entry:
+                del self.memory[key]
+
+        try:
+            conn = self.connect()
+            row = conn.execute("SELECT reply, expires_at FROM reply_cache WHERE cache_key = ?",
+                               (key,)).fetchone()
+            if row and row[1] > now:
+                with conn:
+                    conn.execute("UPDATE reply_cache SET last_used_at = ?, hits = hits + 1 WHERE cache_key = ?",
+                                 (now, key))
+        except sqlite3.Error as e:
+            logging.error(f"Reply cache read failed: {e}")
+            row = None
+
+        if row and row[1] > now:
+            self._remember(key, row[0], row[1])
+            self._count("disk_hits")
+            return row[0]
+
+        self._count("misses")
+        return None
+
+    def put(self, prompt, lang, reply):
+        key = cache_key(prompt, lang)
+        now = time.time()
+        expires_at = now + self.ttl
+        self._remember(key, reply, expires_at)
+
+        try:
+            conn = self.connect()
+            with conn:
+                conn.execute('''INSERT OR REPLACE INTO reply_cache
+                                (cache_key, language, reply, created_at, last_used_at, expires_at, hits)
+                                VALUES (?, ?, ?, ?, ?, ?, 0)''',
+                             (key, lang, reply, now, now, expires_at))
+            self._evict(conn, now)
+            self._count("stores")
+        except sqlite3.Error as e:
+            logging.error(f"Reply cache write failed: {e}")
+
+    def _evict(self, conn, now):
+        """Drop expired rows, then the least recently used ones over budget."""
+        count = conn.execute("SELECT COUNT(*) FROM reply_cache").fetchone()[0]
+        if count <= self.max_rows * (1 + EVICT_SLACK):
+            return
+        with conn:
+            removed = conn.execute("DELETE FROM reply_cache WHERE expires_at <= ?", (now,)).rowcount
+            overflow = count - removed - self.max_rows
+            if overflow > 0:
+                removed += conn.execute('''DELETE FROM reply_cache WHERE cache_key IN
+                                           (SELECT cache_key FROM reply_cache ORDER BY last_used_at ASC LIMIT ?)''',
+                                        (overflow,)).rowcount
+        self._count("evictions", removed)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self.memory)
+        lookups = stats["memory_hits"] + stats["disk_hits"] + stats["misses"]
+        stats["hit_ratio"] = round((stats["memory_hits"] + stats["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return stats
@@ -0,0 +1,393 @@
+"""Storage retention and garbage collection.
+
+Files are reference counted against the database. An upload (with its
+vision copy and thumbnail) is deleted once no chat message names it, and a
+voice file once no message names it and it hasn't been served for a while;
+anything a deleted session or a timed-out voice job left behind is
+reclaimed that way. Retention quotas don't delete files directly: they
+drop the image reference from the oldest messages (the message itself
+stays), and the sweep then frees whatever is no longer referenced.
+Finished voice jobs, old outbox rows and messages whose session is gone
+are purged as well.
+
+Work is done in small batches with a pause between them, in a background
+thread, so a sweep never holds up requests.
+
+    GC_INTERVAL_SECONDS      time between sweeps (default 900)
+    GC_BATCH_SIZE            files or rows handled per batch (default 200)
+    GC_GRACE_SECONDS         unreferenced files younger than this are kept, which
+                             covers uploads still being answered (default 3600)
+    VOICE_ORPHAN_SECONDS     unreferenced voices not served for this long are
+                             deleted (default 86400)
+    UPLOAD_MAX_AGE_DAYS      images older than this are expired (default 0, off)
+    USER_UPLOAD_QUOTA_BYTES  image bytes kept per user (default 0, off)
+    UPLOADS_MAX_BYTES        image bytes kept overall (default 0, off; 100 MB on Vercel)
+    GC_ROW_RETENTION_DAYS    age at which finished voice jobs and sent or failed
+                             emails are purged (default 7)
+    GC_ASYNC                 "0" runs one batch inline per kick() (default "1", "0" on
+                             Vercel where background threads are frozen once the
+                             response is sent)
+"""
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+from uploads import EXTENSIONS, THUMBNAIL_SUFFIX, VISION_SUFFIX
+
+IS_VERCEL = os.getenv("VERCEL") == "1"
+
+INTERVAL = float(os.getenv("GC_INTERVAL_SECONDS", "900"))
+BATCH_SIZE = int(os.getenv("GC_BATCH_SIZE", "200"))
+GRACE_SECONDS = float(os.getenv("GC_GRACE_SECONDS", "3600"))
+VOICE_ORPHAN_SECONDS = float(os.getenv("VOICE_ORPHAN_SECONDS", "86400"))
+UPLOAD_MAX_AGE_DAYS = float(os.getenv("UPLOAD_MAX_AGE_DAYS", "0"))
+USER_UPLOAD_QUOTA = int(os.getenv("USER_UPLOAD_QUOTA_BYTES", "0"))
+UPLOADS_MAX_BYTES = int(os.getenv("UPLOADS_MAX_BYTES", str(100 * 1024 * 1024) if IS_VERCEL else "0"))
+ROW_RETENTION_DAYS = float(os.getenv("GC_ROW_RETENTION_DAYS", "7"))
+ASYNC = os.getenv("GC_ASYNC", "0" if IS_VERCEL else "1") == "1"
+
+# Pause between batches, and the least time between two background sweeps
+BATCH_PAUSE = 0.05
+MIN_GAP_SECONDS = 60
+
+DERIVATIVE_SUFFIXES = (VISION_SUFFIX, THUMBNAIL_SUFFIX)
+
+
+def new_report():
+    return {
+        "uploads": {"files": 0, "bytes": 0},
+        "voices": {"files": 0, "bytes": 0},
+        "temp": {"files": 0, "bytes": 0},
+        "images_expired": 0,
+        "rows": {"voice_jobs": 0, "email_outbox": 0, "chat_messages": 0},
+        "reclaimable_bytes": 0,
+    }
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class StorageCollector:
+    """Incremental sweeper for UPLOADS_DIR, VOICES_DIR and stale rows.
+
+    ``connect`` returns the sqlite3 connection to use (see db.get_connection).
+    """
+
+    def __init__(self, connect, uploads_dir, voices_dir, batch_size=BATCH_SIZE, interval=INTERVAL,
+                 grace_seconds=GRACE_SECONDS, voice_orphan_seconds=VOICE_ORPHAN_SECONDS,
+                 upload_max_age_days=UPLOAD_MAX_AGE_DAYS, user_quota=USER_UPLOAD_QUOTA,
+                 uploads_max_bytes=UPLOADS_MAX_BYTES, row_retention_days=ROW_RETENTION_DAYS,
+                 run_async=ASYNC):
+        self.connect = connect
+        self.uploads_dir = uploads_dir
+        self.voices_dir = voices_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.voice_orphan_seconds = voice_orphan_seconds
+        self.upload_max_age_days = upload_max_age_days
+        self.user_quota = user_quota
+        self.uploads_max_bytes = uploads_max_bytes
+        self.row_retention_days = row_retention_days
+        self.run_async = run_async
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.thread_pid = None
+        self.steps = None
+        self.step_report = None
+        self.last_started = 0.0
+        self.last_report = None
+        self.last_finished = None
+        self.sweeps = 0
+
+    # ---------------- scheduling ----------------
+
+    def start(self):
+        """Make sure this process has a sweeper thread (no-op when not async)."""
+        if not self.run_async or self.thread_pid == os.getpid():
+            return
+        # Threads don't survive a fork, so start the sweeper lazily in each worker process
+        with self.lock:
+            if self.thread_pid == os.getpid():
+                return
+            self.thread = threading.Thread(target=self._run, name="storage-gc", daemon=True)
+            self.thread.start()
+            self.thread_pid = os.getpid()
+
+    def kick(self):
+        """Ask for a sweep soon, e.g. after a session was deleted.
+
+        Without a background thread this runs one batch of the current sweep
+        inline instead, so storage is still reclaimed a little at a time.
+        """
+        if self.run_async:
+            self.start()
+            self.wakeup.set()
+            return
+
+        with self.lock:
+            if self.steps is None:
+                if time.monotonic() - self.last_started < self.interval and self.last_started:
+                    return
+                self.last_started = time.monotonic()
+                self.step_report = new_report()
+                self.steps = self._sweep(self.step_report, dry_run=False)
+            try:
+                next(self.steps)
+            except StopIteration:
+                self._finished(self.step_report)
+                self.steps = None
+            except Exception as e:
+                logging.error(f"Storage sweep failed: {e}")
+                self.steps = None
+
+    def _run(self):
+        while True:
+            self.last_started = time.monotonic()
+            report = new_report()
+            try:
+                for _ in self._sweep(report, dry_run=False):
+                    time.sleep(BATCH_PAUSE)
+                with self.lock:
+                    self._finished(report)
+            except Exception as e:
+                logging.error(f"Storage sweep failed: {e}")
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            gap = MIN_GAP_SECONDS - (time.monotonic() - self.last_started)
+            if gap > 0:
+                time.sleep(gap)
+
+    def _finished(self, report):
+        self.last_report = report
+        self.last_finished = time.time()
+        self.sweeps += 1
+        logging.info(f"Storage sweep reclaimed {report['reclaimable_bytes']} bytes: {report}")
+
+    def collect(self, dry_run=False):
+        """Run a whole sweep now and return its report.
+
+        With ``dry_run`` nothing is deleted or updated; the report says what
+        a real sweep would reclaim.
+        """
+        report = new_report()
+        for _ in self._sweep(report, dry_run):
+            pass
+        return report
+
+    def stats(self):
+        with self.lock:
+            return {
+                "sweeps": self.sweeps,
+                "last_finished": self.last_finished,
+                "last_report": self.last_report,
+            }
+
+    # ---------------- sweep ----------------
+
+    def _sweep(self, report, dry_run):
+        """Generator doing one sweep; it yields after every batch."""
+        # Messages whose image reference was dropped; a dry run only records
+        # them here, so the file sweep must ignore them itself
+        expired = set()
+        yield from self._expire_images(report, expired, dry_run)
+        yield from self._sweep_uploads(report, expired, dry_run)
+        yield from self._sweep_voices(report, dry_run)
+        yield from self._purge_rows(report, dry_run)
+        report["reclaimable_bytes"] = sum(report[kind]["bytes"] for kind in ("uploads", "voices", "temp"))
+
+    def _expire_images(self, report, expired, dry_run):
+        if not (self.upload_max_age_days > 0 or self.user_quota > 0 or self.uploads_max_bytes > 0):
+            return
+        conn = self.connect()
+
+        cutoff = None
+        if self.upload_max_age_days > 0:
+            cutoff = time.strftime("%Y-%m-%d %H:%M:%S",
+                                   time.gmtime(time.time() - self.upload_max_age_days * 86400))
+
+        sizes = {}
+        user_bytes = defaultdict(int)
+        user_kept = defaultdict(set)
+        total_bytes = 0
+        kept = set()
+        # Newest first: the most recent images are the ones that fit the
+        # quotas. Rows are read a batch at a time after the last (timestamp,
+        # id) seen, so no query holds the whole image history
+        after = None
+        while True:
+            if after is None:
+                rows = conn.execute('''SELECT m.id, m.image_filename, m.timestamp, s.username
+                                       FROM chat_messages m LEFT JOIN chat_sessions s ON s.id = m.session_id
+                                       WHERE m.image_filename IS NOT NULL
+                                       ORDER BY m.timestamp DESC, m.id DESC LIMIT ?''',
+                                    (self.batch_size,)).fetchall()
+            else:
+                rows = conn.execute('''SELECT m.id, m.image_filename, m.timestamp, s.username
+                                       FROM chat_messages m LEFT JOIN chat_sessions s ON s.id = m.session_id
+                                       WHERE m.image_filename IS NOT NULL AND (m.timestamp, m.id) < (?, ?)
+                                       ORDER BY m.timestamp DESC, m.id DESC LIMIT ?''',
+                                    (*after, self.batch_size)).fetchall()
+            if not rows:
+                return
+            after = (rows[-1][2], rows[-1][0])
+
+            to_expire = []
+            for message_id, filename, timestamp, username in rows:
+                if cutoff is not None and timestamp < cutoff:
+                    to_expire.append(message_id)
+                    continue
+                if filename not in sizes:
+                    sizes[filename] = self._upload_size(filename)
+                size = sizes[filename]
+
+                if self.user_quota > 0 and filename not in user_kept[username]:
+                    if user_bytes[username] + size > self.user_quota:
+                        to_expire.append(message_id)
+                        continue
+                    user_bytes[username] += size
+                    user_kept[username].add(filename)
+
+                if self.uploads_max_bytes > 0 and filename not in kept:
+                    if total_bytes + size > self.uploads_max_bytes:
+                        to_expire.append(message_id)
+                        continue
+                    total_bytes += size
+                    kept.add(filename)
+
+            # Only rows already read are updated, so the next page is unaffected
+            if to_expire:
+                expired.update(to_expire)
+                report["images_expired"] += len(to_expire)
+                if not dry_run:
+                    placeholders = ",".join("?" * len(to_expire))
+                    with conn:
+                        conn.execute(f"UPDATE chat_messages SET image_filename = NULL WHERE id IN ({placeholders})",
+                                     to_expire)
+            yield
+
+    def _upload_size(self, filename):
+        total = 0
+        for name in [filename, *self._derivatives(filename)]:
+            try:
+                total += os.path.getsize(os.path.join(self.uploads_dir, name))
+            except OSError:
+                pass
+        return total
+
+    @staticmethod
+    def _derivatives(filename):
+        stem = os.path.splitext(filename)[0]
+        return [stem + suffix for suffix in DERIVATIVE_SUFFIXES]
+
+    def _referenced(self, column, names, expired):
+        """The subset of ``names`` that some chat message still references."""
+        if not names:
+            return set()
+        conn = self.connect()
+        placeholders = ",".join("?" * len(names))
+        rows = conn.execute(f"SELECT id, {column} FROM chat_messages WHERE {column} IN ({placeholders})",
+                            names).fetchall()
+        return {name for message_id, name in rows if message_id not in expired}
+
+    def _remove(self, path, kind, report, dry_run):
+        try:
+            size = os.path.getsize(path)
+            if not dry_run:
+                os.remove(path)
+        except OSError:
+            return
+        report[kind]["files"] += 1
+        report[kind]["bytes"] += size
+
+    def _age(self, path, now):
+        try:
+            return now - os.path.getmtime(path)
+        except OSError:
+            return None
+
+    def _sweep_uploads(self, report, expired, dry_run):
+        try:
+            names = sorted(os.listdir(self.uploads_dir))
+        except OSError:
+            return
+        originals_left = set(names)
+
+        for batch in batches(names, self.batch_size):
+            now = time.time()
+            candidates = [name for name in batch
+                          if not name.startswith(".") and not name.endswith(DERIVATIVE_SUFFIXES)]
+            referenced = self._referenced("image_filename", candidates, expired)
+
+            for name in batch:
+                path = os.path.join(self.uploads_dir, name)
+                age = self._age(path, now)
+                if age is None or age < self.grace_seconds:
+                    continue
+
+                if name.startswith("."):
+                    # Partial upload or derivative left by a crashed request
+                    self._remove(path, "temp", report, dry_run)
+                elif name.endswith(DERIVATIVE_SUFFIXES):
+                    stem = name[:-len(VISION_SUFFIX if name.endswith(VISION_SUFFIX) else THUMBNAIL_SUFFIX)]
+                    if not any(stem + extension in originals_left for extension in set(EXTENSIONS.values())):
+                        self._remove(path, "uploads", report, dry_run)
+                elif name not in referenced:
+                    # Its derivatives sort after it ("." < "_"), so they are
+                    # removed when the sweep reaches them
+                    self._remove(path, "uploads", report, dry_run)
+                    originals_left.discard(name)
+            yield
+
+    def _sweep_voices(self, report, dry_run):
+        try:
+            names = sorted(os.listdir(self.voices_dir))
+        except OSError:
+            return
+
+        for batch in batches(names, self.batch_size):
+            now = time.time()
+            referenced = self._referenced("voice_filename", [name for name in batch if name.endswith(".mp3")], set())
+            for name in batch:
+                path = os.path.join(self.voices_dir, name)
+                age = self._age(path, now)
+                if age is None:
+                    continue
+                if name.endswith(".tmp"):
+                    if age >= self.grace_seconds:
+                        self._remove(path, "temp", report, dry_run)
+                elif name.endswith(".mp3") and name not in referenced and age >= self.voice_orphan_seconds:
+                    # Served files get their mtime bumped, so this only hits voices nobody plays
+                    self._remove(path, "voices", report, dry_run)
+            yield
+
+    def _purge_rows(self, report, dry_run):
+        cutoff = time.time() - self.row_retention_days * 86400
+        purges = [
+            ("voice_jobs", "SELECT rowid FROM voice_jobs WHERE status IN ('done', 'failed', 'dropped') "
+                           "AND finished_at < ?", (cutoff,)),
+            ("email_outbox", "SELECT rowid FROM email_outbox WHERE status IN ('sent', 'failed') "
+                             "AND created_at < ?", (cutoff,)),
+            ("chat_messages", "SELECT m.rowid FROM chat_messages m WHERE NOT EXISTS "
+                              "(SELECT 1 FROM chat_sessions s WHERE s.id = m.session_id)", ()),
+        ]
+        conn = self.connect()
+        for table, select, params in purges:
+            if dry_run:
+                report["rows"][table] += conn.execute(f"SELECT COUNT(*) FROM ({select})", params).fetchone()[0]
+                yield
+                continue
+            while True:
+                with conn:
+                    deleted = conn.execute(f"DELETE FROM {table} WHERE rowid IN ({select} LIMIT ?)",
+                                           (*params, self.batch_size)).rowcount
+                report["rows"][table] += deleted
+                yield
+                if deleted < self.batch_size:
+                    break
@@ -0,0 +1,92 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class Upstream(ThreadingHTTPServer):
+    """Local stand-in for OpenRouter that answers from a script.
+
+    ``script[model]`` is a list of (status, delay seconds, headers) used up
+    one request at a time; once it is empty a model answers 200 after
+    ``delays[model]`` (default 0). Every answer echoes the model it was for.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), UpstreamHandler)
+        self.script = {}
+        self.delays = {}
+        self.requests = []
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/"
+
+    def next_answer(self, model):
+        with self.lock:
+            self.requests.append((time.monotonic(), model))
+            steps = self.script.get(model) or self.script.get(None)
+            if steps:
+                return steps.pop(0)
+        return 200, self.delays.get(model, 0), {}
+
+    def count(self, model=None):
+        with self.lock:
+            return sum(1 for _, m in self.requests if model is None or m == model)
+
+
+class UpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        model = request.get("model")
+        status, delay, headers = self.server.next_answer(model)
+        time.sleep(delay)
+        body = json.dumps({"model": model, "choices": [{"message": {"content": f"answer from {model}"}}]})
+        body = body.encode("utf-8")
+        try:
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        except OSError:
+            # The client gave up on this request (a cancelled hedge)
+            pass
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    monkeypatch.setenv("NO_PROXY", "127.0.0.1,localhost")
+    server = Upstream()
+    threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(scope="session")
+def krishi(tmp_path_factory):
+    """The Flask app module, imported in a scratch directory with background threads off."""
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(tmp_path_factory.mktemp("app"))
+        for name, value in {"EMAIL_ASYNC": "0", "GC_ASYNC": "0", "LOCAL_HISTORY_ASYNC": "0",
+                            "SUMMARY_ASYNC": "0", "FLASK_SECRET_KEY": "tests", "NO_PROXY": "127.0.0.1,localhost"}.items():
+            patch.setenv(name, value)
+        import app
+        yield app
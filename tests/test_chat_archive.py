@@ -0,0 +1,159 @@
+import csv
+import io
+import json
+import os
+import zipfile
+
+import pytest
+
+import chat_archive
+import db
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / "history.db"))
+    db.migrate(conn)
+    return conn
+
+
+def add_history(conn, username, sessions=2, messages=3, image=None, voice=None):
+    for s in range(sessions):
+        session_id = conn.execute("INSERT INTO chat_sessions (username, session_name) VALUES (?, ?)",
+                                  (username, f"Chat {s}")).lastrowid
+        for m in range(messages):
+            conn.execute('''INSERT INTO chat_messages (session_id, message_type, message_text, response_text,
+                                                       image_filename, voice_filename, language)
+                            VALUES (?, 'text', ?, 'answer, with "quotes"\nand lines', ?, ?, 'kn')''',
+                         (session_id, f"question {s}.{m} ಭತ್ತ", image if m == 0 else None,
+                          voice if m == 1 else None))
+    # One session without messages
+    conn.execute("INSERT INTO chat_sessions (username, session_name) VALUES (?, 'Empty')", (username,))
+    conn.commit()
+
+
+def history(conn, username):
+    return conn.execute('''SELECT s.session_name, m.message_text, m.response_text, m.image_filename,
+                                  m.voice_filename, m.language
+                           FROM chat_sessions s LEFT JOIN chat_messages m ON m.session_id = s.id
+                           WHERE s.username = ? ORDER BY s.id, m.id''', (username,)).fetchall()
+
+
+def export(conn, username, fmt):
+    return b"".join(chat_archive.export_chunks(conn, username, fmt))
+
+
+@pytest.mark.parametrize("fmt", ["ndjson", "csv"])
+def test_round_trip(conn, tmp_path, fmt):
+    add_history(conn, "asha", image="a.jpg", voice="v.mp3")
+    add_history(conn, "ravi")
+    path = tmp_path / f"history.{fmt}"
+    path.write_bytes(export(conn, "asha", fmt))
+
+    target = db.connect(str(tmp_path / "target.db"))
+    db.migrate(target)
+    counts = chat_archive.import_file(target, str(path), str(tmp_path), str(tmp_path), batch_rows=2)
+    assert counts == {"sessions": 3, "messages": 6}
+    assert history(target, "asha") == history(conn, "asha")
+    assert history(target, "ravi") == []
+
+
+def test_export_of_everyone_groups_by_user(conn):
+    add_history(conn, "ravi", sessions=1)
+    add_history(conn, "asha", sessions=1)
+    lines = [json.loads(line) for line in export(conn, None, "ndjson").splitlines()]
+    assert [(line["type"], line.get("username")) for line in lines if line["type"] == "session"] == [
+        ("session", "asha"), ("session", "asha"), ("session", "ravi"), ("session", "ravi")]
+
+
+def test_bundle_streams_history_and_files(conn, tmp_path):
+    uploads, voices = tmp_path / "uploads", tmp_path / "voices"
+    uploads.mkdir()
+    voices.mkdir()
+    (uploads / "a.jpg").write_bytes(b"photo" * 1000)
+    (uploads / "a_thumb.jpg").write_bytes(b"thumb")
+    (voices / "v.mp3").write_bytes(b"mp3")
+    add_history(conn, "asha", image="a.jpg", voice="v.mp3")
+
+    chunks = list(chat_archive.bundle_chunks(conn, "asha", "ndjson", str(uploads), str(voices)))
+    assert len(chunks) > 1
+    bundle = zipfile.ZipFile(io.BytesIO(b"".join(chunks)))
+    assert bundle.testzip() is None
+    assert sorted(bundle.namelist()) == ["history.ndjson", "uploads/a.jpg", "uploads/a_thumb.jpg", "voices/v.mp3"]
+
+    path = tmp_path / "bundle.zip"
+    path.write_bytes(b"".join(chunks))
+    target = db.connect(str(tmp_path / "target.db"))
+    db.migrate(target)
+    new_uploads, new_voices = tmp_path / "new_uploads", tmp_path / "new_voices"
+    new_uploads.mkdir()
+    new_voices.mkdir()
+    counts = chat_archive.import_file(target, str(path), str(new_uploads), str(new_voices), username="asha2")
+    assert counts == {"sessions": 3, "messages": 6, "files": 3}
+    assert (new_uploads / "a.jpg").read_bytes() == b"photo" * 1000
+    assert history(target, "asha2") == history(conn, "asha")
+
+
+def test_bundle_files_cannot_escape_their_directory(conn, tmp_path):
+    path = tmp_path / "evil.zip"
+    with zipfile.ZipFile(path, "w") as bundle:
+        bundle.writestr("history.ndjson", "")
+        bundle.writestr("uploads/../../escaped.jpg", b"x")
+        bundle.writestr("voices/.hidden", b"x")
+        bundle.writestr("other/file.jpg", b"x")
+    uploads = tmp_path / "uploads"
+    uploads.mkdir()
+    counts = chat_archive.import_file(conn, str(path), str(uploads), str(uploads))
+    assert counts["files"] == 0
+    assert os.listdir(uploads) == []
+    assert not (tmp_path.parent / "escaped.jpg").exists()
+
+
+def test_broken_input_is_rejected(conn):
+    records = chat_archive.read_records(io.StringIO('{"type": "message", "session_id": 1}\n'), "ndjson")
+    with pytest.raises(chat_archive.ArchiveError):
+        chat_archive.import_records(conn, records)
+    with pytest.raises(chat_archive.ArchiveError):
+        list(chat_archive.read_records(io.StringIO("not json\n"), "ndjson"))
+    with pytest.raises(chat_archive.ArchiveError):
+        list(chat_archive.read_records(io.StringIO("a,b\n1,2\n"), "csv"))
+
+
+def login(krishi, username):
+    client = krishi.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = username
+    return client
+
+
+def test_web_import_drops_file_names(krishi):
+    lines = [{"type": "session", "id": 1, "username": "victim", "session_name": "Mine now"},
+             {"type": "message", "id": 1, "session_id": 1, "message_type": "image", "message_text": "see",
+              "response_text": "ok", "image_filename": "victims-photo.jpg", "voice_filename": "victims-voice.mp3",
+              "language": "en"}]
+    body = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+    response = login(krishi, "mallory").post("/import/history",
+                                             data={"file": (io.BytesIO(body), "history.ndjson")})
+    assert response.status_code == 200
+    assert response.get_json() == {"success": True, "sessions": 1, "messages": 1}
+    rows = db.get_connection().execute('''SELECT s.username, m.image_filename, m.voice_filename
+                                          FROM chat_messages m JOIN chat_sessions s ON s.id = m.session_id
+                                          WHERE s.session_name = 'Mine now' ''').fetchall()
+    assert rows == [("mallory", None, None)]
+
+
+def test_web_import_refuses_bundles(krishi):
+    response = login(krishi, "mallory").post("/import/history", data={"file": (io.BytesIO(b"PK"), "x.zip")})
+    assert response.status_code == 400
+
+
+def test_web_export_streams_the_users_history(krishi):
+    conn = db.get_connection()
+    add_history(conn, "exporter", sessions=1, messages=2)
+    response = login(krishi, "exporter").get("/export/history?format=csv")
+    assert response.status_code == 200
+    assert response.is_streamed
+    assert "attachment" in response.headers["Content-Disposition"]
+    rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+    assert [(row["username"], row["message_text"]) for row in rows] == [
+        ("exporter", "question 0.0 ಭತ್ತ"), ("exporter", "question 0.1 ಭತ್ತ"), ("exporter", "")]
@@ -0,0 +1,53 @@
+import json
+
+import pytest
+
+
+@pytest.fixture
+def client(krishi):
+    client = krishi.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = "ravi"
+        session["current_session_id"] = krishi.get_or_create_session("ravi")[0]
+    return client
+
+
+def saved_replies(krishi, username):
+    return [row[0] for row in krishi.db.get_connection().execute(
+        '''SELECT m.response_text FROM chat_messages m JOIN chat_sessions s ON s.id = m.session_id
+           WHERE s.username = ? ORDER BY m.id''', (username,))]
+
+
+def test_stream_saves_the_reply_when_the_client_leaves(krishi, client, monkeypatch):
+    produced = []
+
+    def reply_stream(prompt, lang="en", use_cache=True, session_id=None):
+        for piece in ("Apply ", "25 kg ", "urea ", "per acre."):
+            produced.append(piece)
+            yield piece
+
+    monkeypatch.setattr(krishi, "generate_reply_stream", reply_stream)
+    response = client.post("/chat/stream", data={"message": "urea for paddy?", "lang": "en"}, buffered=False)
+    body = iter(response.response)
+    while b"event: token" not in next(body):
+        pass
+    response.close()
+
+    assert len(produced) == 4
+    assert saved_replies(krishi, "ravi") == ["Apply 25 kg urea per acre."]
+
+
+def test_batch_saves_the_answers_so_far_when_the_client_leaves(krishi, monkeypatch):
+    client = krishi.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = "officer"
+    monkeypatch.setattr(krishi, "generate_reply", lambda message, lang="en", **kwargs: f"reply to {message}")
+    response = client.post("/chat/batch", json={"items": ["first", "second", "third"], "voice": False},
+                           buffered=False)
+    line = json.loads(next(iter(response.response)))
+    response.close()
+
+    assert line["event"] == "reply"
+    saved = saved_replies(krishi, "officer")
+    assert line["reply"] in saved
+    assert set(saved) <= {"reply to first", "reply to second", "reply to third"}
@@ -0,0 +1,112 @@
+import asyncio
+
+import pytest
+import requests
+
+from llm_client import AsyncLLMClient, CircuitBreaker, CircuitOpenError, LLMClient
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def make_client(breaker=None, max_retries=2):
+    sleeps = []
+    client = LLMClient(pool_size=4, connect_timeout=1, read_timeout=5, max_retries=max_retries,
+                       backoff_base=0.5, backoff_max=4, breaker=breaker or CircuitBreaker(threshold=3, cooldown=30),
+                       sleep=sleeps.append)
+    return client, sleeps
+
+
+def test_retries_5xx_then_succeeds(upstream):
+    upstream.script[None] = [(503, 0, {}), (502, 0, {})]
+    client, sleeps = make_client()
+    response = client.post(upstream.url, json={"model": "m"})
+    assert response.status_code == 200
+    assert upstream.count() == 3
+    # Full jitter under the doubling ceiling
+    assert len(sleeps) == 2 and 0 <= sleeps[0] <= 0.5 and 0 <= sleeps[1] <= 1.0
+    assert client.breaker.state == "closed" and client.breaker.failures == 0
+
+
+def test_429_honours_retry_after_up_to_the_cap(upstream):
+    upstream.script[None] = [(429, 0, {"Retry-After": "2"}), (429, 0, {"Retry-After": "60"})]
+    client, sleeps = make_client()
+    assert client.post(upstream.url, json={}).status_code == 200
+    assert sleeps == [2.0, 4.0]
+
+
+def test_client_errors_are_not_retried(upstream):
+    upstream.script[None] = [(400, 0, {})]
+    client, sleeps = make_client()
+    assert client.post(upstream.url, json={}).status_code == 400
+    assert upstream.count() == 1 and sleeps == []
+    assert client.breaker.failures == 0
+
+
+def test_breaker_opens_after_failed_calls_and_fails_fast(upstream):
+    upstream.script[None] = [(500, 0, {})] * 6
+    client, _ = make_client(breaker=CircuitBreaker(threshold=2, cooldown=30), max_retries=2)
+
+    # Each call is retried to exhaustion and gives the last response back
+    assert client.post(upstream.url, json={}).status_code == 500
+    assert upstream.count() == 3 and client.breaker.state == "closed"
+    assert client.post(upstream.url, json={}).status_code == 500
+    assert upstream.count() == 6 and client.breaker.state == "open"
+
+    with pytest.raises(CircuitOpenError):
+        client.post(upstream.url, json={})
+    assert upstream.count() == 6
+
+
+def test_half_open_breaker_lets_one_probe_through(upstream):
+    clock = Clock()
+    breaker = CircuitBreaker(threshold=1, cooldown=30, clock=clock)
+    upstream.script[None] = [(503, 0, {})]
+    client, _ = make_client(breaker=breaker, max_retries=0)
+    assert client.post(upstream.url, json={}).status_code == 503
+    assert breaker.state == "open"
+
+    clock.now += 31
+    assert breaker.state == "half-open"
+    assert breaker.allow() and not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+    clock.now += 31
+    assert client.post(upstream.url, json={}).status_code == 200
+    assert breaker.state == "closed"
+
+
+def test_connection_errors_are_retried_then_raised():
+    client, sleeps = make_client(breaker=CircuitBreaker(threshold=1, cooldown=30), max_retries=1)
+    with pytest.raises(requests.ConnectionError):
+        # Nothing listens on port 9 of the loopback interface
+        client.post("http://127.0.0.1:9/", json={})
+    assert len(sleeps) == 1
+    assert client.breaker.state == "open"
+
+
+def test_async_client_retries_and_opens_the_breaker(upstream):
+    upstream.script[None] = [(503, 0, {"Retry-After": "0"}), (200, 0, {}), (500, 0, {}), (500, 0, {})]
+
+    async def run():
+        client = AsyncLLMClient(pool_size=4, max_retries=1, backoff_base=0.01, backoff_max=0.01,
+                                breaker=CircuitBreaker(threshold=1, cooldown=30))
+        try:
+            first = await client.post(upstream.url, json={"model": "m"})
+            assert (first.status_code, upstream.count()) == (200, 2)
+            second = await client.post(upstream.url, json={"model": "m"})
+            assert (second.status_code, upstream.count()) == (500, 4)
+            assert client.breaker.state == "open"
+            with pytest.raises(CircuitOpenError):
+                await client.post(upstream.url, json={"model": "m"})
+            assert upstream.count() == 4
+        finally:
+            await client.close()
+
+    asyncio.run(run())
@@ -0,0 +1,126 @@
+import asyncio
+import time
+
+import pytest
+
+import llm_client
+from llm_router import ModelRouter
+
+
+@pytest.fixture(autouse=True)
+def fresh_clients():
+    # The router sends through the process-wide clients; give each test its own
+    llm_client._client = llm_client._async_client = None
+    yield
+    llm_client._client = llm_client._async_client = None
+
+
+def make_router(models, **kwargs):
+    options = dict(hedge_percentile=95, hedge_min_ms=100, hedge_min_samples=5)
+    options.update(kwargs)
+    return ModelRouter(models, provider_limits={}, **options)
+
+
+def warm_up(router, model, seconds, count=20):
+    """Give ``model`` a latency history, as if it had answered ``count`` calls."""
+    for _ in range(count):
+        router.record(model, seconds, True)
+
+
+def answered_by(response):
+    return response.json()["model"]
+
+
+def test_slow_call_is_hedged_to_the_next_model(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    warm_up(router, "a/primary", 0.05)
+    upstream.delays["a/primary"] = 1.5
+
+    started = time.monotonic()
+    response = router.post(upstream.url, json={})
+    elapsed = time.monotonic() - started
+
+    assert answered_by(response) == "b/backup"
+    # Hedged after hedge_min (the p95 is below it), not after the slow answer
+    assert 0.1 <= elapsed < 1.0
+    assert upstream.count("a/primary") == 1 and upstream.count("b/backup") == 1
+    counters = router.stats()["models"]
+    assert counters["b/backup"]["hedged"] == 1 and counters["b/backup"]["hedge_won"] == 1
+    assert counters["a/primary"]["cancelled"] == 1
+
+
+def test_hedge_waits_for_the_latency_percentile(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    warm_up(router, "a/primary", 0.4)
+    upstream.delays["a/primary"] = 0.2
+
+    response = router.post(upstream.url, json={})
+    assert answered_by(response) == "a/primary"
+    assert upstream.count("b/backup") == 0
+
+
+def test_no_hedge_without_enough_samples(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    warm_up(router, "a/primary", 0.05, count=2)
+    upstream.delays["a/primary"] = 0.3
+
+    assert answered_by(router.post(upstream.url, json={})) == "a/primary"
+    assert upstream.count("b/backup") == 0
+
+
+def test_single_model_is_hedged_to_itself(upstream):
+    router = make_router(["a/only"])
+    warm_up(router, "a/only", 0.05)
+    upstream.script["a/only"] = [(200, 1.5, {})]
+
+    started = time.monotonic()
+    assert answered_by(router.post(upstream.url, json={})) == "a/only"
+    assert time.monotonic() - started < 1.0
+    assert upstream.count("a/only") == 2
+
+
+def test_failure_falls_back_without_retrying(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    upstream.script["a/primary"] = [(503, 0, {})]
+
+    assert answered_by(router.post(upstream.url, json={})) == "b/backup"
+    assert upstream.count("a/primary") == 1
+    assert router.stats()["models"]["b/backup"]["fallback"] == 1
+
+
+def test_every_model_failing_returns_the_last_failure(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    upstream.script["a/primary"] = [(500, 0, {})]
+    upstream.script["b/backup"] = [(502, 0, {})]
+
+    assert router.post(upstream.url, json={}).status_code == 502
+
+
+def test_failing_model_moves_behind_the_others(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    for _ in range(6):
+        router.record("a/primary", 0.05, False)
+    assert router.ranked() == ["b/backup", "a/primary"]
+    assert answered_by(router.post(upstream.url, json={})) == "b/backup"
+    assert upstream.count("a/primary") == 0
+
+
+def test_async_hedge_cancels_the_slow_call(upstream):
+    router = make_router(["a/primary", "b/backup"])
+    warm_up(router, "a/primary", 0.05)
+    upstream.delays["a/primary"] = 1.5
+
+    async def run():
+        try:
+            started = time.monotonic()
+            response = await router.apost(upstream.url, json={})
+            return answered_by(response), time.monotonic() - started
+        finally:
+            await llm_client.close_async_client()
+
+    model, elapsed = asyncio.run(run())
+    assert model == "b/backup" and elapsed < 1.0
+    counters = router.stats()["models"]
+    assert counters["b/backup"]["hedge_won"] == 1 and counters["a/primary"]["cancelled"] == 1
+    # The cancelled attempt gave its provider slot back
+    assert router.stats()["providers"]["a"]["in_use"] == 0
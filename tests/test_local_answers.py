@@ -0,0 +1,57 @@
+import pytest
+
+import db
+from local_answers import LocalAnswers
+
+
+@pytest.fixture
+def index():
+    conn = db.connect(":memory:")
+    db.migrate(conn)
+    return LocalAnswers(lambda: conn, history_min_users=0, confidence=0.75, fallback_confidence=0.7)
+
+
+@pytest.mark.parametrize("prompt, lang, expected", [
+    ("How much urea per acre for paddy?", "en", "Transplanted paddy"),
+    ("My tomato leaves are curling", "en", "Tomato leaf curl"),
+    ("why are paddy leaves yellow", "en", "Yellow paddy leaves"),
+    ("ಭತ್ತಕ್ಕೆ ಎಕರೆಗೆ ಎಷ್ಟು ಯೂರಿಯಾ ಹಾಕಬೇಕು", "kn", "ನಾಟಿ ಭತ್ತಕ್ಕೆ"),
+    ("धान में यूरिया कितना डालें प्रति एकड़", "hi", "रोपाई वाले धान"),
+])
+def test_answers_known_questions(index, prompt, lang, expected):
+    assert index.answer(prompt, lang).startswith(expected)
+
+
+@pytest.mark.parametrize("prompt", [
+    "How much urea per acre for sugarcane?",
+    "How much potash per acre for paddy?",
+    "my chilli leaves are curling",
+    "tomato price",
+])
+def test_other_crops_and_inputs_get_no_answer(index, prompt):
+    assert index.answer(prompt, "en") is None
+    assert index.fallback(prompt, "en") is None
+
+
+def test_entities_alone_are_not_confident(index):
+    assert index.answer("paddy urea", "en") is None
+    assert index.fallback("paddy urea", "en").startswith("Transplanted paddy")
+
+
+def test_fallback_uses_english_for_other_languages(index):
+    assert index.answer("How much fertilizer for wheat", "te") is None
+    assert index.fallback("How much fertilizer for wheat", "te").startswith("Irrigated wheat")
+
+
+def test_history_entries_keep_their_crop(index):
+    conn = index.connect()
+    with conn:
+        for user in ("asha", "ravi", "meena"):
+            session_id = conn.execute("INSERT INTO chat_sessions (username) VALUES (?)", (user,)).lastrowid
+            conn.execute('''INSERT INTO chat_messages (session_id, message_type, message_text, response_text, language)
+                            VALUES (?, 'text', 'best time to harvest sugarcane', 'Harvest sugarcane at 12 months.', 'en')''',
+                         (session_id,))
+    index.history_min_users = 3
+    assert index.harvest(force=True) == 1
+    assert index.answer("best time to harvest sugarcane", "en") == "Harvest sugarcane at 12 months."
+    assert index.fallback("best time to harvest cotton", "en") is None
@@ -0,0 +1,142 @@
+import socket
+import time
+
+import pytest
+from aiosmtpd.controller import Controller
+from aiosmtpd.smtp import AuthResult
+
+import db
+from mailer import BACKOFF_BASE, STALE_CLAIM_SECONDS, Outbox
+
+
+class Mailbox:
+    """aiosmtpd handler that keeps what it receives and can refuse the next few messages."""
+
+    def __init__(self):
+        self.messages = []
+        self.logins = 0
+        self.refuse = 0
+
+    def authenticate(self, server, session, envelope, mechanism, auth_data):
+        self.logins += 1
+        return AuthResult(success=auth_data.password == b"secret")
+
+    async def handle_DATA(self, server, session, envelope):
+        if self.refuse:
+            self.refuse -= 1
+            return "451 Try again later"
+        self.messages.append((envelope.rcpt_tos, envelope.content))
+        return "250 OK"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def mailbox():
+    handler = Mailbox()
+    controller = Controller(handler, hostname="127.0.0.1", port=free_port(),
+                            authenticator=handler.authenticate, auth_require_tls=False)
+    controller.start()
+    yield handler, controller.port
+    controller.stop()
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / "outbox.db"))
+    db.migrate(conn)
+    return conn
+
+
+def make_outbox(conn, port, **kwargs):
+    return Outbox(lambda: conn, "krishi@example.com", "secret", "127.0.0.1", port, starttls=False,
+                  rate_per_minute=0, run_async=False, **kwargs)
+
+
+def row(conn, outbox_id):
+    return conn.execute("SELECT status, attempts, next_attempt_at, last_error FROM email_outbox WHERE id = ?",
+                        (outbox_id,)).fetchone()
+
+
+def test_sends_over_one_reused_connection(conn, mailbox):
+    handler, port = mailbox
+    outbox = make_outbox(conn, port)
+    ids = [outbox.enqueue(f"farmer{i}@example.com", "Verify", "<b>1234</b>") for i in range(3)]
+
+    assert [recipients for recipients, _ in handler.messages] == [[f"farmer{i}@example.com"] for i in range(3)]
+    assert b"1234" in handler.messages[0][1]
+    assert handler.logins == 1
+    assert [row(conn, outbox_id)[:2] for outbox_id in ids] == [("sent", 1)] * 3
+    assert outbox.stats() == {"pending": 0, "sending": 0, "sent": 3, "failed": 0}
+
+
+def test_failed_send_is_retried_with_backoff(conn, mailbox):
+    handler, port = mailbox
+    handler.refuse = 2
+    outbox = make_outbox(conn, port)
+
+    before = time.time()
+    outbox_id = outbox.enqueue("farmer@example.com", "Verify", "hi")
+    status, attempts, next_attempt_at, last_error = row(conn, outbox_id)
+    assert (status, attempts) == ("pending", 1)
+    assert "451" in last_error
+    assert before + BACKOFF_BASE <= next_attempt_at <= time.time() + BACKOFF_BASE
+    # Not due yet
+    assert outbox.drain() == 0
+
+    conn.execute("UPDATE email_outbox SET next_attempt_at = 0")
+    conn.commit()
+    before = time.time()
+    assert outbox.drain() == 0
+    status, attempts, next_attempt_at, _ = row(conn, outbox_id)
+    assert (status, attempts) == ("pending", 2)
+    assert next_attempt_at >= before + 2 * BACKOFF_BASE
+
+    conn.execute("UPDATE email_outbox SET next_attempt_at = 0")
+    conn.commit()
+    assert outbox.drain() == 1
+    assert row(conn, outbox_id)[:2] == ("sent", 3)
+    assert len(handler.messages) == 1
+
+
+def test_gives_up_after_max_attempts(conn, mailbox):
+    handler, port = mailbox
+    handler.refuse = 10
+    outbox = make_outbox(conn, port, max_attempts=2)
+    outbox_id = outbox.enqueue("farmer@example.com", "Verify", "hi")
+    conn.execute("UPDATE email_outbox SET next_attempt_at = 0")
+    conn.commit()
+    outbox.drain()
+    status, attempts, next_attempt_at, _ = row(conn, outbox_id)
+    assert (status, attempts, next_attempt_at) == ("failed", 2, None)
+    conn.execute("UPDATE email_outbox SET next_attempt_at = 0")
+    conn.commit()
+    assert outbox.drain() == 0
+
+
+def test_claims_skip_live_claims_and_recover_stale_ones(conn):
+    outbox = make_outbox(conn, 1)
+    now = time.time()
+    with conn:
+        for status, claimed_at in (("sending", now), ("sending", now - STALE_CLAIM_SECONDS - 1), ("sent", None)):
+            conn.execute('''INSERT INTO email_outbox (recipient, subject, body_html, status, attempts,
+                                                      next_attempt_at, claimed_at, created_at)
+                            VALUES (?, 's', 'b', ?, 0, 0, ?, ?)''', (status, status, claimed_at, now))
+
+    claimed = outbox._claim()
+    assert claimed is not None and claimed[0] == 2
+    assert conn.execute("SELECT status FROM email_outbox WHERE id = 2").fetchone() == ("sending",)
+    # The live claim of row 1 is left to its sender, and row 2 is taken now
+    assert outbox._claim() is None
+
+
+def test_unconfigured_outbox_keeps_the_message(conn):
+    outbox = Outbox(lambda: conn, "", "", "127.0.0.1", 1, run_async=False, rate_per_minute=0)
+    outbox_id = outbox.enqueue("farmer@example.com", "Verify", "hi")
+    status, attempts, _, last_error = row(conn, outbox_id)
+    assert (status, attempts) == ("pending", 1)
+    assert "not configured" in last_error
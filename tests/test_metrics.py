@@ -0,0 +1,45 @@
+from flask import Flask, Response
+
+import metrics
+
+
+def in_flight(route):
+    return metrics._gauges.get(metrics._key("krishi_requests_in_flight", {"route": route}), 0)
+
+
+def request_count(route):
+    series = metrics._histograms.get(metrics._key("krishi_request_seconds",
+                                                  {"route": route, "method": "GET", "status": "200"}))
+    return series[-1] if series else 0
+
+
+def test_streamed_request_is_in_flight_until_the_body_is_sent():
+    app = Flask(__name__)
+    metrics.init_app(app)
+    seen = []
+
+    @app.route("/lines")
+    def lines():
+        def body():
+            for n in range(3):
+                seen.append((in_flight("/lines"), request_count("/lines")))
+                yield f"{n}\n"
+        return Response(body(), mimetype="application/x-ndjson")
+
+    response = app.test_client().get("/lines", buffered=False)
+    assert b"".join(response.response) == b"0\n1\n2\n"
+    assert seen == [(1, 0)] * 3
+    response.close()
+    assert in_flight("/lines") == 0
+    assert request_count("/lines") == 1
+
+
+def test_plain_request_is_recorded_once():
+    app = Flask(__name__)
+    metrics.init_app(app)
+    app.add_url_rule("/ping", "ping", lambda: "pong")
+
+    with app.test_client().get("/ping") as response:
+        assert response.data == b"pong"
+    assert in_flight("/ping") == 0
+    assert request_count("/ping") == 1
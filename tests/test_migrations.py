@@ -0,0 +1,70 @@
+import multiprocessing
+import sqlite3
+
+import db
+
+
+def columns(conn, table):
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+
+
+def test_migrate_builds_the_latest_schema(tmp_path):
+    conn = db.connect(str(tmp_path / "fresh.db"))
+    assert db.migrate(conn) == db.LATEST_VERSION
+    assert db.schema_version(conn) == db.LATEST_VERSION
+    assert {"summary", "summary_through"} <= columns(conn, "chat_sessions")
+    tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+    assert {"users", "chat_messages", "email_outbox", "local_answers", "idx_chat_messages_image"} <= tables
+
+
+def test_migrate_is_idempotent(tmp_path):
+    conn = db.connect(str(tmp_path / "again.db"))
+    db.migrate(conn)
+    assert db.migrate(conn) == db.LATEST_VERSION
+
+
+def test_migrate_resumes_from_an_older_version(tmp_path):
+    conn = db.connect(str(tmp_path / "old.db"))
+    conn.isolation_level = None
+    for version, _, statements in db.MIGRATIONS[:6]:
+        for statement in statements:
+            conn.execute(statement)
+        conn.execute(f"PRAGMA user_version = {version}")
+    conn.isolation_level = ""
+    conn.execute("INSERT INTO chat_sessions (username, session_name) VALUES ('asha', 'Kharif')")
+    conn.commit()
+
+    assert db.migrate(conn) == db.LATEST_VERSION
+    assert conn.execute("SELECT session_name, summary_through FROM chat_sessions").fetchall() == [("Kharif", 0)]
+
+
+def test_failed_migration_rolls_back(tmp_path, monkeypatch):
+    conn = db.connect(str(tmp_path / "broken.db"))
+    broken = db.MIGRATIONS + [(db.LATEST_VERSION + 1, "broken", [
+        "CREATE TABLE half_done (id INTEGER)",
+        "THIS IS NOT SQL",
+    ])]
+    monkeypatch.setattr(db, "MIGRATIONS", broken)
+    monkeypatch.setattr(db, "LATEST_VERSION", db.LATEST_VERSION + 1)
+    try:
+        db.migrate(conn)
+    except sqlite3.OperationalError:
+        pass
+    else:
+        raise AssertionError("the broken migration should have raised")
+    assert db.schema_version(conn) == db.LATEST_VERSION - 1
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+
+
+def _migrate(path, barrier):
+    barrier.wait()
+    db.configure(path)
+    return db.migrate()
+
+
+def test_concurrent_workers_migrate_a_fresh_database(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, context.Pool(6) as pool:
+        barrier = manager.Barrier(6)
+        results = [pool.apply_async(_migrate, (str(tmp_path / "shared.db"), barrier)) for _ in range(6)]
+        assert [result.get(timeout=60) for result in results] == [db.LATEST_VERSION] * 6
@@ -0,0 +1,111 @@
+import os
+import time
+
+import pytest
+
+import db
+from retention import StorageCollector, new_report
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = db.connect(str(tmp_path / "retention.db"))
+    db.migrate(conn)
+    return conn
+
+
+@pytest.fixture
+def media(tmp_path):
+    path = tmp_path / "uploads"
+    path.mkdir()
+    return str(path)
+
+
+def add_images(conn, uploads_dir, username, count, size=100, start_day=1):
+    """``count`` messages of ``username``, one image each, a day apart (the last is newest)."""
+    session_id = conn.execute("INSERT INTO chat_sessions (username) VALUES (?)", (username,)).lastrowid
+    ids = []
+    for i in range(count):
+        name = f"{username}{i}.jpg"
+        with open(os.path.join(uploads_dir, name), "wb") as f:
+            f.write(b"x" * size)
+        ids.append(conn.execute('''INSERT INTO chat_messages (session_id, message_type, message_text, image_filename,
+                                                              timestamp)
+                                   VALUES (?, 'image', 'photo', ?, ?)''',
+                                (session_id, name, f"2026-01-{start_day + i:02d} 10:00:00")).lastrowid)
+    conn.commit()
+    return ids
+
+
+def images(conn):
+    return {message_id: name for message_id, name in
+            conn.execute("SELECT id, image_filename FROM chat_messages ORDER BY id")}
+
+
+def collector(conn, media, **kwargs):
+    return StorageCollector(lambda: conn, media, media, batch_size=2, run_async=False, **kwargs)
+
+
+def test_user_quota_keeps_each_users_newest_images(conn, media):
+    asha = add_images(conn, media, "asha", 5)
+    ravi = add_images(conn, media, "ravi", 3, start_day=10)
+    report = new_report()
+    steps = list(collector(conn, media, user_quota=250)._expire_images(report, set(), dry_run=False))
+
+    kept = {message_id for message_id, name in images(conn).items() if name}
+    assert kept == set(asha[-2:] + ravi[-2:])
+    assert report["images_expired"] == 4
+    # One step per page of two rows
+    assert len(steps) == 4
+
+
+def test_total_quota_counts_across_users(conn, media):
+    asha = add_images(conn, media, "asha", 3)
+    ravi = add_images(conn, media, "ravi", 3, start_day=10)
+    sweep = collector(conn, media, uploads_max_bytes=350)
+    list(sweep._expire_images(new_report(), set(), dry_run=False))
+    kept = {message_id for message_id, name in images(conn).items() if name}
+    assert kept == set(ravi)
+    assert not kept & set(asha)
+
+
+def test_pages_are_expired_as_they_are_read(conn, media):
+    add_images(conn, media, "asha", 6)
+    report = new_report()
+    expired = set()
+    steps = collector(conn, media, user_quota=150)._expire_images(report, expired, dry_run=False)
+
+    next(steps)
+    # The newest page keeps one image and expires the other; older pages aren't read yet
+    assert report["images_expired"] == 1
+    assert sum(1 for name in images(conn).values() if name is None) == 1
+    list(steps)
+    assert report["images_expired"] == 5
+
+
+def test_max_age_and_dry_run(conn, media):
+    ids = add_images(conn, media, "asha", 3)
+    conn.execute("UPDATE chat_messages SET timestamp = datetime('now') WHERE id = ?", (ids[-1],))
+    conn.commit()
+    sweep = collector(conn, media, upload_max_age_days=30)
+
+    expired = set()
+    report = new_report()
+    list(sweep._expire_images(report, expired, dry_run=True))
+    assert expired == set(ids[:2]) and report["images_expired"] == 2
+    assert all(images(conn).values())
+
+    list(sweep._expire_images(new_report(), set(), dry_run=False))
+    assert [name is None for name in images(conn).values()] == [True, True, False]
+
+
+def test_sweep_removes_the_expired_files(conn, media):
+    ids = add_images(conn, media, "asha", 3)
+    old = time.time() - 7200
+    for name in os.listdir(media):
+        os.utime(os.path.join(media, name), (old, old))
+    report = collector(conn, media, user_quota=150, grace_seconds=3600).collect()
+    assert report["images_expired"] == 2
+    assert report["uploads"]["files"] == 2
+    assert sorted(name for name in os.listdir(media) if name.endswith(".jpg")) == ["asha2.jpg"]
+    assert images(conn)[ids[-1]] == "asha2.jpg"
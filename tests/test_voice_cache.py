@@ -0,0 +1,82 @@
+import threading
+import time
+
+from voice_cache import VoiceCache, voice_filename
+
+
+class Synthesizer:
+    """Writes a fake mp3; the first call can be held until ``release`` is set."""
+
+    def __init__(self, hold_first=False):
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.release = threading.Event()
+        self.started = threading.Event()
+        self.hold_first = hold_first
+
+    def __call__(self, text, lang, slow, path):
+        with self.lock:
+            self.calls += 1
+            first = self.calls == 1
+        self.started.set()
+        if first and self.hold_first:
+            self.release.wait(10)
+        with open(path, "wb") as f:
+            f.write(b"ID3" + text.encode("utf-8"))
+        return True
+
+
+def test_concurrent_requests_share_one_synthesis(tmp_path):
+    synthesize = Synthesizer(hold_first=True)
+    cache = VoiceCache(str(tmp_path), synthesize, wait_seconds=5)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_create("namaskara", "kn", False)))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    synthesize.started.wait(5)
+    time.sleep(0.1)
+    synthesize.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [voice_filename("namaskara", "kn", False)] * 4
+    assert synthesize.calls == 1
+
+
+def test_waiter_synthesizes_itself_when_the_first_synthesis_hangs(tmp_path):
+    synthesize = Synthesizer(hold_first=True)
+    cache = VoiceCache(str(tmp_path), synthesize, wait_seconds=0.2)
+    stuck = threading.Thread(target=cache.get_or_create, args=("namaskara", "kn", False))
+    stuck.start()
+    synthesize.started.wait(5)
+
+    started = time.monotonic()
+    assert cache.get_or_create("namaskara", "kn", False) == voice_filename("namaskara", "kn", False)
+    assert time.monotonic() - started < 2
+    assert synthesize.calls == 2
+
+    synthesize.release.set()
+    stuck.join(5)
+    assert not cache.in_flight
+    assert (tmp_path / voice_filename("namaskara", "kn", False)).read_bytes() == "ID3namaskara".encode("utf-8")
+
+
+def test_concurrent_chunked_requests_join_the_reply_once(tmp_path):
+    text = ("Apply 50 kg of urea per acre after the first weeding. "
+            "Irrigate the field lightly on the same evening to settle it.")
+    synthesize = Synthesizer(hold_first=True)
+    cache = VoiceCache(str(tmp_path), synthesize, wait_seconds=5)
+    cache.total_bytes = 0
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get_or_create_chunked(text, "en", False)))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    synthesize.started.wait(5)
+    time.sleep(0.1)
+    synthesize.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert results == [voice_filename(text, "en", False)] * 3
+    assert synthesize.calls == len(cache.chunk_filenames(text, "en", False)) == 2
+    assert cache.total_bytes == cache._scan_size()
@@ -0,0 +1,52 @@
+import json
+import threading
+
+import pytest
+
+
+@pytest.fixture
+def client(krishi):
+    client = krishi.app.test_client()
+    with client.session_transaction() as session:
+        session["user"] = "asha"
+    return client
+
+
+def sse_events(response):
+    events = []
+    for block in response.get_data(as_text=True).strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines())
+        events.append((fields["event"], json.loads(fields["data"])))
+    return events
+
+
+def add_job(krishi, job_id, status, voice_filename=None):
+    conn = krishi.db.get_connection()
+    with conn:
+        conn.execute('''INSERT INTO voice_jobs (id, username, status, voice_filename, created_at)
+                        VALUES (?, 'asha', ?, ?, 0)''', (job_id, status, voice_filename))
+
+
+def test_events_report_a_finished_job(krishi, client):
+    add_job(krishi, "job-done", "done", "abc.mp3")
+    assert sse_events(client.get("/voice_jobs/job-done/events")) == [
+        ("voice", {"status": "done", "voice": krishi.voice_url("abc.mp3")})]
+
+
+def test_events_report_a_job_deleted_while_waiting(krishi, client):
+    add_job(krishi, "job-purged", "queued")
+
+    def purge():
+        conn = krishi.db.connect()
+        with conn:
+            conn.execute("DELETE FROM voice_jobs WHERE id = 'job-purged'")
+        conn.close()
+
+    # Retention purges the row while the stream is waiting on it
+    timer = threading.Timer(0.2, purge)
+    timer.start()
+    try:
+        assert sse_events(client.get("/voice_jobs/job-purged/events")) == [
+            ("voice", {"status": "gone", "voice": None})]
+    finally:
+        timer.join()
@@ -0,0 +1,166 @@
+"""Background voice synthesis.
+
+Replies are returned as soon as the text is ready; the mp3 is produced by a
+small pool of worker threads fed from a bounded queue. Every job is a row in
+the voice_jobs table so its status survives across workers, and when it
+finishes the file name is back-filled into chat_messages.voice_filename.
+
+    TTS_WORKERS     worker threads per process (default 2)
+    TTS_QUEUE_SIZE  jobs waiting before new ones are dropped (default 100)
+    TTS_ASYNC       "0" runs jobs inline in the request (default "1", "0" on Vercel
+                    where background threads are frozen once the response is sent)
+"""
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+
+WORKERS = int(os.getenv("TTS_WORKERS", "2"))
+QUEUE_SIZE = int(os.getenv("TTS_QUEUE_SIZE", "100"))
+ASYNC = os.getenv("TTS_ASYNC", "0" if os.getenv("VERCEL") == "1" else "1") == "1"
+
+FINISHED = ("done", "failed", "dropped")
+
+
+class VoiceJobQueue:
+    """Bounded worker pool that runs ``synthesize(text, lang)`` jobs.
+
+    ``connect`` returns the sqlite3 connection to use (see db.get_connection).
+    """
+
+    def __init__(self, connect, synthesize, workers=WORKERS, queue_size=QUEUE_SIZE, run_async=ASYNC):
+        self.connect = connect
+        self.synthesize = synthesize
+        self.workers = workers
+        self.run_async = run_async
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.threads = []
+        self.threads_pid = None
+        self.lock = threading.Lock()
+        self.finished = threading.Condition(self.lock)
+        self.counters = {"submitted": 0, "done": 0, "failed": 0, "dropped": 0}
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    def _start_workers(self):
+        # Threads don't survive a fork, so start them lazily in each worker process
+        pid = os.getpid()
+        with self.lock:
+            if self.threads_pid == pid:
+                return
+            self.threads = []
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"tts-worker-{i}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+            self.threads_pid = pid
+
+    def submit(self, text, lang, username, message_id=None):
+        """Queue a voice job and return its id."""
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        conn = self.connect()
+        with conn:
+            conn.execute('''INSERT INTO voice_jobs (id, username, message_id, status, created_at)
+                            VALUES (?, ?, ?, 'pending', ?)''', (job_id, username, message_id, now))
+
+        with self.lock:
+            self.counters["submitted"] += 1
+
+        job = (job_id, text, lang, message_id, now)
+        if not self.run_async:
+            self._run(job)
+            return job_id
+
+        self._start_workers()
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            logging.warning(f"Voice job queue full, dropping job {job_id}")
+            self._finish(job_id, "dropped", error="queue full")
+        return job_id
+
+    def _work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self._run(job)
+            except Exception as e:
+                logging.error(f"Voice job {job[0]} crashed: {e}")
+                self._finish(job[0], "failed", error=str(e))
+            finally:
+                self.queue.task_done()
+
+    def _run(self, job):
+        job_id, text, lang, message_id, queued_at = job
+        started_at = time.time()
+        conn = self.connect()
+        with conn:
+            conn.execute("UPDATE voice_jobs SET status = 'running', started_at = ? WHERE id = ?",
+                         (started_at, job_id))
+
+        voice_filename = self.synthesize(text, lang)
+        finished_at = time.time()
+        with self.lock:
+            self.wait_seconds += started_at - queued_at
+            self.run_seconds += finished_at - started_at
+
+        if voice_filename:
+            self._finish(job_id, "done", voice_filename=voice_filename, message_id=message_id)
+        else:
+            self._finish(job_id, "failed", error="synthesis failed")
+
+    def _finish(self, job_id, status, voice_filename=None, message_id=None, error=None):
+        conn = self.connect()
+        with conn:
+            conn.execute('''UPDATE voice_jobs SET status = ?, voice_filename = ?, error = ?, finished_at = ?
+                            WHERE id = ?''', (status, voice_filename, error, time.time(), job_id))
+            if voice_filename and message_id:
+                conn.execute("UPDATE chat_messages SET voice_filename = ? WHERE id = ?",
+                             (voice_filename, message_id))
+
+        with self.finished:
+            self.counters[status] += 1
+            self.finished.notify_all()
+
+    def get(self, job_id, username=None):
+        """Return {"id", "status", "voice_filename"} or None if unknown."""
+        conn = self.connect()
+        if username is None:
+            row = conn.execute("SELECT id, status, voice_filename FROM voice_jobs WHERE id = ?",
+                               (job_id,)).fetchone()
+        else:
+            row = conn.execute("SELECT id, status, voice_filename FROM voice_jobs WHERE id = ? AND username = ?",
+                               (job_id, username)).fetchone()
+        if not row:
+            return None
+        return {"id": row[0], "status": row[1], "voice_filename": row[2]}
+
+    def wait(self, job_id, timeout, username=None):
+        """Block until the job has finished or ``timeout`` seconds passed.
+
+        Jobs may run in another process, so the table is re-read at least
+        once a second rather than relying only on local notifications.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id, username)
+            if job is None or job["status"] in FINISHED:
+                return job
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return job
+            with self.finished:
+                self.finished.wait(min(1.0, remaining))
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            completed = stats["done"] + stats["failed"]
+            stats["queue_depth"] = self.queue.qsize()
+            stats["workers"] = len(self.threads)
+            stats["avg_wait_seconds"] = round(self.wait_seconds / completed, 3) if completed else 0.0
+            stats["avg_run_seconds"] = round(self.run_seconds / completed, 3) if completed else 0.0
+        return stats
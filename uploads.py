@@ -0,0 +1,244 @@
+"""Image upload pipeline.
+
+An upload is copied to a temporary file in fixed-size chunks while it is
+hashed, and rejected as soon as it passes the byte cap, so an oversized
+photo never sits in memory. The stored file is named after its content
+hash: re-uploading the same photo reuses the file (and its derivatives)
+already on disk. Two derivatives are written next to the original, a
+downscaled JPEG sized for the vision model and a small thumbnail for the
+chat UI. Each stage is timed so slow uploads can be attributed.
+
+    UPLOAD_MAX_BYTES     largest accepted upload (default 10 MB)
+    VISION_MAX_SIDE      longest side of the copy sent to the model (default 1024)
+    VISION_JPEG_QUALITY  JPEG quality of that copy (default 80)
+    THUMBNAIL_MAX_SIDE   longest side of the chat thumbnail (default 320)
+
+Pillow is imported on the first upload rather than at startup, which keeps
+serverless cold starts short.
+"""
+import base64
+import hashlib
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", str(10 * 1024 * 1024)))
+VISION_MAX_SIDE = int(os.getenv("VISION_MAX_SIDE", "1024"))
+VISION_QUALITY = int(os.getenv("VISION_JPEG_QUALITY", "80"))
+THUMBNAIL_MAX_SIDE = int(os.getenv("THUMBNAIL_MAX_SIDE", "320"))
+
+CHUNK_SIZE = 64 * 1024
+
+# Formats we keep, by the extension the stored file gets
+EXTENSIONS = {"JPEG": ".jpg", "MPO": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif", "BMP": ".bmp"}
+
+VISION_SUFFIX = "_vision.jpg"
+THUMBNAIL_SUFFIX = "_thumb.jpg"
+
+
+class UploadRejected(Exception):
+    """The upload was refused; ``reason`` is "too_large" or "invalid"."""
+
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+class StageTimer:
+    """Milliseconds spent in each named stage of one request."""
+
+    def __init__(self):
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def server_timing(self):
+        """Value for a Server-Timing response header."""
+        return ", ".join(f"{name};dur={ms:.1f}" for name, ms in self.stages.items())
+
+    def __str__(self):
+        return " ".join(f"{name}={ms:.1f}ms" for name, ms in self.stages.items())
+
+
+def thumbnail_name(filename):
+    return os.path.splitext(filename)[0] + THUMBNAIL_SUFFIX
+
+
+def vision_name(filename):
+    return os.path.splitext(filename)[0] + VISION_SUFFIX
+
+
+class ImageStore:
+    """Content-addressed store of uploaded images and their derivatives."""
+
+    def __init__(self, directory, max_bytes=MAX_BYTES, vision_side=VISION_MAX_SIDE,
+                 vision_quality=VISION_QUALITY, thumbnail_side=THUMBNAIL_MAX_SIDE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.vision_side = vision_side
+        self.vision_quality = vision_quality
+        self.thumbnail_side = thumbnail_side
+        self.lock = threading.Lock()
+        self.counters = {"stored": 0, "duplicates": 0, "too_large": 0, "invalid": 0, "bytes_in": 0}
+        self.stage_ms = {}
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def ingest(self, stream, timer):
+        """Store an uploaded image and return its file names.
+
+        Returns {"filename", "vision", "thumbnail", "digest", "duplicate"}.
+        Raises UploadRejected for files over the cap or that aren't images.
+        """
+        try:
+            with timer.stage("ingest"):
+                tmp_path, digest, size = self._receive(stream)
+            with self.lock:
+                self.counters["bytes_in"] += size
+
+            with timer.stage("identify"):
+                filename = self._existing(digest)
+                duplicate = filename is not None
+                if duplicate:
+                    os.remove(tmp_path)
+                    # Restart the grace period the storage sweep gives unreferenced files
+                    os.utime(self._path(filename))
+                else:
+                    filename = self._keep(tmp_path, digest)
+
+            stored = {
+                "filename": filename,
+                "vision": vision_name(filename),
+                "thumbnail": thumbnail_name(filename),
+                "digest": digest,
+                "duplicate": duplicate,
+            }
+            if not (os.path.exists(self._path(stored["vision"])) and
+                    os.path.exists(self._path(stored["thumbnail"]))):
+                with timer.stage("resize"):
+                    self._derive(stored)
+        except UploadRejected as e:
+            with self.lock:
+                self.counters[e.reason] += 1
+            raise
+
+        with self.lock:
+            self.counters["duplicates" if duplicate else "stored"] += 1
+        return stored
+
+    def _receive(self, stream):
+        """Copy the stream to a temp file, hashing it and enforcing the cap."""
+        tmp_path = self._path(f".{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                while True:
+                    chunk = stream.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > self.max_bytes:
+                        raise UploadRejected("too_large", f"Upload exceeds {self.max_bytes} bytes")
+                    digest.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        if size == 0:
+            os.remove(tmp_path)
+            raise UploadRejected("invalid", "Empty upload")
+        return tmp_path, digest.hexdigest(), size
+
+    def _existing(self, digest):
+        stem = digest[:32]
+        for extension in set(EXTENSIONS.values()):
+            if os.path.exists(self._path(stem + extension)):
+                return stem + extension
+        return None
+
+    def _keep(self, tmp_path, digest):
+        """Check the temp file is an image we accept and move it into place."""
+        from PIL import Image
+
+        try:
+            with Image.open(tmp_path) as img:
+                image_format = img.format
+                img.verify()
+        except Exception as e:
+            os.remove(tmp_path)
+            raise UploadRejected("invalid", f"Not a supported image: {e}")
+
+        extension = EXTENSIONS.get(image_format)
+        if extension is None:
+            os.remove(tmp_path)
+            raise UploadRejected("invalid", f"Unsupported image format {image_format}")
+
+        filename = digest[:32] + extension
+        os.replace(tmp_path, self._path(filename))
+        return filename
+
+    def _derive(self, stored):
+        """Write the vision copy and the thumbnail of a stored image."""
+        from PIL import Image, ImageOps
+
+        try:
+            with Image.open(self._path(stored["filename"])) as img:
+                # JPEG can decode straight at a reduced scale, which is far
+                # cheaper than decoding a 12 MP photo and shrinking it
+                img.draft("RGB", (self.vision_side, self.vision_side))
+                img = ImageOps.exif_transpose(img)
+                if img.mode in ("RGBA", "LA", "P"):
+                    img = img.convert("RGBA")
+                    background = Image.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+                else:
+                    img = img.convert("RGB")
+
+                img.thumbnail((self.vision_side, self.vision_side), Image.LANCZOS)
+                self._save_jpeg(img, stored["vision"], self.vision_quality)
+                img.thumbnail((self.thumbnail_side, self.thumbnail_side), Image.LANCZOS)
+                self._save_jpeg(img, stored["thumbnail"], 70)
+        except Exception as e:
+            raise UploadRejected("invalid", f"Could not decode image: {e}")
+
+    def _save_jpeg(self, img, filename, quality):
+        tmp_path = self._path(f".{uuid.uuid4().hex}.jpg")
+        img.save(tmp_path, "JPEG", quality=quality, optimize=True)
+        os.replace(tmp_path, self._path(filename))
+
+    def data_url(self, stored):
+        """The vision copy as a base64 data URL for an image_url message part."""
+        with open(self._path(stored["vision"]), "rb") as f:
+            encoded = base64.b64encode(f.read()).decode("ascii")
+        return f"data:image/jpeg;base64,{encoded}"
+
+    def thumbnail_for(self, filename):
+        """Thumbnail to show for a stored image; older uploads have none."""
+        thumbnail = thumbnail_name(filename)
+        return thumbnail if os.path.exists(self._path(thumbnail)) else filename
+
+    def record(self, timer):
+        """Add one upload's stage timings to the running totals."""
+        with self.lock:
+            for name, ms in timer.stages.items():
+                total, count = self.stage_ms.get(name, (0.0, 0))
+                self.stage_ms[name] = (total + ms, count + 1)
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["avg_stage_ms"] = {name: round(total / count, 1)
+                                     for name, (total, count) in self.stage_ms.items()}
+        return stats
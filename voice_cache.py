@@ -0,0 +1,251 @@
+"""Content-addressed store for synthesized voice files.
+
+A reply's mp3 is named after a hash of (text, language, slow flag), so the
+same text is only ever synthesized once: repeated greetings, cached answers
+and the fallback error messages all reuse the file already on disk.
+Concurrent requests for the same text wait for the one synthesis in flight
+instead of starting their own, for up to TTS_WAIT_SECONDS: a synthesis that
+hangs (a stalled gTTS connection) would otherwise hold every waiter's worker
+thread, so after that a waiter synthesizes the text itself. The directory
+is kept under a byte budget by deleting the least recently used files (by
+mtime, which is bumped whenever a file is served); evicted files are
+regenerated on demand.
+
+Long replies can be synthesized sentence by sentence: the chunks run
+concurrently, each lands in its own content-addressed file as soon as it is
+ready (so playback can start with the first sentence), and they are then
+concatenated into the file for the whole text, which is what history uses.
+
+    VOICE_CACHE_MAX_BYTES  disk budget for VOICES_DIR (default 200 MB)
+    TTS_CHUNK_WORKERS      concurrent chunk syntheses per process (default 4)
+    TTS_WAIT_SECONDS       how long a request waits for the same text's synthesis
+                           in flight before doing its own (default 60)
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_BYTES = int(os.getenv("VOICE_CACHE_MAX_BYTES", str(200 * 1024 * 1024)))
+CHUNK_WORKERS = int(os.getenv("TTS_CHUNK_WORKERS", "4"))
+WAIT_SECONDS = float(os.getenv("TTS_WAIT_SECONDS", "60"))
+
+# Sentences shorter than this are merged with the next one so we don't pay a
+# gTTS round trip for every "Yes." or numbered list marker
+MIN_CHUNK_CHARS = 40
+
+# Latin sentence ends need trailing whitespace (so "2.5 kg" stays whole); the
+# danda and double danda end a sentence on their own
+SENTENCE_BREAK = re.compile(r"(?<=[.!?])\s+|(?<=[\u0964\u0965])\s*|\n+")
+
+# After an eviction pass the directory is trimmed down to this share of the budget
+LOW_WATER = 0.9
+
+
+def split_sentences(text):
+    """Split text into speakable chunks at sentence boundaries."""
+    chunks = []
+    current = ""
+    for piece in SENTENCE_BREAK.split(text):
+        piece = piece.strip()
+        if not piece:
+            continue
+        current = f"{current} {piece}" if current else piece
+        if len(current) >= MIN_CHUNK_CHARS:
+            chunks.append(current)
+            current = ""
+    if current:
+        if chunks and len(current) < MIN_CHUNK_CHARS // 2:
+            chunks[-1] = f"{chunks[-1]} {current}"
+        else:
+            chunks.append(current)
+    return chunks
+
+
+def voice_filename(text, lang, slow):
+    digest = hashlib.sha256(f"{lang}\0{int(bool(slow))}\0{text}".encode("utf-8")).hexdigest()
+    return f"{digest[:32]}.mp3"
+
+
+class VoiceCache:
+    """Deduplicating, size-bounded cache of mp3 files in one directory.
+
+    ``synthesize(text, lang, slow, path)`` must write the audio to ``path``
+    and return True on success.
+    """
+
+    def __init__(self, directory, synthesize, max_bytes=MAX_BYTES, wait_seconds=WAIT_SECONDS):
+        self.directory = directory
+        self.synthesize = synthesize
+        self.max_bytes = max_bytes
+        self.wait_seconds = wait_seconds
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.total_bytes = None
+        self.pool = None
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def get_or_create(self, text, lang, slow):
+        """Return the filename of the voice for this text, synthesizing if needed."""
+        filename = voice_filename(text, lang, slow)
+        filepath = self.path(filename)
+
+        if os.path.exists(filepath):
+            self.touch(filename)
+            return filename
+
+        return self._once(filename, lambda: self._create(filename, text, lang, slow))
+
+    def _once(self, filename, create):
+        """Run ``create()`` for a file unless another thread already is, then wait for that one."""
+        filepath = self.path(filename)
+        with self.lock:
+            event = self.in_flight.get(filename)
+            owner = event is None
+            if owner:
+                event = threading.Event()
+                self.in_flight[filename] = event
+
+        if not owner:
+            if event.wait(self.wait_seconds):
+                return filename if os.path.exists(filepath) else None
+            # The synthesis we waited for is stuck; the file is named after its
+            # content, so writing it from here as well is harmless
+            logging.warning(f"Voice {filename} still in flight after {self.wait_seconds}s, synthesizing it again")
+            return create()
+
+        try:
+            return create()
+        finally:
+            with self.lock:
+                del self.in_flight[filename]
+            event.set()
+
+    def _create(self, filename, text, lang, slow):
+        filepath = self.path(filename)
+        # Write under a temporary name so readers never see a partial file
+        tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+        ok = replaced = False
+        try:
+            ok = self.synthesize(text, lang, slow, tmp_path)
+            ok = ok and os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0
+            if ok:
+                replaced = os.path.exists(filepath)
+                os.replace(tmp_path, filepath)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if not ok:
+            return None
+        if not replaced:
+            self._added(os.path.getsize(filepath))
+        return filename
+
+    def get_or_create_chunked(self, text, lang, slow):
+        """Like get_or_create(), but synthesizes sentence chunks in parallel.
+
+        Each chunk is written to its own file as soon as it is ready, then
+        the chunks are concatenated (MP3 frames can simply be appended) into
+        the file for the whole text.
+        """
+        filename = voice_filename(text, lang, slow)
+        filepath = self.path(filename)
+        if os.path.exists(filepath):
+            self.touch(filename)
+            return filename
+
+        chunks = split_sentences(text)
+        if len(chunks) <= 1:
+            return self.get_or_create(text, lang, slow)
+        return self._once(filename, lambda: self._join(filename, chunks, lang, slow))
+
+    def _join(self, filename, chunks, lang, slow):
+        filepath = self.path(filename)
+        with self.lock:
+            if self.pool is None:
+                self.pool = ThreadPoolExecutor(max_workers=CHUNK_WORKERS, thread_name_prefix="tts-chunk")
+        futures = [self.pool.submit(self.get_or_create, chunk, lang, slow) for chunk in chunks]
+        parts = [future.result() for future in futures]
+        if not all(parts):
+            return None
+
+        tmp_path = f"{filepath}.{uuid.uuid4().hex}.tmp"
+        try:
+            with open(tmp_path, "wb") as out:
+                for part in parts:
+                    with open(self.path(part), "rb") as f:
+                        out.write(f.read())
+            replaced = os.path.exists(filepath)
+            os.replace(tmp_path, filepath)
+        except OSError as e:
+            logging.error(f"Failed to join voice chunks: {e}")
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if not replaced:
+            self._added(os.path.getsize(filepath))
+        return filename
+
+    def chunk_filenames(self, text, lang, slow):
+        """Files that get_or_create_chunked() writes for each chunk, in order."""
+        chunks = split_sentences(text)
+        if len(chunks) <= 1:
+            return [voice_filename(text, lang, slow)]
+        return [voice_filename(chunk, lang, slow) for chunk in chunks]
+
+    def touch(self, filename):
+        """Mark a file as recently used."""
+        try:
+            os.utime(self.path(filename))
+        except OSError:
+            pass
+
+    def _added(self, size):
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = self._scan_size()
+            else:
+                self.total_bytes += size
+            over_budget = self.total_bytes > self.max_bytes
+        if over_budget:
+            self.evict()
+
+    def _scan_size(self):
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                total += entry.stat().st_size
+        return total
+
+    def evict(self):
+        """Delete least recently used files until under the low-water mark."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith(".mp3"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        files.sort()
+
+        total = sum(size for _, size, _ in files)
+        target = self.max_bytes * LOW_WATER
+        removed = 0
+        for _, size, path in files:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+
+        with self.lock:
+            self.total_bytes = total
+        if removed:
+            logging.info(f"Voice cache evicted {removed} files, {total} bytes remain")